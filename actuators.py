@@ -0,0 +1,106 @@
+"""Non-blocking scheduler for servo, lock and indicator motions."""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+import metrics
+
+MotionResult = collections.namedtuple(
+    'MotionResult', ['name', 'queued_time', 'start_time', 'end_time'])
+
+
+class ActuatorScheduler:
+  """Runs queued motion commands on a dedicated thread.
+
+  A command is a list of `(delay, action)` steps. Each `action` is called
+  `delay` seconds after the previous step, measured against a deadline so the
+  time spent inside the actions does not accumulate. Commands run one at a
+  time in submission order, so the caller never sleeps while the mechanism
+  moves and the next command starts as soon as the previous one finished.
+  """
+
+  def __init__(self):
+    self._queue = queue.Queue()
+    self._lock = threading.Lock()
+    self._pending = 0
+    self._idle = threading.Event()
+    self._idle.set()
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(
+        target=self._run, name='ActuatorScheduler', daemon=True)
+    self._thread.start()
+
+  def submit(self, name, steps):
+    """Queues a motion command.
+
+    Args:
+      name: Label used in the timing report.
+      steps: List of `(delay, action)` tuples. `action` is a callable taking
+        no arguments.
+
+    Returns:
+      A `concurrent.futures.Future` resolved with a `MotionResult` once the
+      last step ran.
+    """
+    future = concurrent.futures.Future()
+    with self._lock:
+      self._pending += 1
+      self._idle.clear()
+    self._queue.put((name, list(steps), future, time.time()))
+    return future
+
+  def is_idle(self):
+    """Returns True when no command is running or queued."""
+    return self._idle.is_set()
+
+  def wait_idle(self, timeout=None):
+    """Blocks until every queued command finished.
+
+    Returns:
+      True if the scheduler is idle, False if the timeout expired.
+    """
+    return self._idle.wait(timeout)
+
+  def stop(self):
+    """Stops the scheduler after the command in progress."""
+    self._stopped.set()
+    self._queue.put(None)
+    self._thread.join()
+
+  def _run(self):
+    while not self._stopped.is_set():
+      command = self._queue.get()
+      if command is None:
+        break
+      name, steps, future, queued_time = command
+      result, error = None, None
+      if future.set_running_or_notify_cancel():
+        start_time = time.time()
+        deadline = start_time
+        try:
+          for delay, action in steps:
+            deadline += delay
+            remaining = deadline - time.time()
+            if remaining > 0 and self._stopped.wait(remaining):
+              break
+            action()
+        except Exception as e:  # pylint: disable=broad-except
+          error = e
+        else:
+          result = MotionResult(name, queued_time, start_time, time.time())
+          metrics.observe('actuation_wait', start_time - queued_time)
+          metrics.observe('actuation', result.end_time - start_time)
+
+      # Mark the scheduler idle before resolving the future so callers that
+      # wait on it can immediately submit the next command.
+      with self._lock:
+        self._pending -= 1
+        if self._pending == 0:
+          self._idle.set()
+      if error is not None:
+        future.set_exception(error)
+      elif future.running():
+        future.set_result(result)
@@ -0,0 +1,165 @@
+"""Classifies a directory tree of images offline with a pool of processes.
+
+Every worker process loads its own ImageClassifier, so throughput scales with
+the number of cores. Predictions are written as CSV or JSON Lines, depending
+on the extension of the output file:
+
+  python3 batch_classify.py --input classified_images --output labels.csv \
+      --workers 4 --numThreads 1
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import classification
+import image_files
+
+_MAX_RESULTS = 3
+_SCORE_THRESHOLD = 0.0
+_NUM_THREADS = 1
+_CHUNK_SIZE = 16
+_PROGRESS_INTERVAL = 500  # images
+
+# The classifier and preprocessor of the current worker process
+_classifier = None
+_preprocessor = None
+
+
+def _init_worker(model, num_threads, max_results, score_threshold):
+  global _classifier, _preprocessor
+  _classifier = classification.create_classifier(
+      model, num_threads, max_results, score_threshold)
+  _preprocessor = classification.image_preprocessor(model)
+
+
+def _classify_file(path):
+  image = cv2.imread(path)
+  if image is None:
+    return path, None
+  categories = classification.classify_bgr(_classifier, _preprocessor, image)
+  return path, [(c.category_name, c.score) for c in categories]
+
+
+class _CsvWriter:
+
+  def __init__(self, f, max_results):
+    self._writer = csv.writer(f)
+    header = ['path', 'label']
+    for i in range(1, max_results + 1):
+      header += [f'category{i}', f'score{i}']
+    self._writer.writerow(header)
+
+  def write(self, path, label, predictions):
+    row = [path, label]
+    for category_name, score in predictions:
+      row += [category_name, f'{score:.6f}']
+    self._writer.writerow(row)
+
+
+class _JsonlWriter:
+
+  def __init__(self, f, max_results):
+    del max_results  # Unused.
+    self._f = f
+
+  def write(self, path, label, predictions):
+    record = {
+        'path': path,
+        'label': label,
+        'predictions': [{'category': category_name, 'score': score}
+                        for category_name, score in predictions],
+    }
+    self._f.write(json.dumps(record) + '\n')
+
+
+def run(model, input_dir, output, workers, num_threads, max_results,
+        score_threshold):
+  if output.endswith('.jsonl'):
+    writer_class = _JsonlWriter
+  elif output.endswith('.csv'):
+    writer_class = _CsvWriter
+  else:
+    raise ValueError('The output file must end in .csv or .jsonl')
+
+  start_time = time.time()
+  classified, unreadable = 0, 0
+  with open(output, 'w', newline='') as f, multiprocessing.Pool(
+      workers, initializer=_init_worker,
+      initargs=(model, num_threads, max_results, score_threshold)) as pool:
+    writer = writer_class(f, max_results)
+    paths = image_files.find_images(input_dir)
+    for path, predictions in pool.imap(_classify_file, paths, _CHUNK_SIZE):
+      if predictions is None:
+        unreadable += 1
+        print(f'Skipping unreadable image {path}')
+        continue
+      # Images are stored as <category>/<name>.jpg, so the folder is the label
+      label = os.path.basename(os.path.dirname(path))
+      writer.write(path, label, predictions)
+      classified += 1
+      if classified % _PROGRESS_INTERVAL == 0:
+        rate = classified / (time.time() - start_time)
+        print(f'Classified {classified} images ({rate:.1f} images/s)')
+
+  elapsed = time.time() - start_time
+  print(f'Classified {classified} images in {elapsed:.1f} s '
+        f'({classified / max(elapsed, 1e-9):.1f} images/s), '
+        f'skipped {unreadable}. Predictions written to {output}')
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--model',
+      help='Name of image classification model.',
+      required=False,
+      default='default_model.tflite')
+  parser.add_argument(
+      '--input',
+      help='Directory tree of images to classify.',
+      required=False,
+      default='classified_images')
+  parser.add_argument(
+      '--output',
+      help='Predictions file, .csv or .jsonl.',
+      required=False,
+      default='predictions.csv')
+  parser.add_argument(
+      '--workers',
+      help='Number of worker processes.',
+      type=int,
+      required=False,
+      default=os.cpu_count())
+  parser.add_argument(
+      '--numThreads',
+      help='Number of CPU threads used by each classifier.',
+      type=int,
+      required=False,
+      default=_NUM_THREADS)
+  parser.add_argument(
+      '--maxResults',
+      help='Number of categories written per image.',
+      type=int,
+      required=False,
+      default=_MAX_RESULTS)
+  parser.add_argument(
+      '--scoreThreshold',
+      help='Minimum score of a written category.',
+      type=float,
+      required=False,
+      default=_SCORE_THRESHOLD)
+  args = parser.parse_args()
+
+  run(args.model, args.input, args.output, args.workers, args.numThreads,
+      args.maxResults, args.scoreThreshold)
+
+
+if __name__ == '__main__':
+  main()
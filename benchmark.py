@@ -0,0 +1,223 @@
+"""Reproducible benchmark of the image classification models.
+
+Each model is measured in a fresh process on a fixed local image set with
+fixed settings, so load time and peak memory are not skewed by the models
+measured before it. Results are written as JSON and can be compared against
+a previous run to catch regressions between retrained models:
+
+  python3 benchmark.py --images challenged_images --output results.json
+  python3 benchmark.py --baseline results.json --output new_results.json
+
+The folder an image is stored in is its label. Top-1 accuracy only counts
+images whose label is one of the model's categories.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import classification
+import image_files
+
+_MODELS = ['default_model.tflite', 'mobilenet_v2.tflite',
+           'mobilenet_v2_psu_data.tflite']
+_NUM_THREADS = [1, 2, 4]
+# Latency and accuracy are measured with the thread count the bins use
+_LATENCY_NUM_THREADS = 4
+_REPEATS = 5
+_MAX_RESULTS = 3
+_SCORE_THRESHOLD = 0.0
+# Allowed change against the baseline before a result is a regression
+_LATENCY_TOLERANCE = 0.10  # relative increase of the warm p50 latency
+ACCURACY_TOLERANCE = 0.02  # absolute drop of the top-1 accuracy
+
+
+def percentiles(latencies):
+  """Returns the p50, p95 and p99 of latencies in seconds, in ms."""
+  p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+  return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+def _benchmark_model(model, image_paths, num_threads_values, repeats):
+  """Measures one model. Runs in its own process."""
+  images = []
+  for path in image_paths:
+    image = cv2.imread(path)
+    if image is not None:
+      images.append((os.path.basename(os.path.dirname(path)), image))
+  labels = set(classification.model_labels(model))
+  preprocessor = classification.image_preprocessor(model)
+
+  start_time = time.perf_counter()
+  classifier = classification.create_classifier(
+      model, _LATENCY_NUM_THREADS, _MAX_RESULTS, _SCORE_THRESHOLD)
+  load_time = time.perf_counter() - start_time
+
+  start_time = time.perf_counter()
+  classification.classify_bgr(classifier, preprocessor, images[0][1])
+  cold_latency = time.perf_counter() - start_time
+
+  latencies = []
+  correct, labelled = 0, 0
+  for repeat in range(repeats):
+    for label, image in images:
+      start_time = time.perf_counter()
+      categories = classification.classify_bgr(classifier, preprocessor, image)
+      latencies.append(time.perf_counter() - start_time)
+      if repeat == 0 and label in labels:
+        labelled += 1
+        correct += bool(categories) and categories[0].category_name == label
+
+  throughput = {}
+  for num_threads in num_threads_values:
+    threaded_classifier = classification.create_classifier(
+        model, num_threads, _MAX_RESULTS, _SCORE_THRESHOLD)
+    classification.classify_bgr(
+        threaded_classifier, preprocessor, images[0][1])
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+      for _, image in images:
+        classification.classify_bgr(threaded_classifier, preprocessor, image)
+    elapsed = time.perf_counter() - start_time
+    throughput[str(num_threads)] = repeats * len(images) / elapsed
+
+  # ru_maxrss is in kilobytes on Linux
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  return {
+      'load_time_ms': load_time * 1000,
+      'cold_latency_ms': cold_latency * 1000,
+      'warm_latency': percentiles(latencies),
+      'throughput_images_per_s': throughput,
+      'peak_rss_mb': peak_rss,
+      'top1_accuracy': correct / labelled if labelled else None,
+      'labelled_images': labelled,
+      'images': len(images),
+  }
+
+
+def _compare(results, baseline):
+  """Returns a list of regressions of `results` against `baseline`."""
+  regressions = []
+  for model, result in results['models'].items():
+    previous = baseline.get('models', {}).get(model)
+    if previous is None:
+      continue
+    old_p50 = previous['warm_latency']['p50_ms']
+    new_p50 = result['warm_latency']['p50_ms']
+    if new_p50 > old_p50 * (1 + _LATENCY_TOLERANCE):
+      regressions.append(
+          f'{model}: warm p50 latency {old_p50:.1f} -> {new_p50:.1f} ms')
+    old_accuracy = previous['top1_accuracy']
+    new_accuracy = result['top1_accuracy']
+    if (old_accuracy is not None and new_accuracy is not None and
+        new_accuracy < old_accuracy - ACCURACY_TOLERANCE):
+      regressions.append(f'{model}: top-1 accuracy {old_accuracy:.3f} -> '
+                         f'{new_accuracy:.3f}')
+  return regressions
+
+
+def run(models, images_dir, output, num_threads_values, repeats, baseline):
+  image_paths = list(image_files.find_images(images_dir))
+  if not image_paths:
+    sys.exit(f'ERROR: No images found in {images_dir}')
+
+  results = {
+      'settings': {
+          'images_dir': images_dir,
+          'images': len(image_paths),
+          'repeats': repeats,
+          'num_threads': num_threads_values,
+          'latency_num_threads': _LATENCY_NUM_THREADS,
+          'max_results': _MAX_RESULTS,
+          'score_threshold': _SCORE_THRESHOLD,
+      },
+      'platform': {
+          'machine': platform.machine(),
+          'python': platform.python_version(),
+          'cpu_count': os.cpu_count(),
+      },
+      'timestamp': time.time(),
+      'models': {},
+  }
+  # A fresh process per model keeps load time and peak RSS independent
+  context = multiprocessing.get_context('spawn')
+  for model in models:
+    print(f'Benchmarking {model}')
+    with context.Pool(1) as pool:
+      result = pool.apply(
+          _benchmark_model,
+          (model, image_paths, num_threads_values, repeats))
+    results['models'][model] = result
+    latency = result['warm_latency']
+    print(f"  load {result['load_time_ms']:.0f} ms, "
+          f"cold {result['cold_latency_ms']:.1f} ms, "
+          f"warm p50/p95/p99 {latency['p50_ms']:.1f}/{latency['p95_ms']:.1f}/"
+          f"{latency['p99_ms']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB, "
+          f"top-1 accuracy {result['top1_accuracy']}")
+
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {output}')
+
+  if baseline:
+    with open(baseline) as f:
+      regressions = _compare(results, json.load(f))
+    for regression in regressions:
+      print(f'REGRESSION: {regression}')
+    if regressions:
+      sys.exit(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--models',
+      help='Names of the models to benchmark.',
+      nargs='+',
+      required=False,
+      default=_MODELS)
+  parser.add_argument(
+      '--images',
+      help='Directory of labelled images, one folder per category.',
+      required=False,
+      default='challenged_images')
+  parser.add_argument(
+      '--output',
+      help='JSON file the results are written to.',
+      required=False,
+      default='benchmark_results.json')
+  parser.add_argument(
+      '--numThreads',
+      help='Thread counts to measure throughput with.',
+      type=int,
+      nargs='+',
+      required=False,
+      default=_NUM_THREADS)
+  parser.add_argument(
+      '--repeats',
+      help='Number of passes over the image set.',
+      type=int,
+      required=False,
+      default=_REPEATS)
+  parser.add_argument(
+      '--baseline',
+      help='Previous results file; exit with an error on regressions.',
+      required=False,
+      default=None)
+  args = parser.parse_args()
+
+  run(args.models, args.images, args.output, args.numThreads, args.repeats,
+      args.baseline)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+"""Multi-frame classification that stops as soon as the result is clear."""
+
+import numpy as np
+
+
+class BurstClassifier:
+  """Averages the category scores of consecutive frames of the same item.
+
+  Each frame's categories are scattered into a score vector indexed by the
+  model's category index and added to a running sum, so the average over all
+  frames seen so far is a single vector division. The burst is done when the
+  best average score reaches `threshold` after at least `min_frames` frames,
+  or when `max_frames` frames were classified.
+  """
+
+  def __init__(self, threshold, max_frames, min_frames=1):
+    self._threshold = threshold
+    self._max_frames = max_frames
+    self._min_frames = min_frames
+    self._sums = np.zeros(0, dtype=np.float32)
+    self._names = {}
+    self._best_frames = {}
+    self.frames = 0
+    self.done = False
+
+  def add(self, categories, image):
+    """Adds the classification of one frame.
+
+    Args:
+      categories: `classifications[0].categories` of the frame's result.
+      image: The classified frame, kept if it is the most confident frame for
+        one of its categories.
+
+    Returns:
+      True once enough evidence was gathered to decide.
+    """
+    if categories:
+      indices = np.fromiter((c.index for c in categories), dtype=np.int64)
+      scores = np.fromiter((c.score for c in categories), dtype=np.float32)
+      if indices.max() >= len(self._sums):
+        self._sums = np.pad(self._sums, (0, indices.max() + 1 - len(self._sums)))
+      self._sums[indices] += scores
+      for c in categories:
+        self._names[c.index] = c.category_name
+        best = self._best_frames.get(c.index)
+        if best is None or c.score > best[0]:
+          self._best_frames[c.index] = (c.score, image)
+
+    self.frames += 1
+    _, score = self._leader()
+    self.done = ((self.frames >= self._min_frames and score >= self._threshold)
+                 or self.frames >= self._max_frames)
+    return self.done
+
+  def _leader(self):
+    if not len(self._sums):
+      return None, 0.0
+    index = int(np.argmax(self._sums))
+    return index, float(self._sums[index]) / self.frames
+
+  def ranking(self, count):
+    """Returns the `count` best `(category_name, score)` pairs, best first.
+
+    Scores are averaged over every frame of the burst.
+    """
+    if not self.frames:
+      return []
+    order = np.argsort(self._sums)[::-1][:count]
+    return [(self._names[index], float(self._sums[index]) / self.frames)
+            for index in order if index in self._names]
+
+  def result(self):
+    """Returns the decision as `(category_name, score, image)`.
+
+    `score` is the average score over every frame of the burst and `image` is
+    the frame the chosen category was most confident on.
+    """
+    index, score = self._leader()
+    if index is None:
+      return None, 0.0, None
+    return self._names[index], score, self._best_frames[index][1]
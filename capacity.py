@@ -0,0 +1,149 @@
+"""Fill level of the bin from its IR break beams.
+
+A beam is broken when waste piles up in front of it, but also for a moment
+when an item falls through it. The GPIO callbacks only timestamp the edges
+into a queue; a monitor thread keeps a timer per beam and only trusts a beam's
+level once it has not changed for `settle_time` seconds. The callbacks never
+block, so the PIR callback sharing RPi.GPIO's callback thread is never
+delayed by the beams.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+import metrics
+
+_SETTLE_TIME = 10  # seconds a beam must stay broken or clear to count
+_FULL_LEVEL = 1.0  # fill level at which the bin counts as full
+
+BeamEdge = collections.namedtuple('BeamEdge', ['timestamp', 'pin'])
+
+
+class CapacityMonitor:
+  """Debounces the break beams and reports the fill level and a full bin.
+
+  The fill level is the fraction of beams that are settled broken. Lower
+  beams only raise the level; the bin is full once the level reaches
+  `full_level`, and stays full until `reset()` is called after it was
+  emptied; beams clearing on their own, e.g. when the waste settles, never
+  unlock it. `on_full` and `on_level` are called on the
+  monitor thread, so they may take time, but should hand slow work such as
+  servo moves to the actuator scheduler.
+  """
+
+  def __init__(self, gpio, pins, on_full, on_level=None,
+               settle_time=_SETTLE_TIME, full_level=_FULL_LEVEL):
+    """Initializes the monitor. The pins must be set up as inputs.
+
+    Args:
+      gpio: The `RPi.GPIO` module, or an object with the same interface.
+      pins: BCM pins of the beam receivers, which read low when broken.
+      on_full: Called without arguments when the bin becomes full.
+      on_level: Called with the new fill level whenever it changes.
+      settle_time: Seconds a beam's level must be stable to count.
+      full_level: Fill level from 0 to 1 at which the bin is full. The
+        default waits until every beam, up to the top one, is broken.
+    """
+    self._gpio = gpio
+    self._pins = tuple(pins)
+    self._on_full = on_full
+    self._on_level = on_level
+    self._settle_time = settle_time
+    self._full_level = full_level
+    self._edges = queue.Queue()
+    self._lock = threading.Lock()
+    self._blocked = dict.fromkeys(self._pins, False)
+    self._thread = None
+    self.full = False
+
+  def start(self):
+    """Watches both edges of every beam and starts the monitor thread."""
+    for pin in self._pins:
+      self._gpio.add_event_detect(pin, self._gpio.BOTH, callback=self._edge)
+      # A beam already broken at startup settles like a new edge
+      if not self._gpio.input(pin):
+        self._edge(pin)
+    self._thread = threading.Thread(
+        target=self._run, name='CapacityMonitor', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    for pin in self._pins:
+      self._gpio.remove_event_detect(pin)
+    self._edges.put(None)
+    if self._thread is not None:
+      self._thread.join()
+
+  def level(self):
+    """Returns the fraction of beams that are broken, from 0 to 1."""
+    return sum(self._blocked.values()) / len(self._pins)
+
+  def reset(self):
+    """Marks a full bin as emptied, e.g. from a maintenance control.
+
+    The beams are read right away instead of waiting for them to settle, so
+    the bin can be unlocked as soon as it was emptied.
+
+    Returns:
+      True if the bin was full and no beam is broken now, so it may be
+      unlocked. False if it was not full or is still blocked.
+    """
+    with self._lock:
+      if not self.full:
+        return False
+      broken = [pin for pin in self._pins if not self._gpio.input(pin)]
+      if broken:
+        print(f'Not resetting the bin, beam(s) {broken} still broken')
+        return False
+      self._blocked = dict.fromkeys(self._pins, False)
+      self.full = False
+    print('Bin reset after emptying')
+    if self._on_level:
+      self._on_level(0.0)
+    return True
+
+  def _edge(self, channel):
+    # Runs on the GPIO callback thread, so it must not block
+    self._edges.put(BeamEdge(time.time(), channel))
+
+  def _run(self):
+    # Time at which each beam with a recent edge is read again
+    deadlines = {}
+    while True:
+      timeout = None
+      if deadlines:
+        timeout = max(0.0, min(deadlines.values()) - time.time())
+      try:
+        edge = self._edges.get(timeout=timeout)
+      except queue.Empty:
+        edge = False
+      if edge is None:
+        return
+      if edge:
+        metrics.increment('beam_edges')
+        # Every edge restarts the beam's timer, so bouncing and items
+        # falling through the beam never settle
+        deadlines[edge.pin] = edge.timestamp + self._settle_time
+
+      now = time.time()
+      for pin in [pin for pin, deadline in deadlines.items()
+                  if deadline <= now]:
+        del deadlines[pin]
+        self._settle(pin, not self._gpio.input(pin))
+
+  def _settle(self, pin, blocked):
+    with self._lock:
+      if blocked == self._blocked[pin]:
+        return
+      self._blocked[pin] = blocked
+      level = self.level()
+      became_full = level >= self._full_level and not self.full
+      self.full = self.full or became_full
+    print(f"Beam {pin} {'broken' if blocked else 'clear'}, bin "
+          f'{level:.0%} full')
+    if self._on_level:
+      self._on_level(level)
+    if became_full:
+      self._on_full()
@@ -0,0 +1,254 @@
+"""Camera session management and background frame capture."""
+
+import collections
+import threading
+import time
+
+import cv2
+
+# Number of frames kept in the ring buffer. Older frames are dropped.
+_DEFAULT_BUFFER_SIZE = 2
+
+# Consecutive failed reads before the camera is considered disconnected.
+_MAX_CONSECUTIVE_FAILURES = 5
+# Reconnect backoff, doubled after every failed attempt.
+_INITIAL_BACKOFF = 0.5  # seconds
+_MAX_BACKOFF = 10  # seconds
+# Frames grabbed and discarded to empty the driver queue on flush.
+_FLUSH_FRAMES = 2
+
+Frame = collections.namedtuple('Frame', ['index', 'timestamp', 'image'])
+
+
+class CameraSession:
+  """Keeps a camera device open for the life of the process.
+
+  Reads that fail are retried; only after several consecutive failures is the
+  device released and reopened, with exponential backoff between attempts.
+  The duration of every reconnect is recorded in `reconnect_durations`.
+
+  `capture_factory` creates the device from `camera_id`. It defaults to
+  `cv2.VideoCapture` and can be replaced by a simulated camera.
+  """
+
+  def __init__(self, camera_id, width, height,
+               max_failures=_MAX_CONSECUTIVE_FAILURES,
+               max_reconnect_attempts=None, capture_factory=cv2.VideoCapture):
+    self._camera_id = camera_id
+    self._capture_factory = capture_factory
+    self._width = width
+    self._height = height
+    self._max_failures = max_failures
+    self._max_reconnect_attempts = max_reconnect_attempts
+    self._failures = 0
+    self._backoff = _INITIAL_BACKOFF
+    self._delivered_since_open = True
+    self._cap = None
+    self.reconnect_durations = collections.deque(maxlen=20)
+
+  def open(self):
+    """Opens the camera device.
+
+    Returns:
+      True if the device is open.
+    """
+    self._cap = self._capture_factory(self._camera_id)
+    self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, self._width)
+    self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self._height)
+    # Keep the driver queue short so frames are never far behind real time.
+    self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    self._failures = 0
+    self._delivered_since_open = False
+    return self._cap.isOpened()
+
+  def is_open(self):
+    return self._cap is not None and self._cap.isOpened()
+
+  def release(self):
+    if self._cap is not None:
+      self._cap.release()
+      self._cap = None
+
+  def read(self):
+    """Reads a frame, reconnecting if the device stopped delivering frames.
+
+    Returns:
+      A `(success, image)` tuple like `cv2.VideoCapture.read()`. A failed
+      read does not mean the session is lost; check `is_open()` for that.
+    """
+    success, image = self._cap.read()
+    if success:
+      self._failures = 0
+      self._backoff = _INITIAL_BACKOFF
+      self._delivered_since_open = True
+      return True, image
+
+    self._failures += 1
+    if self._failures >= self._max_failures:
+      self.reconnect()
+    return False, None
+
+  def flush(self):
+    """Discards frames already queued in the driver."""
+    for _ in range(_FLUSH_FRAMES):
+      self._cap.grab()
+
+  def reconnect(self):
+    """Reopens the device, backing off between failed attempts.
+
+    Returns:
+      True if the device was reopened, False if `max_reconnect_attempts` was
+      reached.
+    """
+    start_time = time.time()
+    attempts = 0
+    while True:
+      # Back off before every attempt except the first one after the device
+      # was healthy, so a camera that opens but never delivers frames does not
+      # make us spin.
+      if attempts > 0 or not self._delivered_since_open:
+        time.sleep(self._backoff)
+        self._backoff = min(self._backoff * 2, _MAX_BACKOFF)
+      attempts += 1
+      self.release()
+      if self.open():
+        duration = time.time() - start_time
+        self.reconnect_durations.append(duration)
+        print(f'Camera reconnected in {duration:.2f} s '
+              f'after {attempts} attempt(s)')
+        return True
+      if (self._max_reconnect_attempts is not None and
+          attempts >= self._max_reconnect_attempts):
+        self.release()
+        print(f'ERROR: Unable to reconnect to the camera after '
+              f'{attempts} attempt(s)')
+        return False
+
+
+class FrameGrabber:
+  """Drains a camera on a dedicated thread into a small ring buffer.
+
+  The reader thread reads from a `CameraSession` as fast as the camera
+  delivers frames, so the driver queue never fills up with stale images.
+  Consumers ask for the freshest frame newer than a given time and block on
+  a condition variable instead of spinning on `cap.read()` themselves.
+  """
+
+  def __init__(self, session, buffer_size=_DEFAULT_BUFFER_SIZE):
+    self._session = session
+    self._frames = collections.deque(maxlen=buffer_size)
+    self._condition = threading.Condition()
+    self._thread = None
+    self._running = False
+    self._flush_requested = False
+    self._frame_index = 0
+    self._listeners = []
+    self.failed = False
+
+  def start(self):
+    """Opens the camera and starts the reader thread.
+
+    Returns:
+      True if the camera was opened successfully.
+    """
+    if not self._session.is_open() and not self._session.open():
+      self.failed = True
+      return False
+    self._running = True
+    self._thread = threading.Thread(
+        target=self._read_loop, name='FrameGrabber', daemon=True)
+    self._thread.start()
+    return True
+
+  def stop(self):
+    """Stops the reader thread and releases the camera."""
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    self._session.release()
+
+  def flush(self):
+    """Drops buffered frames so the next frame is captured after this call.
+
+    The driver queue is emptied on the reader thread, which owns the device.
+    Frames returned by `wait_for_frame(time.time())` afterwards were captured
+    after the flush.
+    """
+    with self._condition:
+      self._flush_requested = True
+      self._frames.clear()
+
+  def is_running(self):
+    return self._running
+
+  def add_listener(self, listener):
+    """Calls `listener(frame)` on the reader thread for every new frame.
+
+    Listeners run before the frame is handed to consumers, so they must be
+    cheap. Exceptions they raise are printed and otherwise ignored.
+    """
+    self._listeners.append(listener)
+
+  def _read_loop(self):
+    try:
+      while self._running:
+        if self._flush_requested:
+          self._flush_requested = False
+          self._session.flush()
+
+        success, image = self._session.read()
+        timestamp = time.time()
+        with self._condition:
+          if not success:
+            if not self._session.is_open():
+              self.failed = True
+              self._running = False
+          elif not self._flush_requested:
+            self._frame_index += 1
+            frame = Frame(self._frame_index, timestamp, image)
+            for listener in self._listeners:
+              # A broken listener must not stop the capture for everyone
+              try:
+                listener(frame)
+              except Exception as e:  # pylint: disable=broad-except
+                print(f'ERROR: Frame listener {listener!r} failed: {e!r}')
+            self._frames.append(frame)
+          self._condition.notify_all()
+    finally:
+      # Consumers must not wait forever if the thread dies, e.g. when the
+      # camera device raises
+      with self._condition:
+        if self._running:
+          self.failed = True
+          self._running = False
+        self._condition.notify_all()
+
+  def latest(self):
+    """Returns the most recent frame, or None if nothing was captured yet."""
+    with self._condition:
+      return self._frames[-1] if self._frames else None
+
+  def wait_for_frame(self, newer_than=0.0, timeout=None):
+    """Blocks until a frame captured after `newer_than` is available.
+
+    Args:
+      newer_than: Timestamp (as returned by `time.time()`) the frame must be
+        newer than.
+      timeout: Maximum number of seconds to wait, or None to wait forever.
+
+    Returns:
+      The freshest `Frame` newer than `newer_than`, or None if the timeout
+      expired or the camera stopped delivering frames.
+    """
+    def ready():
+      return (not self._running or
+              (self._frames and self._frames[-1].timestamp > newer_than))
+
+    with self._condition:
+      self._condition.wait_for(ready, timeout)
+      if self._frames and self._frames[-1].timestamp > newer_than:
+        return self._frames[-1]
+      return None
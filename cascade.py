@@ -0,0 +1,110 @@
+"""Two-stage classification: a fast model first, a heavier one when unsure.
+
+Every frame is classified by the fast model. Only when its best score is
+below `min_score`, or the best two scores are closer than `min_margin`, the
+frame is classified again by the accurate model, whose categories are then
+used instead. Both models stay loaded, so an escalation costs one extra
+inference and no load.
+"""
+
+import threading
+
+import metrics
+
+MIN_SCORE = 0.7  # best fast-model score below which a frame is escalated
+MIN_MARGIN = 0.2  # gap between the best two scores below which it is too
+
+
+def is_uncertain(categories, min_score=MIN_SCORE, min_margin=MIN_MARGIN):
+  """Returns True if a classification is not clear enough to act on."""
+  scores = sorted((c.score for c in categories), reverse=True)
+  if not scores:
+    return True
+  runner_up = scores[1] if len(scores) > 1 else 0.0
+  return scores[0] < min_score or scores[0] - runner_up < min_margin
+
+
+class Cascade:
+  """Classifies with the fast model and escalates uncertain frames.
+
+  The models come from `model_manager.ModelManager`s, so the fast model can
+  still be swapped at runtime. Take the models once per item with
+  `stages()` and pass them to `classify()` for every frame of the item.
+  """
+
+  def __init__(self, fast, accurate=None, min_score=MIN_SCORE,
+               min_margin=MIN_MARGIN):
+    """Initializes the cascade.
+
+    Args:
+      fast: `ModelManager` of the model every frame is classified by.
+      accurate: `ModelManager` of the model uncertain frames are escalated
+        to, or None to only use the fast model.
+      min_score: Best fast-model score below which a frame is escalated.
+      min_margin: Gap between the two best scores below which a frame is
+        escalated.
+    """
+    self._fast = fast
+    self._accurate = accurate
+    self._min_score = min_score
+    self._min_margin = min_margin
+    self._lock = threading.Lock()
+    self.classifications = 0
+    self.escalations = 0
+
+  def stages(self):
+    """Returns the active `(fast, accurate)` models; `accurate` may be None."""
+    accurate = self._accurate.current() if self._accurate else None
+    return self._fast.current(), accurate
+
+  @staticmethod
+  def tag(stages):
+    """Returns a key that changes whenever one of the models does."""
+    return tuple((model.name, model.mtime) for model in stages if model)
+
+  def escalation_rate(self):
+    """Returns the fraction of frames the accurate model was asked about."""
+    with self._lock:
+      if not self.classifications:
+        return 0.0
+      return self.escalations / self.classifications
+
+  def classify(self, image, stages=None):
+    """Classifies a BGR frame.
+
+    Args:
+      image: BGR frame from the camera.
+      stages: `(fast, accurate)` from `stages()`. `accurate` None classifies
+        with the fast model only.
+
+    Returns:
+      A `(categories, model)` tuple with the categories of the model that
+      decided and its `LoadedModel`.
+    """
+    fast, accurate = stages or self.stages()
+    categories = self._run(fast, image, 'preprocess', 'inference')
+    if accurate is None:
+      return categories, fast
+    escalate = is_uncertain(categories, self._min_score, self._min_margin)
+    with self._lock:
+      self.classifications += 1
+      self.escalations += escalate
+    metrics.increment('cascade_classifications')
+    if not escalate:
+      return categories, fast
+
+    metrics.increment('escalations')
+    categories = self._run(accurate, image, 'escalation_preprocess',
+                           'escalation_inference')
+    print(f'Escalated to {accurate.name}, '
+          f'{self.escalation_rate():.0%} of cascade classifications so far')
+    return categories, accurate
+
+  @staticmethod
+  def _run(model, image, preprocess_stage, inference_stage):
+    # Scale straight to the model's input size in reused buffers
+    with metrics.timed(preprocess_stage):
+      tensor_image = model.preprocessor(image)
+    with metrics.timed(inference_stage):
+      result = model.classifier.classify(tensor_image)
+    return result.classifications[0].categories
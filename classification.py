@@ -0,0 +1,56 @@
+"""Helpers shared by the tools that run the image classification models."""
+
+import os
+
+from tflite_support import metadata
+from tflite_support.task import core
+from tflite_support.task import processor
+from tflite_support.task import vision
+
+import preprocess
+
+MODELS_DIR = './models'
+
+
+def model_path(model):
+  """Returns the path of a model given its name in `models/` or a path."""
+  if os.path.isfile(model):
+    return model
+  return os.path.join(MODELS_DIR, model)
+
+
+def create_classifier(model, num_threads, max_results, score_threshold):
+  """Creates an ImageClassifier the same way the run() loops do."""
+  base_options = core.BaseOptions(
+      file_name=model_path(model), use_coral=False, num_threads=num_threads)
+  classification_options = processor.ClassificationOptions(
+      max_results=max_results, score_threshold=score_threshold)
+  options = vision.ImageClassifierOptions(
+      base_options=base_options, classification_options=classification_options)
+  return vision.ImageClassifier.create_from_options(options)
+
+
+def model_labels(model):
+  """Returns the category names packed in a model's metadata."""
+  displayer = metadata.MetadataDisplayer.with_model_file(model_path(model))
+  for name in displayer.get_packed_associated_file_list():
+    if name.endswith('.txt'):
+      labels = displayer.get_associated_file_buffer(name).decode('utf-8')
+      return [label.strip() for label in labels.splitlines() if label.strip()]
+  return []
+
+
+def image_preprocessor(model):
+  """Returns the `Preprocessor` for images stored by the bins.
+
+  Saved and uploaded images are mirrored like the frames the run() loops
+  classify, so they are converted the same way, just not mirrored again.
+  """
+  return preprocess.Preprocessor(model_path(model), flip=False)
+
+
+def classify_bgr(classifier, preprocessor, image):
+  """Classifies a BGR image and returns its categories, best first."""
+  categories = classifier.classify(preprocessor(image))
+  return sorted(categories.classifications[0].categories,
+                key=lambda x: x.score, reverse=True)
@@ -0,0 +1,302 @@
+"""Exports the bin's image folders as pre-resized NumPy shards for retraining.
+
+The retraining notebook reads `<root>/<category>/*.jpg` trees, like the ones
+`dataset_writer.DatasetWriter` and the challenge uploads write, and decodes
+every image again on every run. This exporter decodes and resizes each image
+once, into `.npy` shards that training code memory-maps:
+
+  python3 dataset_export.py --sources classified_images challenged_images
+
+Only images added since the last export are processed. An image is known by
+the SHA-1 of its content, so renamed or copied files are not exported twice,
+and files whose path, size and modification time were seen before are not
+even read again. Every run appends at most a few new shards and never
+rewrites old ones.
+
+The category of an image is the name of its directory. Challenged images are
+filed under the category the bin gave them, so move them to the right
+category after reviewing them. An exported image that shows up under another
+category is not exported again; a row appended to the index relabels it, and
+`load()` applies the latest label of every image over the shard's labels.
+
+Output directory layout:
+
+  labels.txt                   category names; line number = label index
+  shard-00000.npy              uint8 [count, height, width, 3] RGB images
+  shard-00000.labels.npy       int32 [count] label indices
+  index.jsonl                  one line per exported or relabeled image
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import image_files
+
+_SOURCES = ('classified_images', 'challenged_images')
+_OUTPUT_DIR = 'dataset_export'
+_SIZE = (224, 224)  # input size of the MobileNetV2 models in models/
+_SHARD_SIZE = 512  # images per shard at most, 75 MB at 224x224
+_LABELS_NAME = 'labels.txt'
+_INDEX_NAME = 'index.jsonl'
+
+
+def _hash_file(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _shard_paths(output_dir, shard):
+  name = os.path.join(output_dir, f'shard-{shard:05d}')
+  return name + '.npy', name + '.labels.npy'
+
+
+def load(output_dir=_OUTPUT_DIR):
+  """Returns the exported dataset without reading the images.
+
+  Returns:
+    A `(shards, label_names)` tuple. `shards` is a list of `(images, labels)`
+    pairs, where `images` is a read-only memory map of one shard and `labels`
+    holds the latest label of every image.
+  """
+  with open(os.path.join(output_dir, _LABELS_NAME)) as f:
+    label_names = [line.rstrip('\n') for line in f]
+  shards = []
+  shard = 0
+  while os.path.exists(_shard_paths(output_dir, shard)[1]):
+    images_path, labels_path = _shard_paths(output_dir, shard)
+    labels = np.load(labels_path)
+    # Rows of images that failed to decode are left unused at the end
+    images = np.load(images_path, mmap_mode='r')[:len(labels)]
+    shards.append((images, labels))
+    shard += 1
+  # Later index lines relabel images moved to another category
+  with open(os.path.join(output_dir, _INDEX_NAME)) as f:
+    for line in f:
+      entry = json.loads(line)
+      if entry['shard'] is not None and entry['shard'] < len(shards):
+        shards[entry['shard']][1][entry['row']] = label_names.index(
+            entry['label'])
+  return shards, label_names
+
+
+class DatasetExporter:
+  """Appends the images not exported yet to the shards in `output_dir`."""
+
+  def __init__(self, output_dir=_OUTPUT_DIR, size=_SIZE,
+               shard_size=_SHARD_SIZE, num_workers=None):
+    """Initializes the exporter and reads what was exported before.
+
+    Args:
+      output_dir: Directory of the shards, created if needed.
+      size: `(width, height)` the images are resized to. Must be the same for
+        every export into one directory.
+      shard_size: Images per shard at most.
+      num_workers: Threads decoding and resizing, one per core if None.
+    """
+    self._output_dir = output_dir
+    self._size = tuple(size)
+    self._shard_size = shard_size
+    self._num_workers = num_workers or os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+    self._labels = []
+    labels_path = os.path.join(output_dir, _LABELS_NAME)
+    if os.path.exists(labels_path):
+      with open(labels_path) as f:
+        self._labels = [line.rstrip('\n') for line in f]
+    # Hash -> (shard, row, label) of the latest index line of every image
+    self._exported = {}
+    self._seen_files = set()
+    self._next_shard = 0
+    index_path = os.path.join(output_dir, _INDEX_NAME)
+    if os.path.exists(index_path):
+      with open(index_path) as f:
+        for line in f:
+          entry = json.loads(line)
+          if tuple(entry['size']) != self._size:
+            raise ValueError(f"{output_dir} holds {entry['size']} images, "
+                             f'not {list(self._size)}')
+          self._exported[entry['hash']] = (
+              entry['shard'], entry['row'], entry['label'])
+          self._seen_files.add(tuple(entry['file']))
+          if entry['shard'] is not None:
+            self._next_shard = max(self._next_shard, entry['shard'] + 1)
+
+  def find_new(self, sources):
+    """Finds the images to export and the exported ones that were moved.
+
+    Returns:
+      A `(new, moved)` tuple of lists of `(path, category, hash, file key)`.
+      `moved` holds exported images found under another category.
+    """
+    new = []
+    moved = []
+    hashes = set()
+    candidates = []
+    for source in sources:
+      for path in image_files.find_images(source):
+        relative = os.path.relpath(path, source)
+        if os.sep not in relative:
+          continue  # Not in a category directory
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if key not in self._seen_files:
+          candidates.append((path, relative.split(os.sep)[0], key))
+    # Hashing is I/O bound, so it runs on the same threads as the decoding
+    with concurrent.futures.ThreadPoolExecutor(self._num_workers) as pool:
+      digests = pool.map(_hash_file, [path for path, _, _ in candidates])
+      for (path, category, key), digest in zip(candidates, digests):
+        exported = self._exported.get(digest)
+        if (exported is not None and exported[0] is not None and
+            exported[2] != category):
+          moved.append((path, category, digest, key))
+          continue
+        if exported is not None or digest in hashes:
+          # Same content as an exported image; remember the file as done
+          self._seen_files.add(key)
+          continue
+        hashes.add(digest)
+        new.append((path, category, digest, key))
+    return new, moved
+
+  def export(self, sources):
+    """Exports the new images of `sources` and returns how many it wrote.
+
+    Exported images that were moved to another category are relabeled.
+    """
+    new, moved = self.find_new(sources)
+    if moved:
+      self._relabel(moved)
+    return sum(self._write_shard(new[start:start + self._shard_size])
+               for start in range(0, len(new), self._shard_size))
+
+  def _relabel(self, moved):
+    """Appends index lines that give exported images their new category."""
+    with open(os.path.join(self._output_dir, _INDEX_NAME), 'a') as f:
+      for _, category, digest, key in moved:
+        shard, row, label = self._exported[digest]
+        self._label(category)
+        f.write(json.dumps({
+            'hash': digest,
+            'shard': shard,
+            'row': row,
+            'label': category,
+            'size': list(self._size),
+            'file': list(key),
+        }) + '\n')
+        self._exported[digest] = (shard, row, category)
+        self._seen_files.add(key)
+        print(f'Relabeled {digest[:8]} from {label} to {category}')
+
+  def _label(self, category):
+    if category not in self._labels:
+      self._labels.append(category)
+      with open(os.path.join(self._output_dir, _LABELS_NAME), 'a') as f:
+        f.write(category + '\n')
+    return self._labels.index(category)
+
+  def _write_shard(self, items):
+    """Decodes `items` into the next shard; returns the images written."""
+    shard = self._next_shard
+    images_path, labels_path = _shard_paths(self._output_dir, shard)
+    width, height = self._size
+    images = np.lib.format.open_memmap(
+        images_path + '.tmp', mode='w+', dtype=np.uint8,
+        shape=(len(items), height, width, 3))
+    rows = []
+    failed = []
+    lock = threading.Lock()
+
+    def convert(item):
+      image = cv2.imread(item[0])
+      if image is None:
+        print(f'Skipping {item[0]}, it could not be decoded')
+        failed.append(item)
+        return
+      with lock:
+        row = len(rows)
+        rows.append(item)
+      # Written straight into the shard's pages, without another copy
+      cv2.resize(image, self._size, dst=images[row],
+                 interpolation=cv2.INTER_AREA)
+      cv2.cvtColor(images[row], cv2.COLOR_BGR2RGB, dst=images[row])
+
+    with concurrent.futures.ThreadPoolExecutor(self._num_workers) as pool:
+      list(pool.map(convert, items))
+    images.flush()
+    del images
+    if rows:
+      labels = np.array(
+          [self._label(category) for _, category, _, _ in rows],
+          dtype=np.int32)
+      # The labels file marks the shard as complete, so it is written last
+      os.replace(images_path + '.tmp', images_path)
+      np.save(labels_path + '.tmp.npy', labels)
+      os.replace(labels_path + '.tmp.npy', labels_path)
+      self._next_shard += 1
+      print(f'Wrote {len(rows)} image(s) to {images_path}')
+    else:
+      os.remove(images_path + '.tmp')
+
+    # Files that failed to decode are listed too, so they are only retried
+    # once they change
+    with open(os.path.join(self._output_dir, _INDEX_NAME), 'a') as f:
+      for row, (_, category, digest, key) in enumerate(rows + failed):
+        exported = row < len(rows)
+        f.write(json.dumps({
+            'hash': digest,
+            'shard': shard if exported else None,
+            'row': row if exported else None,
+            'label': category,
+            'size': list(self._size),
+            'file': list(key),
+        }) + '\n')
+    for row, (_, category, digest, key) in enumerate(rows + failed):
+      exported = row < len(rows)
+      self._exported[digest] = (shard if exported else None,
+                                row if exported else None, category)
+      self._seen_files.add(key)
+    return len(rows)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Export image folders as pre-resized shards for retraining.',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--sources', help='Directories of category subdirectories.',
+      nargs='+', default=list(_SOURCES))
+  parser.add_argument(
+      '--output', help='Directory the shards are written to.',
+      default=_OUTPUT_DIR)
+  parser.add_argument(
+      '--size', help='Width and height the images are resized to.',
+      type=int, nargs=2, default=list(_SIZE))
+  parser.add_argument(
+      '--shardSize', help='Images per shard at most.', type=int,
+      default=_SHARD_SIZE)
+  parser.add_argument(
+      '--workers', help='Threads decoding and resizing; one per core if 0.',
+      type=int, default=0)
+  args = parser.parse_args()
+
+  start_time = time.time()
+  exporter = DatasetExporter(args.output, args.size, args.shardSize,
+                             args.workers)
+  exported = exporter.export(
+      [source for source in args.sources if os.path.isdir(source)])
+  print(f'Exported {exported} new image(s) in {time.time() - start_time:.2f} s')
+
+
+if __name__ == '__main__':
+  main()
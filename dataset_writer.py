@@ -0,0 +1,100 @@
+"""Background writer for the local dataset of classified images."""
+
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import cv2
+
+import metrics
+
+_DATASET_DIR = './classified_images'
+_MANIFEST_NAME = 'manifest.jsonl'
+_NUM_WORKERS = 2
+# Images waiting to be encoded before save() blocks the caller.
+_MAX_PENDING = 8
+
+
+class DatasetWriter:
+  """Saves classified images as `<root>/<category>/<n>.jpg` in the background.
+
+  The next file number of a category is found with a single directory scan
+  the first time the category is used and is a counter after that, so naming
+  a file does not get slower as the dataset grows. JPEG encoding and the disk
+  write run on a small thread pool. At most `max_pending` images may be
+  waiting; `save()` blocks beyond that so a slow SD card applies backpressure
+  instead of growing memory. Every written image is appended to
+  `<root>/manifest.jsonl` with its category, score and timestamp.
+  """
+
+  def __init__(self, root=_DATASET_DIR, num_workers=_NUM_WORKERS,
+               max_pending=_MAX_PENDING):
+    self._root = root
+    self._counters = {}
+    self._lock = threading.Lock()
+    self._manifest_lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(max_pending)
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=num_workers, thread_name_prefix='DatasetWriter')
+    os.makedirs(root, exist_ok=True)
+
+  def _next_name(self, category):
+    with self._lock:
+      if category not in self._counters:
+        path = os.path.join(self._root, category)
+        os.makedirs(path, exist_ok=True)
+        numbers = [int(name[:-4]) for name in os.listdir(path)
+                   if name.endswith('.jpg') and name[:-4].isdigit()]
+        self._counters[category] = max(numbers, default=-1) + 1
+      number = self._counters[category]
+      self._counters[category] += 1
+    return f'{number}.jpg'
+
+  def save(self, image, category, score, timeout=None):
+    """Queues an image to be written to the dataset.
+
+    The writer takes ownership of `image`; the caller must not modify it
+    afterwards.
+
+    Args:
+      image: BGR image as returned by OpenCV.
+      category: Category name, used as the directory name.
+      score: Classification score stored in the manifest.
+      timeout: Seconds to wait for a free slot, or None to wait forever.
+
+    Returns:
+      The path the image will be written to, or None if no slot became free
+      before the timeout.
+    """
+    if not self._slots.acquire(timeout=timeout):
+      print(f'Dataset writer is busy, dropping {category} image')
+      return None
+    name = self._next_name(category)
+    path = os.path.join(self._root, category, name)
+    record = {
+        'file': f'{category}/{name}',
+        'category': category,
+        'score': float(score),
+        'timestamp': time.time(),
+    }
+    self._executor.submit(self._write, path, image, record)
+    return path
+
+  def _write(self, path, image, record):
+    try:
+      with metrics.timed('image_write'):
+        if not cv2.imwrite(path, image):
+          print(f'ERROR: Unable to write {path}')
+          return
+        line = json.dumps(record) + '\n'
+        with self._manifest_lock:
+          with open(os.path.join(self._root, _MANIFEST_NAME), 'a') as f:
+            f.write(line)
+    finally:
+      self._slots.release()
+
+  def close(self):
+    """Waits for queued images to be written."""
+    self._executor.shutdown(wait=True)
@@ -0,0 +1,329 @@
+"""On-device log of every classified item, with hourly rollups.
+
+Each item the bin decides on is written to a SQLite database with its top
+categories, the decision, the saved image and the item's stage timings. A
+challenge marks the item it challenges. The run loops only put events in a
+queue; a writer thread inserts them in batches of one transaction each, so a
+slow SD card never delays a deposit.
+
+Every batch also updates an `hourly` table of item and challenge counts per
+hour, category and decision in the same transaction. Throughput, per-class
+counts and the challenge rate are read from that table, so they take
+milliseconds even on months of items:
+
+  python3 event_store.py --db events.db --days 7
+  python3 event_store.py --db /tmp/load.db --synthetic 500000 --days 90
+
+The database is in WAL mode, so the reports can run while the bin writes.
+Only one process may write to a database, since item ids are assigned by the
+writer before the rows are inserted.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+import metrics
+
+_EVENTS_DB = 'events.db'
+_BATCH_SIZE = 64  # events inserted per transaction at most
+_FLUSH_INTERVAL = 1.0  # seconds an event may wait for more to batch with
+_MAX_PENDING = 1024  # events queued before new ones are dropped
+_HOUR = 3600
+# Rollup label of items without any category; the rollup key can't be NULL
+_NO_CATEGORY = ''
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+  id INTEGER PRIMARY KEY,
+  timestamp REAL NOT NULL,
+  label TEXT,
+  score REAL,
+  decision TEXT NOT NULL,
+  model TEXT,
+  categories TEXT,
+  timings TEXT,
+  image_path TEXT,
+  challenged_at REAL,
+  challenge_path TEXT
+);
+CREATE INDEX IF NOT EXISTS items_timestamp ON items (timestamp);
+CREATE INDEX IF NOT EXISTS items_label ON items (label, timestamp);
+CREATE TABLE IF NOT EXISTS hourly (
+  hour INTEGER NOT NULL,
+  label TEXT NOT NULL,
+  decision TEXT NOT NULL,
+  items INTEGER NOT NULL DEFAULT 0,
+  challenges INTEGER NOT NULL DEFAULT 0,
+  score_sum REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (hour, label, decision)
+) WITHOUT ROWID;
+"""
+
+_INSERT_ITEM = """
+INSERT INTO items (id, timestamp, label, score, decision, model, categories,
+                   timings, image_path)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_COUNT_ITEM = """
+INSERT INTO hourly (hour, label, decision, items, score_sum)
+VALUES (?, ?, ?, 1, ?)
+ON CONFLICT (hour, label, decision)
+DO UPDATE SET items = items + 1, score_sum = score_sum + excluded.score_sum
+"""
+_CHALLENGE_ITEM = """
+UPDATE items SET challenged_at = ?, challenge_path = ?
+WHERE id = ? AND challenged_at IS NULL
+"""
+_COUNT_CHALLENGE = """
+UPDATE hourly SET challenges = challenges + 1
+WHERE (hour, label, decision) =
+      (SELECT CAST(timestamp / 3600 AS INTEGER), IFNULL(label, ''), decision
+       FROM items WHERE id = ?)
+"""
+
+
+def _connect(path):
+  connection = sqlite3.connect(path, check_same_thread=False)
+  connection.execute('PRAGMA journal_mode=WAL')
+  # In WAL mode a power cut can only lose the last transactions, not
+  # corrupt the database
+  connection.execute('PRAGMA synchronous=NORMAL')
+  return connection
+
+
+def _hours(since, until):
+  """Returns the range of hour numbers covering `since` to `until`."""
+  until = time.time() if until is None else until
+  return int(since // _HOUR), int(math.ceil(until / _HOUR))
+
+
+class EventStore:
+  """Writes item events in the background and answers rollup queries."""
+
+  def __init__(self, path=_EVENTS_DB, batch_size=_BATCH_SIZE,
+               flush_interval=_FLUSH_INTERVAL, max_pending=_MAX_PENDING):
+    self._path = path
+    self._batch_size = batch_size
+    self._flush_interval = flush_interval
+    self._events = queue.Queue(max_pending)
+    self._thread = None
+    connection = _connect(path)
+    try:
+      connection.executescript(_SCHEMA)
+      last_id = connection.execute('SELECT MAX(id) FROM items').fetchone()[0]
+    finally:
+      connection.close()
+    self._ids = itertools.count((last_id or 0) + 1)
+    self._ids_lock = threading.Lock()
+    self.written = 0
+
+  def start(self):
+    self._thread = threading.Thread(
+        target=self._write_loop, name='EventStore', daemon=True)
+    self._thread.start()
+
+  def close(self):
+    """Writes the queued events and stops the writer thread."""
+    if self._thread is not None:
+      self._events.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def full(self):
+    """Returns True while new events would be dropped."""
+    return self._events.full()
+
+  def record_item(self, ranking, decision, model=None, image_path=None,
+                  timings=None, timestamp=None):
+    """Queues a classified item.
+
+    Args:
+      ranking: `(category_name, score)` pairs of the item's top categories,
+        best first. If it is empty, e.g. because no category passed the
+        score threshold, the item is logged without a top category.
+      decision: What the bin did, e.g. 'recycle' or 'nonRecyclable'.
+      model: Name of the model that decided.
+      image_path: Path the item's image was saved to, if any.
+      timings: Dict of stage name to seconds spent on this item.
+      timestamp: Time of the decision, now if None.
+
+    Returns:
+      The item's id, to pass to `record_challenge()`.
+    """
+    with self._ids_lock:
+      item_id = next(self._ids)
+    top = [[name, round(float(score), 4)] for name, score in ranking]
+    label, score = top[0] if top else (None, None)
+    self._put(('item', (
+        item_id, timestamp or time.time(), label, score, decision,
+        model, json.dumps(top),
+        json.dumps(timings) if timings else None, image_path)))
+    return item_id
+
+  def record_challenge(self, item_id, image_path=None, timestamp=None):
+    """Queues a challenge of the item `record_item()` returned `item_id` for.
+
+    Only the first challenge of an item is counted.
+    """
+    self._put(('challenge', (timestamp or time.time(), image_path, item_id)))
+
+  def items_per_hour(self, since, until=None):
+    """Returns `(hour start time, items)` of every hour with items, in order."""
+    first, last = _hours(since, until)
+    return [(hour * _HOUR, items) for hour, items in self._query(
+        'SELECT hour, SUM(items) FROM hourly WHERE hour >= ? AND hour < ? '
+        'GROUP BY hour ORDER BY hour', (first, last))]
+
+  def class_counts(self, since, until=None):
+    """Returns a dict of category to `{decision: items}`, whole hours only.
+
+    Items without a top category are counted under None.
+    """
+    first, last = _hours(since, until)
+    counts = {}
+    for label, decision, items in self._query(
+        'SELECT label, decision, SUM(items) FROM hourly '
+        'WHERE hour >= ? AND hour < ? GROUP BY label, decision',
+        (first, last)):
+      label = None if label == _NO_CATEGORY else label
+      counts.setdefault(label, {})[decision] = items
+    return counts
+
+  def challenge_rate(self, since, until=None):
+    """Returns `(challenges, items)` of the items decided in the range."""
+    first, last = _hours(since, until)
+    (challenges, items), = self._query(
+        'SELECT TOTAL(challenges), TOTAL(items) FROM hourly '
+        'WHERE hour >= ? AND hour < ?', (first, last))
+    return int(challenges), int(items)
+
+  def _query(self, sql, parameters):
+    # Readers get their own connection and never wait for the writer
+    connection = sqlite3.connect(self._path)
+    try:
+      return connection.execute(sql, parameters).fetchall()
+    finally:
+      connection.close()
+
+  def _put(self, event):
+    try:
+      self._events.put_nowait(event)
+    except queue.Full:
+      metrics.increment('event_store_dropped')
+
+  def _write_loop(self):
+    connection = _connect(self._path)
+    stopping = False
+    while not stopping:
+      event = self._events.get()
+      batch = []
+      # Collect what arrives within the flush interval into one transaction
+      deadline = time.time() + self._flush_interval
+      while event is not None:
+        batch.append(event)
+        if len(batch) >= self._batch_size:
+          break
+        try:
+          event = self._events.get(timeout=max(0.0, deadline - time.time()))
+        except queue.Empty:
+          break
+      stopping = event is None
+      if batch:
+        self._write(connection, batch)
+    connection.close()
+
+  def _write(self, connection, batch):
+    try:
+      with metrics.timed('event_write'), connection:
+        for kind, row in batch:
+          if kind == 'item':
+            connection.execute(_INSERT_ITEM, row)
+            connection.execute(_COUNT_ITEM, (
+                int(row[1] // _HOUR),
+                _NO_CATEGORY if row[2] is None else row[2], row[4],
+                row[3] or 0.0))
+          elif connection.execute(_CHALLENGE_ITEM, row).rowcount:
+            connection.execute(_COUNT_CHALLENGE, (row[2],))
+    except sqlite3.Error as e:
+      print(f'ERROR: Unable to write {len(batch)} event(s): {e}')
+      metrics.increment('event_store_dropped', len(batch))
+      return
+    self.written += len(batch)
+
+
+def _generate(store, items, days):
+  """Writes `items` random items spread over the last `days` days."""
+  labels = ['Aluminium', 'Glass', 'Plastic', 'nonRecyclable']
+  start_time = time.time() - days * 86400
+  step = days * 86400 / items
+  for i in range(items):
+    scores = sorted((random.random() for _ in labels), reverse=True)
+    names = random.sample(labels, len(labels))
+    ranking = [(name, score / sum(scores))
+               for name, score in zip(names, scores)][:3]
+    decision = ('nonRecyclable' if names[0] == 'nonRecyclable'
+                else 'recycle')
+    item_id = store.record_item(
+        ranking, decision, 'default_model.tflite',
+        timings={'decision': random.uniform(0.5, 2.0)},
+        timestamp=start_time + i * step)
+    if random.random() < 0.05:
+      store.record_challenge(item_id, timestamp=start_time + i * step + 5)
+    while store.full():
+      time.sleep(0.01)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Report throughput, class counts and challenges of a bin.',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--db', help='Event database.', default=_EVENTS_DB)
+  parser.add_argument(
+      '--days', help='Days to report on.', type=float, default=7)
+  parser.add_argument(
+      '--synthetic',
+      help='First write this many random items over the reported days, to '
+      'measure the write and query speed.',
+      type=int, default=0)
+  args = parser.parse_args()
+
+  store = EventStore(args.db)
+  if args.synthetic:
+    store.start()
+    start_time = time.time()
+    _generate(store, args.synthetic, args.days)
+    store.close()
+    print(f'Wrote {args.synthetic} item(s) in '
+          f'{time.time() - start_time:.1f} s')
+
+  since = time.time() - args.days * 86400
+  start_time = time.time()
+  hours = store.items_per_hour(since)
+  counts = store.class_counts(since)
+  challenges, items = store.challenge_rate(since)
+  query_time = time.time() - start_time
+
+  print(f'{items} item(s) in the last {args.days:g} day(s)')
+  if hours:
+    busiest = max(hours, key=lambda hour: hour[1])
+    print(f'  {items / len(hours):.1f} items per active hour, busiest '
+          f'{time.strftime("%Y-%m-%d %H:00", time.localtime(busiest[0]))} '
+          f'with {busiest[1]}')
+  for label, decisions in sorted(counts.items(),
+                                 key=lambda count: count[0] or ''):
+    print(f"  {label or '(none)':<16} " + ', '.join(
+        f'{decision} {count}' for decision, count in sorted(decisions.items())))
+  if items:
+    print(f'  {challenges} challenge(s), {challenges / items:.1%} of items')
+  print(f'Queried in {query_time * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+  main()
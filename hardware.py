@@ -0,0 +1,485 @@
+"""Real and simulated backends for the bin's GPIO, servos, LEDs and camera.
+
+The bin scripts create their devices through a backend instead of importing
+`RPi.GPIO`, `gpiozero` and `rpi_ws281x` directly:
+
+  backend = hardware.load(simulate)
+  servo = backend.Servo(LOCK_PIN, min_pulse_width=..., max_pulse_width=...)
+  backend.GPIO.setup(PIR, backend.GPIO.IN)
+
+`RealHardware` only imports the Raspberry Pi libraries when it is created.
+`SimulatedHardware` implements the parts of their interfaces the scripts use
+and models the timing that matters for a deposit: servo travel time, the
+NeoPixel write time and GPIO edge callbacks on their own thread. Everything
+the devices do is recorded in `SimulatedHardware.log` so a test harness can
+measure when each step of a deposit happened.
+"""
+
+import collections
+import functools
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Time a servo takes to sweep its whole range, from value -1 to 1.
+_SERVO_TRAVEL_TIME = 0.6  # seconds
+# WS281x LEDs take 24 bits per pixel followed by a latch pause.
+_LED_BITS_PER_PIXEL = 24
+_LED_LATCH_TIME = 50e-6  # seconds
+_CAMERA_FPS = 30
+_BACKGROUND_LEVEL = 128  # grey level of the empty simulated scene
+
+HardwareEvent = collections.namedtuple(
+    'HardwareEvent', ['timestamp', 'device', 'pin', 'value'])
+ServoMove = collections.namedtuple(
+    'ServoMove', ['start_time', 'arrival_time', 'start', 'target'])
+
+_ANY = object()
+
+
+def load(simulate=False):
+  """Returns the backend for the real devices, or a simulated one."""
+  if simulate:
+    return SimulatedHardware(simulate_camera=False)
+  return RealHardware()
+
+
+class RealHardware:
+  """The Raspberry Pi libraries and the OpenCV camera."""
+
+  def __init__(self):
+    # Imported here so the scripts can be loaded on machines without them
+    import RPi.GPIO as GPIO  # pylint: disable=import-outside-toplevel
+    from gpiozero import AngularServo, Servo  # pylint: disable=import-outside-toplevel
+    from rpi_ws281x import Color, PixelStrip  # pylint: disable=import-outside-toplevel
+    self.GPIO = GPIO
+    self.Servo = Servo
+    self.AngularServo = AngularServo
+    self.PixelStrip = PixelStrip
+    self.Color = Color
+    self.VideoCapture = cv2.VideoCapture
+
+
+class EventLog:
+  """Thread-safe record of everything the simulated devices did."""
+
+  def __init__(self):
+    self._events = []
+    self._condition = threading.Condition()
+
+  def record(self, device, pin, value):
+    event = HardwareEvent(time.time(), device, pin, value)
+    with self._condition:
+      self._events.append(event)
+      self._condition.notify_all()
+    return event
+
+  def events(self, device=None, pin=None, since=0.0):
+    """Returns the recorded events matching the filters, oldest first."""
+    with self._condition:
+      return [e for e in self._events if self._matches(
+          e, device, pin, _ANY, since)]
+
+  def wait_for(self, device, pin=None, value=_ANY, since=0.0, timeout=None):
+    """Blocks until a matching event is recorded at or after `since`.
+
+    Returns:
+      The first matching `HardwareEvent`, or None if the timeout expired.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    checked = 0
+    with self._condition:
+      while True:
+        for event in self._events[checked:]:
+          if self._matches(event, device, pin, value, since):
+            return event
+        checked = len(self._events)
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return None
+        self._condition.wait(remaining)
+
+  @staticmethod
+  def _matches(event, device, pin, value, since):
+    return (event.timestamp >= since and
+            (device is None or event.device == device) and
+            (pin is None or event.pin == pin) and
+            (value is _ANY or event.value == value))
+
+
+class SimulatedGPIO:
+  """Stand-in for the `RPi.GPIO` module.
+
+  Inputs are driven with `set_input()` or `pulse()`. Edge callbacks run one at
+  a time on a single thread, like RPi.GPIO's callback thread, so a slow
+  callback delays the ones after it.
+  """
+
+  BCM = 11
+  BOARD = 10
+  OUT = 0
+  IN = 1
+  LOW = 0
+  HIGH = 1
+  PUD_OFF = 20
+  PUD_DOWN = 21
+  PUD_UP = 22
+  RISING = 31
+  FALLING = 32
+  BOTH = 33
+
+  def __init__(self, log):
+    self._log = log
+    self._lock = threading.Lock()
+    self._levels = {}
+    self._callbacks = collections.defaultdict(list)
+    self._callback_queue = queue.Queue()
+    self._callback_thread = threading.Thread(
+        target=self._run_callbacks, name='SimulatedGPIOCallbacks', daemon=True)
+    self._callback_thread.start()
+
+  def setmode(self, mode):
+    pass
+
+  def setwarnings(self, enabled):
+    pass
+
+  def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+    with self._lock:
+      if direction == self.OUT:
+        self._levels[channel] = initial or self.LOW
+      elif channel not in self._levels:
+        self._levels[channel] = int(pull_up_down == self.PUD_UP)
+
+  def output(self, channel, value):
+    with self._lock:
+      self._levels[channel] = int(bool(value))
+    self._log.record('gpio', channel, int(bool(value)))
+
+  def input(self, channel):
+    with self._lock:
+      return self._levels.get(channel, self.LOW)
+
+  def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+    with self._lock:
+      self._callbacks[channel].append((edge, callback))
+
+  def add_event_callback(self, channel, callback):
+    """Adds a callback for the edge already detected on `channel`."""
+    with self._lock:
+      if not self._callbacks.get(channel):
+        raise RuntimeError('Add event detection using add_event_detect first '
+                           'before adding a callback')
+      edge = self._callbacks[channel][0][0]
+      self._callbacks[channel].append((edge, callback))
+
+  def remove_event_detect(self, channel):
+    with self._lock:
+      self._callbacks.pop(channel, None)
+
+  def cleanup(self, channel=None):
+    with self._lock:
+      if channel is None:
+        self._levels.clear()
+        self._callbacks.clear()
+      else:
+        self._levels.pop(channel, None)
+        self._callbacks.pop(channel, None)
+
+  def set_input(self, channel, value):
+    """Drives an input pin, firing the callbacks of the resulting edge."""
+    value = int(bool(value))
+    with self._lock:
+      previous = self._levels.get(channel, self.LOW)
+      self._levels[channel] = value
+      callbacks = list(self._callbacks.get(channel, ()))
+    if value == previous:
+      return
+    self._log.record('gpio', channel, value)
+    edge = self.RISING if value else self.FALLING
+    for detect, callback in callbacks:
+      if callback is not None and detect in (edge, self.BOTH):
+        self._callback_queue.put((callback, channel))
+
+  def pulse(self, channel, duration, value=HIGH):
+    """Holds an input at `value` for `duration` seconds, then releases it."""
+    self.set_input(channel, value)
+    timer = threading.Timer(duration, self.set_input, (channel, not value))
+    timer.daemon = True
+    timer.start()
+
+  def _run_callbacks(self):
+    while True:
+      callback, channel = self._callback_queue.get()
+      callback(channel)
+
+
+class SimulatedServo:
+  """Stand-in for `gpiozero.Servo` that models travel time.
+
+  A new position takes `travel_time` seconds per full sweep to reach. Setting
+  `value` to None detaches the servo where it is; detaching before it
+  arrived counts as an interrupted move, which on the bin means a motion
+  step is shorter than the servo needs.
+  """
+
+  def __init__(self, pin, initial_value=0.0, min_pulse_width=1 / 1000,
+               max_pulse_width=2 / 1000, frame_width=20 / 1000,
+               pin_factory=None, *, hardware, travel_time=_SERVO_TRAVEL_TIME):
+    self.pin = pin
+    self._log = hardware.log
+    self._travel_time = travel_time
+    self._lock = threading.Lock()
+    self._value = initial_value
+    self._move = ServoMove(time.time(), time.time(), initial_value,
+                           initial_value)
+    self.moves = []
+    self.interrupted_moves = 0
+    hardware.servos.append(self)
+
+  @property
+  def value(self):
+    return self._value
+
+  @value.setter
+  def value(self, value):
+    now = time.time()
+    with self._lock:
+      position = self._position(now)
+      if value is None:
+        if self._value is not None and now < self._move.arrival_time:
+          self.interrupted_moves += 1
+        self._move = ServoMove(now, now, position, position)
+      else:
+        value = max(-1.0, min(1.0, float(value)))
+        arrival_time = now + abs(value - position) / 2 * self._travel_time
+        self._move = ServoMove(now, arrival_time, position, value)
+        self.moves.append(self._move)
+      self._value = value
+    self._log.record('servo', self.pin, self._logged_value())
+
+  @property
+  def position(self):
+    """Where the horn physically is now, from -1 to 1."""
+    with self._lock:
+      return self._position(time.time())
+
+  @property
+  def is_active(self):
+    return self._value is not None
+
+  def min(self):
+    self.value = -1
+
+  def mid(self):
+    self.value = 0
+
+  def max(self):
+    self.value = 1
+
+  def detach(self):
+    self.value = None
+
+  def close(self):
+    self.detach()
+
+  def _position(self, now):
+    move = self._move
+    if now >= move.arrival_time or move.arrival_time == move.start_time:
+      return move.target
+    progress = (now - move.start_time) / (move.arrival_time - move.start_time)
+    return move.start + (move.target - move.start) * progress
+
+  def _logged_value(self):
+    return self._value
+
+
+class SimulatedAngularServo(SimulatedServo):
+  """Stand-in for `gpiozero.AngularServo`."""
+
+  def __init__(self, pin, initial_angle=0.0, min_angle=-90, max_angle=90,
+               min_pulse_width=1 / 1000, max_pulse_width=2 / 1000,
+               frame_width=20 / 1000, pin_factory=None, *, hardware,
+               travel_time=_SERVO_TRAVEL_TIME):
+    self._min_angle = min_angle
+    self._angle_range = max_angle - min_angle
+    super().__init__(pin, self._to_value(initial_angle), min_pulse_width,
+                     max_pulse_width, frame_width, pin_factory,
+                     hardware=hardware, travel_time=travel_time)
+
+  @property
+  def angle(self):
+    if self.value is None:
+      return None
+    return (self.value + 1) / 2 * self._angle_range + self._min_angle
+
+  @angle.setter
+  def angle(self, angle):
+    self.value = self._to_value(angle)
+
+  def _to_value(self, angle):
+    if angle is None:
+      return None
+    return (angle - self._min_angle) / self._angle_range * 2 - 1
+
+  def _logged_value(self):
+    # Logged in degrees, the unit the scripts command the servo in
+    angle = self.angle
+    return None if angle is None else round(angle, 3)
+
+
+def Color(red, green, blue, white=0):  # pylint: disable=invalid-name
+  """Packs a colour like `rpi_ws281x.Color`."""
+  return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class SimulatedPixelStrip:
+  """Stand-in for `rpi_ws281x.PixelStrip`.
+
+  `show()` takes as long as sending the strip's data at `freq_hz` and counts
+  the writes in `shows`.
+  """
+
+  def __init__(self, num, pin, freq_hz=800000, dma=10, invert=False,
+               brightness=255, channel=0, strip_type=None, gamma=None, *,
+               hardware):
+    self.pin = pin
+    self._log = hardware.log
+    self._pixels = [0] * num
+    self._brightness = brightness
+    self._write_time = num * _LED_BITS_PER_PIXEL / freq_hz + _LED_LATCH_TIME
+    self.shows = 0
+    hardware.strips.append(self)
+
+  def begin(self):
+    pass
+
+  def numPixels(self):  # pylint: disable=invalid-name
+    return len(self._pixels)
+
+  def setPixelColor(self, n, color):  # pylint: disable=invalid-name
+    self._pixels[n] = color
+
+  def setPixelColorRGB(self, n, red, green, blue, white=0):  # pylint: disable=invalid-name
+    self._pixels[n] = Color(red, green, blue, white)
+
+  def getPixelColor(self, n):  # pylint: disable=invalid-name
+    return self._pixels[n]
+
+  def getPixels(self):  # pylint: disable=invalid-name
+    return list(self._pixels)
+
+  def setBrightness(self, brightness):  # pylint: disable=invalid-name
+    self._brightness = brightness
+
+  def getBrightness(self):  # pylint: disable=invalid-name
+    return self._brightness
+
+  def show(self):
+    time.sleep(self._write_time)
+    self.shows += 1
+    self._log.record('led', self.pin, tuple(self._pixels))
+
+
+class Scene:
+  """What the simulated camera sees: an empty chute or an item in it."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._image = None
+
+  def show(self, image):
+    """Puts a BGR image of an item in front of the camera."""
+    with self._lock:
+      self._image = image
+
+  def clear(self):
+    with self._lock:
+      self._image = None
+
+  def render(self, width, height):
+    with self._lock:
+      image = self._image
+    if image is None:
+      return np.full((height, width, 3), _BACKGROUND_LEVEL, dtype=np.uint8)
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+class SimulatedCamera:
+  """Stand-in for `cv2.VideoCapture` that films a `Scene` at a fixed rate."""
+
+  def __init__(self, camera_id=0, *, scene, fps=_CAMERA_FPS):
+    self._scene = scene
+    self._interval = 1.0 / fps
+    self._width = 640
+    self._height = 480
+    self._next_frame_time = time.time()
+    self._open = True
+
+  def isOpened(self):  # pylint: disable=invalid-name
+    return self._open
+
+  def set(self, prop, value):
+    if prop == cv2.CAP_PROP_FRAME_WIDTH:
+      self._width = int(value)
+    elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+      self._height = int(value)
+    return True
+
+  def get(self, prop):
+    if prop == cv2.CAP_PROP_FRAME_WIDTH:
+      return self._width
+    if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+      return self._height
+    if prop == cv2.CAP_PROP_FPS:
+      return 1.0 / self._interval
+    return 0.0
+
+  def grab(self):
+    if not self._open:
+      return False
+    # Frames come at the camera's rate, however fast they are read
+    now = time.time()
+    if self._next_frame_time > now:
+      time.sleep(self._next_frame_time - now)
+    self._next_frame_time = max(now, self._next_frame_time) + self._interval
+    return True
+
+  def retrieve(self):
+    if not self._open:
+      return False, None
+    return True, self._scene.render(self._width, self._height)
+
+  def read(self):
+    if not self.grab():
+      return False, None
+    return self.retrieve()
+
+  def release(self):
+    self._open = False
+
+
+class SimulatedHardware:
+  """Simulated devices sharing one `EventLog`.
+
+  Args:
+    simulate_camera: Film `scene` instead of opening a real camera.
+  """
+
+  def __init__(self, simulate_camera=True):
+    self.log = EventLog()
+    self.servos = []
+    self.strips = []
+    self.scene = Scene()
+    self.GPIO = SimulatedGPIO(self.log)
+    self.Servo = functools.partial(SimulatedServo, hardware=self)
+    self.AngularServo = functools.partial(SimulatedAngularServo, hardware=self)
+    self.PixelStrip = functools.partial(SimulatedPixelStrip, hardware=self)
+    self.Color = Color
+    if simulate_camera:
+      self.VideoCapture = functools.partial(SimulatedCamera, scene=self.scene)
+    else:
+      self.VideoCapture = cv2.VideoCapture
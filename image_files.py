@@ -0,0 +1,14 @@
+"""Finding image files, without the TFLite imports of `classification`."""
+
+import os
+
+_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def find_images(root):
+  """Yields the image files under `root` in a stable order."""
+  for directory, subdirectories, files in os.walk(root):
+    subdirectories.sort()
+    for name in sorted(files):
+      if name.lower().endswith(_IMAGE_EXTENSIONS):
+        yield os.path.join(directory, name)
@@ -0,0 +1,548 @@
+"""Shared inference service for every process on the bin.
+
+One server process loads each model once and runs all classifications on a
+single interpreter per model, so extra consumers such as a maintenance tool
+or a second camera don't load their own copies and fight over the four
+cores:
+
+  python3 inference_service.py --socket /tmp/recycling_bin_inference.sock
+  python3 run_best_integ.py --inferenceSocket /tmp/recycling_bin_inference.sock
+  python3 inference_service.py --stats   # per-client latencies
+
+Clients talk to the server over a Unix domain socket with one JSON message
+per line. Frames are not sent over the socket: the client resizes each frame
+straight into a shared memory block at the model's input size and only
+sends the block's name.
+
+The server counts the clients of every model and unloads a model once no
+client holds it any more, e.g. after every client swapped to a retrained
+file. A client releases a model, and unlinks its shared memory block, when
+the model's classifier and preprocessor are garbage collected or the client
+closes.
+
+Requests carry a deadline. The server serves the earliest deadline first and
+coalesces requests: it waits up to `group_window` seconds for requests of
+other clients for the same model and then classifies the group one request
+after another on that model's interpreter. This is not batching; the TFLite
+task library has no batch dimension, so every request is still its own
+inference. Grouping only saves switching between interpreters and waking the
+inference thread per request. Requests whose deadline passed while queued are
+answered with an error instead of being classified.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+import preprocess
+
+_SOCKET_PATH = '/tmp/recycling_bin_inference.sock'
+_NUM_THREADS = 4
+_MAX_GROUP = 4  # requests classified back to back at most
+_GROUP_WINDOW = 0.005  # seconds a group waits for more requests
+_REQUEST_TIMEOUT = 10  # seconds from sending a request to its deadline
+_LOAD_TIMEOUT = 120  # seconds the server may take to load a model
+
+# Stand-ins for the tflite_support result types the run() loops read
+Category = collections.namedtuple(
+    'Category', ['index', 'score', 'display_name', 'category_name'])
+Classifications = collections.namedtuple('Classifications', ['categories'])
+ClassificationResult = collections.namedtuple(
+    'ClassificationResult', ['classifications'])
+SharedFrame = collections.namedtuple('SharedFrame', ['segment', 'shape'])
+
+_Request = collections.namedtuple(
+    '_Request',
+    ['deadline', 'arrival', 'connection', 'id', 'model', 'segment', 'shape'])
+
+
+def _attach(name):
+  """Attaches to a shared memory block created by another process."""
+  segment = shared_memory.SharedMemory(name=name)
+  # The creating process owns the block. Without this, Python before 3.13
+  # would unlink it when this process exits.
+  resource_tracker.unregister(
+      segment._name, 'shared_memory')  # pylint: disable=protected-access
+  return segment
+
+
+class _Connection:
+  """A connected client on the server side."""
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.client = 'unknown'
+    # Model key -> loads this client has not released yet
+    self.models = collections.Counter()
+    self._write_lock = threading.Lock()
+    self._segments = {}
+
+  def send(self, message):
+    data = (json.dumps(message) + '\n').encode()
+    with self._write_lock:
+      try:
+        self.sock.sendall(data)
+      except OSError:
+        pass  # The client went away; its reader thread cleans up
+
+  def segment(self, name):
+    if name not in self._segments:
+      self._segments[name] = _attach(name)
+    return self._segments[name]
+
+  def detach(self, name):
+    segment = self._segments.pop(name, None)
+    if segment is not None:
+      segment.close()
+
+  def close(self):
+    for segment in self._segments.values():
+      segment.close()
+    self._segments.clear()
+    self.sock.close()
+
+
+class InferenceServer:
+  """Loads models once and classifies frames for all connected clients."""
+
+  def __init__(self, socket_path=_SOCKET_PATH, num_threads=_NUM_THREADS,
+               max_group=_MAX_GROUP, group_window=_GROUP_WINDOW):
+    self._socket_path = socket_path
+    self._num_threads = num_threads
+    self._max_group = max_group
+    self._group_window = group_window
+    self._models = {}
+    # Model key -> loads of all clients not released yet
+    self._references = collections.Counter()
+    self._models_lock = threading.Lock()
+    self._queue = []
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+    # Recent duration of one inference per model, to start groups in time
+    self._inference_times = {}
+    self._running = False
+    self._listener = None
+    self._threads = []
+    self._connections = set()
+
+  def start(self):
+    if os.path.exists(self._socket_path):
+      os.remove(self._socket_path)  # Left over from a server that crashed
+    self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._listener.bind(self._socket_path)
+    self._listener.listen()
+    self._running = True
+    for target, name in ((self._accept, 'InferenceAccept'),
+                         (self._schedule, 'InferenceScheduler')):
+      thread = threading.Thread(target=target, name=name, daemon=True)
+      thread.start()
+      self._threads.append(thread)
+    print(f'Inference service listening on {self._socket_path}')
+
+  def stop(self):
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    # Closing alone would not wake the blocked accept() and reads
+    self._listener.shutdown(socket.SHUT_RDWR)
+    self._listener.close()
+    for connection in list(self._connections):
+      connection.sock.shutdown(socket.SHUT_RDWR)
+    for thread in self._threads:
+      thread.join()
+    if os.path.exists(self._socket_path):
+      os.remove(self._socket_path)
+
+  def _accept(self):
+    while self._running:
+      try:
+        sock, _ = self._listener.accept()
+      except OSError:
+        return  # The listener was closed by stop()
+      connection = _Connection(sock)
+      self._connections.add(connection)
+      threading.Thread(target=self._serve, args=(connection,),
+                       name='InferenceClient', daemon=True).start()
+
+  def _serve(self, connection):
+    try:
+      with connection.sock.makefile('rb') as lines:
+        for line in lines:
+          message = json.loads(line)
+          try:
+            self._handle(connection, message)
+          except Exception as e:  # pylint: disable=broad-except
+            connection.send({'id': message.get('id'), 'error': str(e)})
+    except (OSError, ValueError) as e:
+      print(f'Dropping client {connection.client}: {e}')
+    finally:
+      self._connections.discard(connection)
+      for key, count in list(connection.models.items()):
+        self._release(connection, key, count)
+      connection.close()
+
+  def _handle(self, connection, message):
+    op = message['op']
+    if op == 'hello':
+      connection.client = message['client']
+    elif op == 'load':
+      key, size = self._load(connection, message['model'],
+                             message['max_results'], message['score_threshold'])
+      connection.send({'id': message['id'], 'model': key, 'size': size})
+    elif op == 'release':
+      # Not answered; the client sends it while dropping the model
+      self._release(connection, message['model'])
+      connection.detach(message['segment'])
+    elif op == 'classify':
+      if message['model'] not in self._models:
+        raise KeyError(f"{message['model']} is not loaded")
+      segment = connection.segment(message['segment'])
+      shape = tuple(int(n) for n in message['shape'])
+      # A bad request is answered here, so it never reaches the scheduler
+      if (len(shape) != 3 or shape[2] != 3 or min(shape) <= 0 or
+          int(np.prod(shape)) > segment.size):
+        raise ValueError(f'Shape {list(shape)} does not fit segment '
+                         f"{message['segment']} of {segment.size} bytes")
+      request = _Request(message['deadline'], time.time(), connection,
+                         message['id'], message['model'], segment, shape)
+      with self._condition:
+        heapq.heappush(self._queue,
+                       (request.deadline, next(self._sequence), request))
+        self._condition.notify_all()
+    elif op == 'stats':
+      connection.send({'id': message['id'],
+                       'stats': metrics.registry.snapshot()})
+    else:
+      raise ValueError(f'Unknown operation {op}')
+
+  def _load(self, connection, model, max_results, score_threshold):
+    """Loads a model unless a client already did; returns its key and size."""
+    # pylint: disable=import-outside-toplevel
+    import startup
+    key = f'{model}@{os.path.getmtime(model)}:{max_results}:{score_threshold}'
+    with self._models_lock:
+      if key not in self._models:
+        start_time = time.time()
+        self._models[key] = startup.load_model(
+            startup.StartupTimer(), model, self._num_threads, max_results,
+            score_threshold)
+        print(f'Loaded {key} in {time.time() - start_time:.2f} s')
+      self._references[key] += 1
+      connection.models[key] += 1
+      _, preprocessor = self._models[key]
+    return key, preprocessor.size
+
+  def _release(self, connection, key, count=1):
+    """Drops loads of `connection`; unloads the model once nobody has it."""
+    with self._models_lock:
+      count = min(count, connection.models[key])
+      if count <= 0:
+        return
+      connection.models[key] -= count
+      if connection.models[key] <= 0:
+        del connection.models[key]
+      self._references[key] -= count
+      if self._references[key] > 0:
+        return
+      del self._references[key]
+      # Requests already taken by the scheduler keep the classifier alive
+      self._models.pop(key, None)
+      self._inference_times.pop(key, None)
+    metrics.increment('model_unloads')
+    print(f'Unloaded {key}')
+
+  def _next_group(self):
+    """Waits for requests and returns the next group, or None to stop."""
+    with self._condition:
+      while True:
+        self._condition.wait_for(lambda: self._queue or not self._running)
+        if not self._running:
+          return None
+        # Wait for requests of other clients, but leave time for the group
+        # to run before the earliest deadline
+        earliest = self._queue[0][2]
+        arrival = min(request.arrival for _, _, request in self._queue)
+        estimate = self._inference_times.get(earliest.model, 0.0)
+        close_time = min(arrival + self._group_window,
+                         earliest.deadline - estimate * self._max_group)
+        # Nobody else can add to the group once every client has a request
+        # queued, e.g. when the bin is the only client
+        waiting = min(self._max_group, len(self._connections))
+        if len(self._queue) < waiting and time.time() < close_time:
+          self._condition.wait(close_time - time.time())
+          continue
+        # The earliest request picks the model; requests for other models
+        # wait for the next group
+        model = self._queue[0][2].model
+        group, rest = [], []
+        while self._queue:
+          entry = heapq.heappop(self._queue)
+          if entry[2].model == model and len(group) < self._max_group:
+            group.append(entry[2])
+          else:
+            rest.append(entry)
+        for entry in rest:
+          heapq.heappush(self._queue, entry)
+        return group
+
+  def _schedule(self):
+    while True:
+      group = self._next_group()
+      if group is None:
+        return
+      metrics.increment('request_groups')
+      metrics.increment('grouped_requests', len(group))
+      loaded = self._models.get(group[0].model)
+      # One inference per request; the interpreter has no batch dimension
+      for request in group:
+        # A failing request is answered with its error; the scheduler keeps
+        # serving the other clients
+        try:
+          if loaded is None:
+            # Every client released the model while the request was queued
+            raise KeyError(f'{request.model} is not loaded')
+          self._classify(loaded[0], request)
+        except Exception as e:  # pylint: disable=broad-except
+          metrics.increment(f'{request.connection.client}/errors')
+          request.connection.send({'id': request.id, 'error': str(e)})
+
+  def _classify(self, classifier, request):
+    # pylint: disable=import-outside-toplevel
+    from tflite_support.task import vision
+    client = request.connection.client
+    start_time = time.time()
+    metrics.observe(f'{client}/queue', start_time - request.arrival)
+    if start_time > request.deadline:
+      metrics.increment(f'{client}/expired')
+      request.connection.send({'id': request.id, 'error': 'deadline expired'})
+      return
+    # The frame is read straight from the client's shared memory
+    image = np.ndarray(request.shape, dtype=np.uint8,
+                       buffer=request.segment.buf)
+    result = classifier.classify(vision.TensorImage.create_from_array(image))
+    inference_time = time.time() - start_time
+    previous = self._inference_times.get(request.model, inference_time)
+    self._inference_times[request.model] = 0.8 * previous + 0.2 * inference_time
+    metrics.observe(f'{client}/inference', inference_time)
+    metrics.observe(f'{client}/total', time.time() - request.arrival)
+    categories = [[c.index, c.score, c.display_name, c.category_name]
+                  for c in result.classifications[0].categories]
+    request.connection.send({'id': request.id, 'categories': categories})
+
+
+class _RemotePreprocessor:
+  """Resizes frames into the shared memory block of one model."""
+
+  def __init__(self, size):
+    width, height = size
+    self.size = size
+    self._preprocessor = preprocess.Preprocessor(None, size=size)
+    self._shape = (height, width, 3)
+    self.segment = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(self._shape)))
+    self._frame = np.ndarray(self._shape, dtype=np.uint8,
+                             buffer=self.segment.buf)
+
+  def __call__(self, image):
+    self._preprocessor.convert(image, out=self._frame)
+    return SharedFrame(self.segment.name, self._shape)
+
+
+class _RemoteClassifier:
+  """Classifies the frames of a `_RemotePreprocessor` in the server."""
+
+  def __init__(self, client, model, preprocessor):
+    self._client = client
+    self._model = model
+    # The model is released once neither is referenced any more
+    self._preprocessor = preprocessor
+
+  def classify(self, frame):
+    reply = self._client.call({
+        'op': 'classify',
+        'model': self._model,
+        'segment': frame.segment,
+        'shape': frame.shape,
+        'deadline': time.time() + _REQUEST_TIMEOUT,
+    }, timeout=_REQUEST_TIMEOUT)
+    categories = [Category(*category) for category in reply['categories']]
+    return ClassificationResult([Classifications(categories)])
+
+
+class InferenceClient:
+  """Connection of one process to the inference service.
+
+  Pass `load_model` to `model_manager.ModelManager` to have its models
+  loaded and run by the server.
+  """
+
+  def __init__(self, socket_path=_SOCKET_PATH, name=None):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.connect(socket_path)
+    self._write_lock = threading.Lock()
+    self._pending = {}
+    self._pending_lock = threading.Lock()
+    self._ids = itertools.count()
+    self._closed = False
+    # Models released by garbage collection, told to the server on the next
+    # call. Sending from a finalizer could deadlock on the write lock.
+    self._released = collections.deque()
+    self._finalizers = []
+    self._reader = threading.Thread(
+        target=self._read, name='InferenceReplies', daemon=True)
+    self._reader.start()
+    self._send({'op': 'hello', 'client': name or f'pid{os.getpid()}'})
+
+  def call(self, message, timeout=None):
+    """Sends a request and returns the server's reply.
+
+    Raises:
+      RuntimeError: If the server answered with an error.
+      TimeoutError: If no reply arrived within `timeout` seconds.
+    """
+    while self._released:
+      model, segment = self._released.popleft()
+      self._send({'op': 'release', 'model': model, 'segment': segment})
+    request_id = next(self._ids)
+    future = concurrent.futures.Future()
+    with self._pending_lock:
+      self._pending[request_id] = future
+    self._send(dict(message, id=request_id))
+    try:
+      reply = future.result(timeout)
+    except concurrent.futures.TimeoutError:
+      raise TimeoutError(f"No reply to {message['op']} after {timeout} s")
+    finally:
+      with self._pending_lock:
+        self._pending.pop(request_id, None)
+    if 'error' in reply:
+      raise RuntimeError(reply['error'])
+    return reply
+
+  def load_model(self, timer, model, num_threads, max_results,
+                 score_threshold):
+    """Loads a model in the server, like `startup.load_model()`.
+
+    `num_threads` is ignored; the server's interpreters use its own setting.
+
+    Returns:
+      A `(classifier, preprocessor)` tuple whose classifications run in the
+      server. The server keeps the model loaded, and the preprocessor's shared
+      memory exists, until both are garbage collected or the client closes.
+    """
+    del num_threads
+    start_time = time.time()
+    reply = self.call({
+        'op': 'load',
+        'model': os.path.abspath(model),
+        'max_results': max_results,
+        'score_threshold': score_threshold,
+    }, timeout=_LOAD_TIMEOUT)
+    timer.record('model load', start_time)
+    preprocessor = _RemotePreprocessor(tuple(reply['size']))
+    self._finalizers = [f for f in self._finalizers if f.alive]
+    self._finalizers.append(weakref.finalize(
+        preprocessor, self._release, reply['model'], preprocessor.segment))
+    return _RemoteClassifier(self, reply['model'], preprocessor), preprocessor
+
+  def stats(self):
+    """Returns the server's per-client latency statistics."""
+    return self.call({'op': 'stats'}, timeout=_REQUEST_TIMEOUT)['stats']
+
+  def close(self):
+    # The server releases the models of a closed connection by itself
+    self._closed = True
+    for finalizer in self._finalizers:
+      detached = finalizer.detach()
+      if detached is not None:
+        # The model is still referenced, so only its name is removed; the
+        # memory goes away with the preprocessor
+        _, _, (_, segment), _ = detached
+        segment.unlink()
+    self._finalizers = []
+    # Wakes the reader thread, which closing alone would leave blocked
+    self._sock.shutdown(socket.SHUT_RDWR)
+    self._reader.join()
+    self._sock.close()
+
+  def _release(self, model, segment):
+    segment.close()
+    segment.unlink()
+    if not self._closed:
+      self._released.append((model, segment.name))
+
+  def _send(self, message):
+    data = (json.dumps(message) + '\n').encode()
+    with self._write_lock:
+      self._sock.sendall(data)
+
+  def _read(self):
+    try:
+      with self._sock.makefile('rb') as lines:
+        for line in lines:
+          reply = json.loads(line)
+          with self._pending_lock:
+            future = self._pending.get(reply.get('id'))
+          if future is not None:
+            future.set_result(reply)
+    except (OSError, ValueError):
+      pass
+    # Fail the requests still waiting, the server is gone
+    with self._pending_lock:
+      for future in self._pending.values():
+        future.set_exception(ConnectionError('Inference service disconnected'))
+      self._pending.clear()
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Serve the classification models to the bin processes.',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--socket', help='Unix domain socket to listen on.',
+      default=_SOCKET_PATH)
+  parser.add_argument(
+      '--numThreads', help='CPU threads of every interpreter.', type=int,
+      default=_NUM_THREADS)
+  parser.add_argument(
+      '--maxGroup', help='Requests classified back to back at most.',
+      type=int, default=_MAX_GROUP)
+  parser.add_argument(
+      '--groupWindow', help='Seconds a group waits for more requests.',
+      type=float, default=_GROUP_WINDOW)
+  parser.add_argument(
+      '--stats', help='Print the statistics of a running server and exit.',
+      action='store_true', default=False)
+  args = parser.parse_args()
+
+  if args.stats:
+    client = InferenceClient(args.socket, 'stats')
+    print(json.dumps(client.stats(), indent=2))
+    client.close()
+    return
+
+  server = InferenceServer(args.socket, args.numThreads, args.maxGroup,
+                           args.groupWindow)
+  server.start()
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+"""Frame buffer for the bin's NeoPixel strip, sent to the LEDs by one thread.
+
+The strip is split into named segments, e.g. the camera light and the
+status/capacity stick. Callers only change the frame buffer, which is cheap
+and never blocks on the strip. A render thread sends the buffer with
+`show()` when a pixel actually changed, at most `fps` times per second, and
+steps the animations of animated segments.
+"""
+
+import math
+import threading
+import time
+
+_FPS = 30  # frames sent per second at most
+_FLUSH_TIMEOUT = 1  # seconds flush() waits for the render thread
+
+
+def _unpack(color):
+  return ((color >> 24) & 0xff, (color >> 16) & 0xff, (color >> 8) & 0xff,
+          color & 0xff)
+
+
+def scale(color, factor):
+  """Returns a packed `Color()` with every channel multiplied by `factor`."""
+  white, red, green, blue = (int(round(c * factor)) for c in _unpack(color))
+  return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+def bar(fraction, color, length, background=0):
+  """Returns the pixels of a bar filled to `fraction` of `length` pixels."""
+  lit = int(round(max(0.0, min(1.0, fraction)) * length))
+  return [color] * lit + [background] * (length - lit)
+
+
+def pulse(color, period=1.0, minimum=0.1):
+  """Returns an animation that fades `color` in and out every `period` s."""
+
+  def animation(elapsed):
+    level = 0.5 - 0.5 * math.cos(2 * math.pi * elapsed / period)
+    return scale(color, minimum + (1 - minimum) * level)
+
+  return animation
+
+
+class LedCompositor:
+  """Keeps the strip's pixels and shows them from a render thread.
+
+  Args:
+    strip: `rpi_ws281x.PixelStrip`, or a simulated one, already begun.
+    segments: Dict of segment name to the `range` of pixels it covers.
+    fps: Maximum number of `show()` calls per second.
+  """
+
+  def __init__(self, strip, segments, fps=_FPS):
+    self._strip = strip
+    self._segments = dict(segments)
+    self._interval = 1.0 / fps
+    self._condition = threading.Condition()
+    self._pixels = [0] * strip.numPixels()
+    self._shown = None
+    self._animations = {}
+    self._version = 0
+    self._shown_version = -1
+    self._running = False
+    self._thread = None
+    self.shows = 0
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(
+        target=self._render_loop, name='LedCompositor', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    """Shows the latest pixels and stops the render thread."""
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def fill(self, segment, color):
+    """Sets every pixel of `segment` to `color`, stopping its animation."""
+    self.set_pixels(segment, [color] * len(self._segments[segment]))
+
+  def set_pixels(self, segment, colors):
+    """Sets the pixels of `segment` in order, stopping its animation."""
+    with self._condition:
+      self._animations.pop(segment, None)
+      self._update(segment, colors)
+
+  def animate(self, segment, animation):
+    """Runs `animation` on `segment` until it is filled or set again.
+
+    Args:
+      segment: Segment name.
+      animation: Called with the seconds since the animation started on every
+        frame. Returns one color for the whole segment or a list of colors.
+    """
+    with self._condition:
+      self._animations[segment] = (animation, time.time())
+      self._condition.notify_all()
+
+  def clear(self):
+    """Turns every pixel off and stops the animations."""
+    with self._condition:
+      self._animations.clear()
+      for segment in self._segments:
+        self._update(segment, [0] * len(self._segments[segment]))
+
+  def flush(self, timeout=_FLUSH_TIMEOUT):
+    """Blocks until the current pixels were sent to the strip.
+
+    Returns:
+      True if they were sent before the timeout.
+    """
+    with self._condition:
+      version = self._version
+      return self._condition.wait_for(
+          lambda: self._shown_version >= version or not self._running, timeout)
+
+  def _update(self, segment, colors):
+    pixels = self._segments[segment]
+    if len(colors) != len(pixels):
+      raise ValueError(f'{segment} has {len(pixels)} pixels, got {len(colors)}')
+    changed = False
+    for index, color in zip(pixels, colors):
+      if self._pixels[index] != color:
+        self._pixels[index] = color
+        changed = True
+    if changed:
+      self._version += 1
+      self._condition.notify_all()
+
+  def _step_animations(self, now):
+    for segment, (animation, start_time) in self._animations.items():
+      colors = animation(now - start_time)
+      if not isinstance(colors, (list, tuple)):
+        colors = [colors] * len(self._segments[segment])
+      self._update(segment, colors)
+
+  def _render_loop(self):
+    last_frame = 0.0
+    while True:
+      with self._condition:
+        self._condition.wait_for(
+            lambda: (not self._running or self._animations or
+                     self._version != self._shown_version))
+        # Changes made within one frame interval are sent together
+        while self._running:
+          delay = last_frame + self._interval - time.time()
+          if delay <= 0:
+            break
+          self._condition.wait(delay)
+        running = self._running
+        self._step_animations(time.time())
+        version = self._version
+        pixels = list(self._pixels)
+      if pixels != self._shown:
+        for index, color in enumerate(pixels):
+          if self._shown is None or self._shown[index] != color:
+            self._strip.setPixelColor(index, color)
+        self._strip.show()
+        self._shown = pixels
+        self.shows += 1
+      last_frame = time.time()
+      with self._condition:
+        self._shown_version = version
+        self._condition.notify_all()
+      if not running:
+        return
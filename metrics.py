@@ -0,0 +1,224 @@
+"""Low-overhead latency histograms for the stages of the bin's pipeline.
+
+Every stage of a deposit records its duration with
+
+  with metrics.timed('inference'):
+    categories = classifier.classify(tensor_image)
+
+or `metrics.observe(stage, seconds)` when the start time is known already.
+An observation is a bisect and a few additions under a per-stage lock, so it
+can be used on the hot path.
+
+Each stage keeps cumulative Prometheus-style histogram buckets and rolling
+statistics over the last minute. They are exposed as Prometheus text by
+`prometheus_text()`, served by the preview server at `/metrics`, and as JSON
+by `snapshot()`, which `start_dump()` writes to a file periodically.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, from 0.5 ms to about 65 s
+_BUCKETS = tuple(0.001 * 2 ** i for i in range(-1, 17))
+_WINDOW = 60  # seconds covered by the rolling statistics
+_SLICES = 6  # the window moves forward one slice at a time
+_DUMP_INTERVAL = 10  # seconds between JSON dumps
+
+
+class Histogram:
+  """Cumulative and rolling histogram of one stage's durations."""
+
+  def __init__(self, buckets=_BUCKETS, window=_WINDOW, slices=_SLICES):
+    self._buckets = buckets
+    self._window = window
+    self._slice_time = window / slices
+    self._lock = threading.Lock()
+    self._counts = [0] * (len(buckets) + 1)
+    self._sum = 0.0
+    self._count = 0
+    self._first_time = None
+    # Per slice: id, bucket counts, sum, count and maximum
+    self._slices = [[-1, [0] * (len(buckets) + 1), 0.0, 0, 0.0]
+                    for _ in range(slices)]
+
+  def observe(self, value, now=None):
+    if now is None:
+      now = time.time()
+    index = bisect.bisect_left(self._buckets, value)
+    slice_id = int(now // self._slice_time)
+    with self._lock:
+      if self._first_time is None:
+        self._first_time = now
+      self._counts[index] += 1
+      self._sum += value
+      self._count += 1
+      current = self._slices[slice_id % len(self._slices)]
+      if current[0] != slice_id:
+        current[0] = slice_id
+        current[1] = [0] * len(self._counts)
+        current[2] = 0.0
+        current[3] = 0
+        current[4] = 0.0
+      current[1][index] += 1
+      current[2] += value
+      current[3] += 1
+      current[4] = max(current[4], value)
+
+  def cumulative(self):
+    """Returns `(bucket_counts, sum, count)` since the start."""
+    with self._lock:
+      return list(self._counts), self._sum, self._count
+
+  def rolling(self, now=None):
+    """Returns statistics of the observations of the last window."""
+    if now is None:
+      now = time.time()
+    oldest = int(now // self._slice_time) - len(self._slices) + 1
+    counts = [0] * len(self._counts)
+    total, count, maximum = 0.0, 0, 0.0
+    with self._lock:
+      first_time = self._first_time
+      for slice_id, slice_counts, slice_sum, slice_count, slice_max in (
+          self._slices):
+        if slice_id >= oldest:
+          counts = [a + b for a, b in zip(counts, slice_counts)]
+          total += slice_sum
+          count += slice_count
+          maximum = max(maximum, slice_max)
+    # Until a full window has passed, the rate is over the time since the
+    # first observation, but at least one slice
+    span = self._window
+    if first_time is not None:
+      span = max(self._slice_time, min(self._window, now - first_time))
+    result = {'count': count, 'rate': count / span}
+    if count:
+      result['mean'] = total / count
+      result['max'] = maximum
+      for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[name] = self._quantile(counts, count, q, maximum)
+    return result
+
+  def _quantile(self, counts, count, q, maximum):
+    """Interpolates the `q` quantile within the bucket it falls in."""
+    rank = q * count
+    seen = 0
+    for index, bucket_count in enumerate(counts):
+      if bucket_count and seen + bucket_count >= rank:
+        lower = self._buckets[index - 1] if index else 0.0
+        upper = (self._buckets[index] if index < len(self._buckets)
+                 else maximum)
+        return min(lower + (upper - lower) * (rank - seen) / bucket_count,
+                   maximum)
+      seen += bucket_count
+    return maximum
+
+
+class Metrics:
+  """Histograms per stage and event counters."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._histograms = {}
+    self._counters = {}
+    self._dump_thread = None
+    self._stopped = threading.Event()
+
+  def histogram(self, stage):
+    histogram = self._histograms.get(stage)
+    if histogram is None:
+      with self._lock:
+        histogram = self._histograms.setdefault(stage, Histogram())
+    return histogram
+
+  def observe(self, stage, seconds):
+    """Records that `stage` took `seconds`."""
+    self.histogram(stage).observe(seconds)
+
+  @contextlib.contextmanager
+  def timed(self, stage):
+    """Times the body of a `with` statement as `stage`."""
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.histogram(stage).observe(time.perf_counter() - start_time)
+
+  def increment(self, event, amount=1):
+    with self._lock:
+      self._counters[event] = self._counters.get(event, 0) + amount
+
+  def rate(self, stage):
+    """Returns how many times per second `stage` ran over the last window."""
+    return self.histogram(stage).rolling()['rate']
+
+  def snapshot(self):
+    """Returns the rolling statistics of every stage and the counters."""
+    with self._lock:
+      histograms = dict(self._histograms)
+      counters = dict(self._counters)
+    now = time.time()
+    return {
+        'timestamp': now,
+        'window_seconds': _WINDOW,
+        'stages': {stage: histogram.rolling(now)
+                   for stage, histogram in sorted(histograms.items())},
+        'counters': counters,
+    }
+
+  def prometheus_text(self):
+    """Returns the metrics in the Prometheus text exposition format."""
+    with self._lock:
+      histograms = sorted(self._histograms.items())
+      counters = sorted(self._counters.items())
+    lines = ['# HELP bin_stage_seconds Time spent in each pipeline stage.',
+             '# TYPE bin_stage_seconds histogram']
+    for stage, histogram in histograms:
+      counts, total, count = histogram.cumulative()
+      seen = 0
+      for bound, bucket_count in zip(_BUCKETS, counts):
+        seen += bucket_count
+        lines.append(
+            f'bin_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {seen}')
+      lines.append(
+          f'bin_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+      lines.append(f'bin_stage_seconds_sum{{stage="{stage}"}} {total}')
+      lines.append(f'bin_stage_seconds_count{{stage="{stage}"}} {count}')
+    lines += ['# HELP bin_events_total Number of events of each kind.',
+              '# TYPE bin_events_total counter']
+    for event, value in counters:
+      lines.append(f'bin_events_total{{event="{event}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+  def dump(self, path):
+    """Writes `snapshot()` to `path` as JSON, replacing it atomically."""
+    with open(path + '.tmp', 'w') as f:
+      json.dump(self.snapshot(), f, indent=2)
+    os.replace(path + '.tmp', path)
+
+  def start_dump(self, path, interval=_DUMP_INTERVAL):
+    """Dumps the metrics to `path` every `interval` seconds until `stop()`."""
+
+    def run():
+      while not self._stopped.wait(interval):
+        self.dump(path)
+
+    self._dump_thread = threading.Thread(
+        target=run, name='MetricsDump', daemon=True)
+    self._dump_thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._dump_thread:
+      self._dump_thread.join()
+
+
+# Shared by every module of the bin
+registry = Metrics()
+observe = registry.observe
+timed = registry.timed
+increment = registry.increment
+rate = registry.rate
@@ -0,0 +1,188 @@
+"""Swaps the classification model of a running bin.
+
+A new model is built and warmed up on a background thread while the bin
+keeps classifying with the old one, then swapped in with a single reference
+assignment. The run() loops call `current()` once per item, so a swap takes
+effect between classifications and no frame waits for a model to load.
+
+A swap is requested with `request()`, e.g. from the preview server's
+`POST /model/<name>`, or by the watcher started with `watch()`. A model
+swapped in is written to an existing models/ACTIVE, so the watcher keeps it:
+
+  echo mobilenet_v2.tflite > models/ACTIVE   # switch to another model
+  mv new.tflite models/default_model.tflite  # replace the active model
+
+Model files should be replaced with a rename, as above, so the watcher never
+sees a half-written file.
+"""
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+import startup
+
+_MODELS_DIR = './models'
+_ACTIVE_FILE = 'ACTIVE'  # names the model the bin should use
+_WATCH_INTERVAL = 2  # seconds between checks of the models directory
+
+LoadedModel = collections.namedtuple(
+    'LoadedModel', ['name', 'classifier', 'preprocessor', 'mtime'])
+
+
+class ModelManager:
+  """Holds the active model and replaces it in the background."""
+
+  def __init__(self, model, num_threads, max_results, score_threshold,
+               models_dir=_MODELS_DIR, load_model=startup.load_model):
+    """Initializes the manager. Call `load()` before `current()`.
+
+    Args:
+      model: Name of the initial model in `models_dir`.
+      num_threads: Number of CPU threads the classifiers use.
+      max_results: Maximum number of categories returned.
+      score_threshold: Minimum score of the returned categories.
+      models_dir: Directory the models are loaded from and watched in.
+      load_model: Function with the signature of `startup.load_model()`
+        that returns a `(classifier, preprocessor)` tuple, e.g. one loading
+        the model in the inference service.
+    """
+    self._model = model
+    self._options = (num_threads, max_results, score_threshold)
+    self._models_dir = models_dir
+    self._load_model = load_model
+    self._active = None
+    self._lock = threading.Lock()
+    self._loader = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='ModelLoader')
+    self._stopped = threading.Event()
+    self._watcher = None
+    self._rejected = set()
+    self.swaps = 0
+
+  def load(self, timer=None):
+    """Loads the initial model on the calling thread.
+
+    Raises:
+      RuntimeError: If the model fails its warm-up check.
+    """
+    loaded, error = self._build(self._model, timer)
+    if error:
+      raise RuntimeError(f'Unable to load {self._model}: {error}')
+    with self._lock:
+      self._active = loaded
+    return loaded
+
+  def current(self):
+    """Returns the active `LoadedModel`.
+
+    Use the same `LoadedModel` for every frame of an item, so all its frames
+    are classified by the same model.
+    """
+    return self._active
+
+  def request(self, model):
+    """Loads `model` in the background and swaps it in if it works.
+
+    Args:
+      model: File name of a model in the models directory.
+
+    Returns:
+      A `concurrent.futures.Future` resolved with True if the model was
+      swapped in, False if the old one was kept.
+    """
+    return self._loader.submit(self._swap, os.path.basename(model))
+
+  def watch(self, interval=_WATCH_INTERVAL):
+    """Starts checking the models directory for a new active model."""
+    self._watcher = threading.Thread(
+        target=self._watch, args=(interval,), name='ModelWatcher', daemon=True)
+    self._watcher.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._watcher:
+      self._watcher.join()
+    self._loader.shutdown(wait=True)
+
+  def _path(self, model):
+    return os.path.join(self._models_dir, model)
+
+  def _build(self, model, timer=None):
+    """Returns `(LoadedModel, None)`, or `(None, error)` if it failed."""
+    path = self._path(model)
+    try:
+      mtime = os.path.getmtime(path)
+      # Runs the warm-up inference, which also checks the category names
+      classifier, preprocessor = self._load_model(
+          timer or startup.StartupTimer(), path, *self._options)
+    except Exception as e:  # pylint: disable=broad-except
+      return None, e
+    return LoadedModel(model, classifier, preprocessor, mtime), None
+
+  def _swap(self, model):
+    start_time = time.time()
+    loaded, error = self._build(model)
+    if error:
+      print(f'Keeping {self._active.name}: {model} failed to load: {error}')
+      return False
+    with self._lock:
+      # Written before the watcher can look again, so it keeps this model
+      self._write_active(model)
+      previous = self._active
+      self._active = loaded
+      self.swaps += 1
+    print(f'Swapped {previous.name} for {model} after '
+          f'{time.time() - start_time:.2f} s')
+    return True
+
+  def _write_active(self, model):
+    """Names `model` in the ACTIVE file, if there is one naming another.
+
+    Without an ACTIVE file the watcher follows the active model anyway.
+    """
+    path = self._path(_ACTIVE_FILE)
+    try:
+      with open(path) as f:
+        if os.path.basename(f.read().strip()) == model:
+          return
+    except FileNotFoundError:
+      return
+    try:
+      # Renamed into place, so the watcher never reads a half-written file
+      with open(path + '.tmp', 'w') as f:
+        f.write(model + '\n')
+      os.replace(path + '.tmp', path)
+    except OSError as e:
+      print(f'WARNING: Unable to write {path}: {e}')
+
+  def _wanted(self):
+    """Returns the model the directory asks for and its modification time."""
+    model = self._active.name
+    try:
+      with open(self._path(_ACTIVE_FILE)) as f:
+        model = os.path.basename(f.read().strip()) or model
+    except FileNotFoundError:
+      pass
+    try:
+      return model, os.path.getmtime(self._path(model))
+    except OSError:
+      return model, None
+
+  def _watch(self, interval):
+    pending = None
+    while not self._stopped.wait(interval):
+      if pending is not None and not pending.done():
+        continue
+      with self._lock:
+        model, mtime = self._wanted()
+        active = self._active
+      if mtime is None or (model, mtime) in self._rejected:
+        continue
+      if model != active.name or mtime != active.mtime:
+        pending = self.request(model)
+        # A model that failed is retried only once its file changes again
+        pending.add_done_callback(
+            lambda f, key=(model, mtime): f.result() or self._rejected.add(key))
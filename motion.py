@@ -0,0 +1,156 @@
+"""Motion triggers from the PIR and the camera, fed into one event queue."""
+
+import collections
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Triggers closer than this to the last accepted one are ignored.
+_DEBOUNCE_TIME = 8  # seconds
+
+# Vision trigger parameters
+_TRIGGER_SIZE = (64, 48)  # width and height of the downscaled region
+_PIXEL_THRESHOLD = 25  # grey levels a pixel must differ to count as changed
+_BACKGROUND_RATE = 0.05  # background adaptation rate where nothing is present
+_FOREGROUND_RATE = 0.002  # adaptation rate under objects, for lighting drift
+_MIN_COVERAGE = 0.05  # fraction of the region an object must cover
+_MAX_MOTION = 0.01  # fraction of pixels allowed to change between frames
+_STABLE_FRAMES = 3  # consecutive still frames before the trigger fires
+
+MotionEvent = collections.namedtuple('MotionEvent', ['timestamp', 'source'])
+
+
+class MotionEvents:
+  """Debounced queue of motion triggers.
+
+  Triggers may come from any thread, typically the RPi.GPIO callback thread.
+  A trigger less than `debounce` seconds after the last accepted one is
+  dropped. Consumers block in `wait()` instead of polling the sensor.
+  """
+
+  def __init__(self, debounce=_DEBOUNCE_TIME):
+    self.debounce = debounce
+    self._queue = queue.Queue()
+    self._lock = threading.Lock()
+    self._last_time = 0
+
+  def trigger(self, source, timestamp=None):
+    """Records a trigger.
+
+    Args:
+      source: Name of what detected the motion, e.g. 'pir'.
+      timestamp: Time of the trigger, defaults to now.
+
+    Returns:
+      True if the trigger was accepted, False if it was debounced.
+    """
+    if timestamp is None:
+      timestamp = time.time()
+    with self._lock:
+      if timestamp - self._last_time <= self.debounce:
+        return False
+      self._last_time = timestamp
+    self._queue.put(MotionEvent(timestamp, source))
+    return True
+
+  def wait(self, timeout=None):
+    """Blocks until motion is detected.
+
+    Returns:
+      The oldest pending `MotionEvent`, or None if the timeout expired.
+    """
+    try:
+      return self._queue.get(timeout=timeout)
+    except queue.Empty:
+      return None
+
+
+def watch_pir(events, gpio, pin):
+  """Feeds the rising edges of a PIR sensor into `events`.
+
+  Args:
+    events: The `MotionEvents` to trigger.
+    gpio: The `RPi.GPIO` module, or an object with the same interface.
+    pin: BCM pin number the PIR output is connected to.
+  """
+  gpio.setup(pin, gpio.IN)
+  gpio.add_event_detect(pin, gpio.RISING,
+                        callback=lambda channel: events.trigger('pir'))
+
+
+class VisionTrigger:
+  """Fires when a still object appears in a region of the camera image.
+
+  The region is subsampled, downscaled to a small grayscale image and
+  compared against a running-average background. The trigger fires once an
+  object covers enough of the region and has stopped moving for a few frames,
+  so people walking past do not trigger a classification. It re-arms when
+  the region is back to the background.
+
+  An instance can be passed to `FrameGrabber.add_listener()` to run on every
+  captured frame.
+  """
+
+  def __init__(self, events, region=(0.0, 0.0, 1.0, 1.0)):
+    """Initializes the trigger.
+
+    Args:
+      events: The `MotionEvents` to trigger.
+      region: `(x, y, width, height)` of the watched area, as fractions of the
+        frame size.
+    """
+    self._events = events
+    self._region = region
+    self._background = None
+    self._previous = None
+    self._stable_frames = 0
+    self._armed = True
+
+  def __call__(self, frame):
+    if self.update(frame.image):
+      self._events.trigger('camera', frame.timestamp)
+
+  def update(self, image):
+    """Adds a BGR frame.
+
+    Returns:
+      True if a still object just appeared in the region.
+    """
+    height, width = image.shape[:2]
+    x, y, w, h = self._region
+    region = image[int(y * height):int((y + h) * height),
+                   int(x * width):int((x + w) * width)]
+    # Skip pixels before resizing so the resize only touches a few of them
+    step = max(1, min(region.shape[1] // (2 * _TRIGGER_SIZE[0]),
+                      region.shape[0] // (2 * _TRIGGER_SIZE[1])))
+    small = cv2.resize(region[::step, ::step], _TRIGGER_SIZE,
+                       interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    if self._background is None:
+      self._background = gray.copy()
+      self._previous = gray
+      return False
+
+    difference = gray - self._background
+    foreground = np.abs(difference) > _PIXEL_THRESHOLD
+    coverage = foreground.mean()
+    motion = (np.abs(gray - self._previous) > _PIXEL_THRESHOLD).mean()
+    self._previous = gray
+    self._background += difference * np.where(
+        foreground, _FOREGROUND_RATE, _BACKGROUND_RATE)
+
+    if coverage >= _MIN_COVERAGE and motion <= _MAX_MOTION:
+      self._stable_frames += 1
+    else:
+      self._stable_frames = 0
+    if coverage < _MIN_COVERAGE / 2:
+      self._armed = True
+
+    if self._armed and self._stable_frames >= _STABLE_FRAMES:
+      self._armed = False
+      return True
+    return False
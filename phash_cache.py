@@ -0,0 +1,99 @@
+"""Perceptual hashes of camera frames and a cache keyed by them.
+
+Two frames of the same item held still in front of the camera differ in
+noise and lighting flicker, so their pixels never match exactly but their
+difference hashes do, up to a few bits. `PerceptualCache` looks entries up by
+Hamming distance instead of equality, which lets the bin reuse a recent
+classification of the same item, and drop a challenge of an item that was
+already challenged.
+"""
+
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+_HASH_SIZE = 16  # the hash has _HASH_SIZE ** 2 bits
+_MAX_DISTANCE = 12  # bits two hashes of the same item may differ in
+_MAX_ENTRIES = 32
+_TTL = 10  # seconds an entry stays valid
+
+
+def dhash(image, hash_size=_HASH_SIZE):
+  """Returns the difference hash of a BGR image as an int.
+
+  The image is shrunk to `hash_size + 1` by `hash_size` grey pixels and every
+  bit tells whether a pixel is brighter than its right neighbour, so the hash
+  follows the shapes in the image rather than its exact colours.
+  """
+  height, width = image.shape[:2]
+  # Skip pixels before resizing so the resize only touches a few of them
+  step = max(1, min(width // (4 * (hash_size + 1)), height // (4 * hash_size)))
+  small = cv2.resize(image[::step, ::step], (hash_size + 1, hash_size),
+                     interpolation=cv2.INTER_AREA)
+  gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+  bits = gray[:, 1:] > gray[:, :-1]
+  return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def distance(hash1, hash2):
+  """Returns the number of bits two hashes differ in."""
+  return bin(hash1 ^ hash2).count('1')
+
+
+class PerceptualCache:
+  """LRU cache of values keyed by near-identical perceptual hashes.
+
+  A lookup scans the entries for one within `max_distance` bits, so the
+  cache is meant to stay small. Entries older than `ttl` seconds are ignored
+  and evicted, as are the least recently used ones beyond `max_entries`.
+  """
+
+  def __init__(self, max_entries=_MAX_ENTRIES, ttl=_TTL,
+               max_distance=_MAX_DISTANCE):
+    self._max_entries = max_entries
+    self._ttl = ttl
+    self._max_distance = max_distance
+    self._lock = threading.Lock()
+    # Hash to (timestamp, tag, value), least recently used first
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, image_hash, tag=None, now=None):
+    """Returns the value of a near-identical hash, or None.
+
+    Args:
+      image_hash: Hash from `dhash()`.
+      tag: Only entries stored with the same tag match, e.g. the model name
+        so results of a swapped-out model are not reused.
+      now: Current time, defaults to `time.time()`.
+    """
+    if now is None:
+      now = time.time()
+    with self._lock:
+      self._expire(now)
+      for key, (_, entry_tag, value) in reversed(self._entries.items()):
+        if entry_tag == tag and distance(key, image_hash) <= self._max_distance:
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return value
+      self.misses += 1
+      return None
+
+  def put(self, image_hash, value, tag=None, now=None):
+    if now is None:
+      now = time.time()
+    with self._lock:
+      self._entries[image_hash] = (now, tag, value)
+      self._entries.move_to_end(image_hash)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def _expire(self, now):
+    expired = [key for key, (timestamp, _, _) in self._entries.items()
+               if now - timestamp > self._ttl]
+    for key in expired:
+      del self._entries[key]
@@ -0,0 +1,89 @@
+"""Camera frame to model input conversion without per-frame allocations."""
+
+import cv2
+import numpy as np
+
+
+def model_input_size(model_file):
+  """Returns the `(width, height)` the model's input tensor expects.
+
+  Args:
+    model_file: Path of the `.tflite` file.
+  """
+  # Imported here so clients of the inference service never load TFLite
+  from tflite_support import schema_py_generated  # pylint: disable=import-outside-toplevel
+  with open(model_file, 'rb') as f:
+    buffer = f.read()
+  model = schema_py_generated.Model.GetRootAsModel(buffer, 0)
+  subgraph = model.Subgraphs(0)
+  shape = subgraph.Tensors(subgraph.Inputs(0)).ShapeAsNumpy()
+  # Image models take a [batch, height, width, channels] tensor
+  return int(shape[2]), int(shape[1])
+
+
+class Preprocessor:
+  """Turns BGR camera frames into `TensorImage`s of the model's input size.
+
+  The watched region of the frame is resized straight into a buffer of the
+  model's input size and colour converted into a second one. Both buffers are
+  allocated once and reused for every frame, and the resize and colour
+  conversion only ever touch the small image, so the classifier no longer
+  has to scale the full camera frame itself.
+
+  The returned `TensorImage` reads from the reused buffer, so it must be
+  classified before the next call.
+  """
+
+  def __init__(self, model_file, region=(0.0, 0.0, 1.0, 1.0), flip=True,
+               size=None):
+    """Initializes the preprocessor.
+
+    Args:
+      model_file: Path of the `.tflite` file the frames are classified with.
+        Only read for the input size, so it may be None if `size` is given.
+      region: `(x, y, width, height)` of the classified area, as fractions of
+        the frame size.
+      flip: Mirror the image horizontally, as the run() loops always did
+        before classifying. Pass False for images the bins saved, which are
+        mirrored already.
+      size: `(width, height)` of the model input, read from `model_file` if
+        None.
+    """
+    self.size = size or model_input_size(model_file)
+    self._region = region
+    self._flip = flip
+    width, height = self.size
+    self._resized = np.empty((height, width, 3), dtype=np.uint8)
+    self._rgb = np.empty((height, width, 3), dtype=np.uint8)
+    self._flipped = np.empty((height, width, 3), dtype=np.uint8)
+
+  def __call__(self, image):
+    """Returns the `TensorImage` of a BGR frame."""
+    from tflite_support.task import vision  # pylint: disable=import-outside-toplevel
+    return vision.TensorImage.create_from_array(self.convert(image))
+
+  def convert(self, image, out=None):
+    """Writes the RGB model input of a BGR frame into `out` and returns it.
+
+    Args:
+      image: BGR camera frame.
+      out: `(height, width, 3)` uint8 array, e.g. in shared memory. Defaults
+        to a reused internal buffer.
+    """
+    height, width = image.shape[:2]
+    x, y, w, h = self._region
+    # Slicing gives a view of the frame, nothing is copied until the resize
+    region = image[int(y * height):int((y + h) * height),
+                   int(x * width):int((x + w) * width)]
+    # Bilinear, like the scaling tflite_support would otherwise do
+    cv2.resize(region, self.size, dst=self._resized,
+               interpolation=cv2.INTER_LINEAR)
+    if out is None:
+      out = self._flipped if self._flip else self._rgb
+    # Convert the image from BGR to RGB as required by the TFLite model.
+    if self._flip:
+      cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB, dst=self._rgb)
+      cv2.flip(self._rgb, 1, dst=out)
+    else:
+      cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB, dst=out)
+    return out
@@ -0,0 +1,203 @@
+"""Low-rate HTTP preview and control channel for headless bins.
+
+The server listens on localhost only. Maintainers reach it through an SSH
+tunnel:
+
+  GET  /stream.mjpg          MJPEG stream of the camera
+  GET  /snapshot.jpg         single JPEG of the latest frame
+  GET  /metrics              stage latencies in the Prometheus text format
+  GET  /metrics.json         rolling stage latencies as JSON
+  POST /control/<action>     one of: space, challenge, quit, reset
+  POST /model/<name>         switch to another model in models/
+
+Frames are only JPEG-encoded while a client is connected, at most `max_fps`
+times per second, and the encoded frame is shared between clients.
+"""
+
+import http.server
+import json
+import queue
+import threading
+import time
+
+import cv2
+
+import metrics
+
+_MAX_FPS = 2
+_JPEG_QUALITY = 70
+
+# Control actions mapped to the key codes the run() loops understand
+CONTROL_KEYS = {
+    'space': 32,
+    'challenge': ord('c'),
+    'quit': 27,
+    'reset': ord('r'),
+}
+
+
+class ControlChannel:
+  """Key presses coming from somewhere other than an OpenCV window."""
+
+  def __init__(self):
+    self._keys = queue.Queue()
+
+  def post(self, key):
+    self._keys.put(key)
+
+  def read_key(self):
+    """Returns the next key code, or -1 like `cv2.waitKey` when none."""
+    try:
+      return self._keys.get_nowait()
+    except queue.Empty:
+      return -1
+
+
+class PreviewServer:
+  """Serves the latest frame published by the run() loop over HTTP."""
+
+  def __init__(self, port, controls, host='127.0.0.1', max_fps=_MAX_FPS,
+               models=None):
+    self._controls = controls
+    self._models = models
+    self._interval = 1.0 / max_fps
+    self._condition = threading.Condition()
+    self._image = None
+    self._image_index = 0
+    self._jpeg = None
+    self._jpeg_index = 0
+    self._jpeg_time = 0
+    self._encoding = False
+    self._running = True
+    self._server = http.server.ThreadingHTTPServer(
+        (host, port), self._handler_class())
+    self._server.daemon_threads = True
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(
+        target=self._server.serve_forever, name='PreviewServer', daemon=True)
+    self._thread.start()
+    host, port = self._server.server_address
+    print(f'Preview available at http://{host}:{port}/stream.mjpg')
+
+  def stop(self):
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    self._server.shutdown()
+    self._server.server_close()
+
+  def publish(self, image):
+    """Makes `image` the latest frame. Only keeps a reference, no encoding."""
+    with self._condition:
+      self._image = image
+      self._image_index += 1
+      self._condition.notify_all()
+
+  def _latest_jpeg(self, newer_than, timeout=None):
+    """Returns `(index, jpeg)` of a frame newer than `newer_than`.
+
+    Encodes the latest published frame if the cached JPEG is out of date and
+    the rate limit allows it. Returns `(newer_than, None)` on timeout.
+    """
+    with self._condition:
+      deadline = None if timeout is None else time.time() + timeout
+      while self._running:
+        now = time.time()
+        if (self._image_index > self._jpeg_index and not self._encoding and
+            now - self._jpeg_time >= self._interval):
+          image, index = self._image, self._image_index
+          # Encoded without the lock, so publish() never waits for it; other
+          # viewers wait for this encoding instead of starting their own
+          self._encoding = True
+          self._condition.release()
+          try:
+            success, encoded = cv2.imencode(
+                '.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, _JPEG_QUALITY])
+          finally:
+            self._condition.acquire()
+            self._encoding = False
+            self._condition.notify_all()
+          if success:
+            self._jpeg = encoded.tobytes()
+            self._jpeg_index = index
+            self._jpeg_time = now
+        if self._jpeg is not None and self._jpeg_index > newer_than:
+          return self._jpeg_index, self._jpeg
+        wait = self._interval - (now - self._jpeg_time)
+        if deadline is not None:
+          if now >= deadline:
+            break
+          wait = min(wait, deadline - now)
+        self._condition.wait(max(wait, 0.01))
+      return newer_than, None
+
+  def _handler_class(self):
+    server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if self.path == '/snapshot.jpg':
+          _, jpeg = server._latest_jpeg(0, timeout=5)
+          if jpeg is None:
+            self.send_error(503, 'No frame available')
+            return
+          self.send_response(200)
+          self.send_header('Content-Type', 'image/jpeg')
+          self.send_header('Content-Length', str(len(jpeg)))
+          self.end_headers()
+          self.wfile.write(jpeg)
+        elif self.path == '/stream.mjpg':
+          self.send_response(200)
+          self.send_header('Content-Type',
+                           'multipart/x-mixed-replace; boundary=frame')
+          self.end_headers()
+          index = 0
+          try:
+            while server._running:
+              index, jpeg = server._latest_jpeg(index)
+              if jpeg is None:
+                break
+              self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n')
+              self.wfile.write(f'Content-Length: {len(jpeg)}\r\n\r\n'.encode())
+              self.wfile.write(jpeg + b'\r\n')
+          except (BrokenPipeError, ConnectionResetError):
+            pass
+        elif self.path == '/metrics':
+          self._send(metrics.registry.prometheus_text(),
+                     'text/plain; version=0.0.4')
+        elif self.path == '/metrics.json':
+          self._send(json.dumps(metrics.registry.snapshot()),
+                     'application/json')
+        else:
+          self.send_error(404)
+
+      def _send(self, text, content_type):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_POST(self):
+        if self.path.startswith('/model/') and server._models:
+          # Loading happens in the background, the bin keeps classifying
+          server._models.request(self.path[len('/model/'):])
+          self.send_response(202)
+          self.end_headers()
+          return
+        action = self.path.rpartition('/control/')[2]
+        if not self.path.startswith('/control/') or action not in CONTROL_KEYS:
+          self.send_error(404, 'Unknown control action')
+          return
+        server._controls.post(CONTROL_KEYS[action])
+        self.send_response(204)
+        self.end_headers()
+
+      def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    return Handler
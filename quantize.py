@@ -0,0 +1,304 @@
+"""Quantizes a trained model and installs the variants that stay accurate.
+
+The retraining notebook can export the trained model as a SavedModel next
+to its `.tflite` file:
+
+  model.export(export_dir='exported', export_format=ExportFormat.SAVED_MODEL)
+
+From it, this script converts a dynamic-range variant (int8 weights) and a
+full-integer variant (int8 weights and activations, uint8 input), calibrated
+on a sample of the local image folders. The category labels and input
+normalization are copied from the float model, so the variants load in
+`vision.ImageClassifier` like any model in `models/`:
+
+  python3 quantize.py --float models/default_model.tflite \
+      --savedModel exported/saved_model
+
+Each variant is then classified on a labelled image set the way run() does,
+with `classification.image_preprocessor()` and the classifier's `classify()`,
+and compared with the float model. Only variants within `--maxAccuracyDrop` of
+the float model's top-1 accuracy and at least `--minSpeedup` times faster
+are copied into `models/`; the others stay in `--workDir` for inspection.
+
+Converting needs TensorFlow, which the bins don't install. Variants converted
+elsewhere, e.g. by the notebook's `QuantizationConfig`, can be checked and
+installed on the Pi without it:
+
+  python3 quantize.py --float models/default_model.tflite \
+      --candidates default_model_int8.tflite
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import benchmark
+import classification
+import image_files
+
+_WORK_DIR = 'quantized'
+_REPRESENTATIVE_IMAGES = 'classified_images'
+_VALIDATION_IMAGES = 'challenged_images'
+_REPRESENTATIVE_SAMPLES = 200  # images the int8 ranges are calibrated on
+_NUM_THREADS = 4  # as in the run() loops
+_REPEATS = 3  # passes over the validation images for the latency
+_MAX_ACCURACY_DROP = benchmark.ACCURACY_TOLERANCE
+_MIN_SPEEDUP = 1.1  # float p50 latency / variant p50 latency
+
+
+def _normalization(float_model):
+  """Returns the input `(mean, std)` from the float model's metadata."""
+  # pylint: disable=import-outside-toplevel
+  from tflite_support import metadata
+  displayer = metadata.MetadataDisplayer.with_model_file(float_model)
+  tensor = json.loads(displayer.get_metadata_json())[
+      'subgraph_metadata'][0]['input_tensor_metadata'][0]
+  for unit in tensor.get('process_units', []):
+    if unit['options_type'] == 'NormalizationOptions':
+      return unit['options']['mean'][0], unit['options']['std'][0]
+  return 0.0, 1.0
+
+
+def _copy_metadata(float_model, variant):
+  """Packs the float model's metadata and label file into `variant`."""
+  # pylint: disable=import-outside-toplevel
+  from tflite_support import metadata
+  displayer = metadata.MetadataDisplayer.with_model_file(float_model)
+  populator = metadata.MetadataPopulator.with_model_file(variant)
+  populator.load_metadata_buffer(displayer.get_metadata_buffer())
+  populator.load_associated_file_buffers({
+      name: displayer.get_associated_file_buffer(name)
+      for name in displayer.get_packed_associated_file_list()})
+  populator.populate()
+
+
+def _representative_dataset(float_model, images_dir, samples):
+  """Returns the calibration generator for the TFLite converter."""
+  paths = list(image_files.find_images(images_dir))
+  if not paths:
+    sys.exit(f'ERROR: No images found in {images_dir}')
+  # A fixed seed keeps the calibration, and so the variants, reproducible
+  random.Random(0).shuffle(paths)
+  preprocessor = classification.image_preprocessor(float_model)
+  mean, std = _normalization(float_model)
+
+  def generate():
+    for path in paths[:samples]:
+      image = cv2.imread(path)
+      if image is None:
+        continue
+      rgb = preprocessor.convert(image).astype(np.float32)
+      yield [((rgb - mean) / std)[np.newaxis]]
+
+  return generate
+
+
+def convert(float_model, saved_model, images_dir, samples, work_dir):
+  """Converts the quantized variants of `saved_model` into `work_dir`.
+
+  Returns:
+    The paths of the converted variants.
+  """
+  try:
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+  except ImportError:
+    sys.exit('ERROR: Converting needs TensorFlow (pip3 install tensorflow); '
+             'pass already quantized models with --candidates instead')
+  stem = os.path.splitext(os.path.basename(float_model))[0]
+  os.makedirs(work_dir, exist_ok=True)
+  variants = []
+  for variant in ('dynamic', 'int8'):
+    start_time = time.time()
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == 'int8':
+      converter.representative_dataset = _representative_dataset(
+          float_model, images_dir, samples)
+      converter.target_spec.supported_ops = [
+          tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+      # Camera frames are uint8 already, so the input needs no normalization
+      converter.inference_input_type = tf.uint8
+      converter.inference_output_type = tf.uint8
+    path = os.path.join(work_dir, f'{stem}_{variant}.tflite')
+    with open(path, 'wb') as f:
+      f.write(converter.convert())
+    _copy_metadata(float_model, path)
+    print(f'Converted {path} ({os.path.getsize(path) / 1e6:.1f} MB) in '
+          f'{time.time() - start_time:.0f} s')
+    variants.append(path)
+  return variants
+
+
+def evaluate(model, images, repeats=_REPEATS):
+  """Classifies labelled images like run() and returns accuracy and latency.
+
+  Args:
+    model: Path of the `.tflite` file.
+    images: List of `(label, BGR image)` pairs.
+    repeats: Passes over the images the latency is measured on.
+  """
+  labels = set(classification.model_labels(model))
+  classifier = classification.create_classifier(model, _NUM_THREADS, 1, 0.0)
+  preprocessor = classification.image_preprocessor(model)
+  # Warm up the interpreter before timing it
+  classifier.classify(preprocessor(images[0][1]))
+  latencies = []
+  correct, labelled = 0, 0
+  for repeat in range(repeats):
+    for label, image in images:
+      start_time = time.perf_counter()
+      result = classifier.classify(preprocessor(image))
+      latencies.append(time.perf_counter() - start_time)
+      categories = result.classifications[0].categories
+      if repeat == 0 and label in labels:
+        labelled += 1
+        correct += bool(categories) and categories[0].category_name == label
+  return {
+      'size_mb': os.path.getsize(model) / 1e6,
+      'latency': benchmark.percentiles(latencies),
+      'top1_accuracy': correct / labelled if labelled else None,
+      'labelled_images': labelled,
+  }
+
+
+def check(reference, result, max_accuracy_drop, min_speedup):
+  """Returns the budgets `result` misses against `reference`."""
+  failures = []
+  if result['top1_accuracy'] is None or reference['top1_accuracy'] is None:
+    failures.append('no labelled validation images')
+  elif (result['top1_accuracy'] <
+        reference['top1_accuracy'] - max_accuracy_drop):
+    failures.append(f"top-1 accuracy {reference['top1_accuracy']:.3f} -> "
+                    f"{result['top1_accuracy']:.3f}")
+  speedup = reference['latency']['p50_ms'] / result['latency']['p50_ms']
+  if speedup < min_speedup:
+    failures.append(f'speedup {speedup:.2f}x below {min_speedup:.2f}x')
+  return failures
+
+
+def run(float_model, saved_model, candidates, representative_dir,
+        samples, validation_dir, work_dir, models_dir, max_accuracy_drop,
+        min_speedup, output):
+  float_model = classification.model_path(float_model)
+  if saved_model:
+    candidates = candidates + convert(float_model, saved_model,
+                                      representative_dir, samples, work_dir)
+  if not candidates:
+    sys.exit('ERROR: Pass --savedModel to convert or --candidates to check')
+
+  images = []
+  for path in image_files.find_images(validation_dir):
+    image = cv2.imread(path)
+    if image is not None:
+      images.append((os.path.basename(os.path.dirname(path)), image))
+  if not images:
+    sys.exit(f'ERROR: No images found in {validation_dir}')
+
+  reference = evaluate(float_model, images)
+  results = {'float': {float_model: reference}, 'variants': {}}
+  print(f"{float_model}: top-1 {reference['top1_accuracy']}, "
+        f"p50 {reference['latency']['p50_ms']:.1f} ms")
+  installed = []
+  for candidate in candidates:
+    result = evaluate(candidate, images)
+    failures = check(reference, result, max_accuracy_drop, min_speedup)
+    result['failures'] = failures
+    results['variants'][candidate] = result
+    print(f"{candidate}: top-1 {result['top1_accuracy']}, "
+          f"p50 {result['latency']['p50_ms']:.1f} ms, "
+          f"{result['size_mb']:.1f} MB")
+    if failures:
+      print(f"  Not installed: {'; '.join(failures)}")
+      continue
+    destination = os.path.join(models_dir, os.path.basename(candidate))
+    # Copied under a temporary name so the model watcher never sees half of it
+    shutil.copyfile(candidate, destination + '.tmp')
+    os.replace(destination + '.tmp', destination)
+    installed.append(destination)
+    print(f'  Installed {destination}')
+
+  results['installed'] = installed
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {output}')
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--float',
+      help='Float model the variants are compared with and get their '
+      'labels from.',
+      required=False,
+      default='default_model.tflite')
+  parser.add_argument(
+      '--savedModel',
+      help='SavedModel directory of the trained model to quantize.',
+      required=False,
+      default=None)
+  parser.add_argument(
+      '--candidates',
+      help='Already quantized .tflite files to check and install.',
+      nargs='+',
+      required=False,
+      default=[])
+  parser.add_argument(
+      '--representativeImages',
+      help='Directory of images the int8 variant is calibrated on.',
+      required=False,
+      default=_REPRESENTATIVE_IMAGES)
+  parser.add_argument(
+      '--samples',
+      help='Number of calibration images.',
+      type=int,
+      required=False,
+      default=_REPRESENTATIVE_SAMPLES)
+  parser.add_argument(
+      '--images',
+      help='Directory of labelled validation images, one folder per category.',
+      required=False,
+      default=_VALIDATION_IMAGES)
+  parser.add_argument(
+      '--workDir',
+      help='Directory the converted variants are written to.',
+      required=False,
+      default=_WORK_DIR)
+  parser.add_argument(
+      '--modelsDir',
+      help='Directory the variants that pass are installed in.',
+      required=False,
+      default=classification.MODELS_DIR)
+  parser.add_argument(
+      '--maxAccuracyDrop',
+      help='Largest allowed drop of the top-1 accuracy against the float model.',
+      type=float,
+      required=False,
+      default=_MAX_ACCURACY_DROP)
+  parser.add_argument(
+      '--minSpeedup',
+      help='Smallest allowed p50 latency speedup against the float model.',
+      type=float,
+      required=False,
+      default=_MIN_SPEEDUP)
+  parser.add_argument(
+      '--output',
+      help='JSON file the results are written to.',
+      required=False,
+      default='quantize_results.json')
+  args = parser.parse_args()
+
+  run(args.float, args.savedModel, args.candidates, args.representativeImages,
+      args.samples, args.images, args.workDir, args.modelsDir,
+      args.maxAccuracyDrop, args.minSpeedup, args.output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,155 @@
+"""Replays a recording from a bin through the `run_best_integ.py` loop.
+
+Record a bin in the field with
+
+  python3 run_best_integ.py --record recordings/monday
+
+then feed the same frames and sensor edges to the real classifier on
+simulated servos and LEDs, at the recorded speed or skipping the quiet time
+between sensor events:
+
+  python3 replay.py --recording recordings/monday --output replay.json
+  python3 replay.py --recording recordings/monday --speed 0 \
+      --model mobilenet_v2.tflite --baseline replay.json
+
+The sort decisions and stage latencies are written as JSON. With a baseline,
+the run fails if any decision differs from it.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+import hardware
+import metrics
+import preview
+import recording
+import run_best_integ
+import simulate_deposits
+
+_STARTUP_TIMEOUT = 60  # seconds to wait for the model and camera
+_SETTLE_TIMEOUT = 30  # seconds to wait for the last item after the replay
+
+
+def _decisions(log, since):
+  """Returns the sort decisions the chute servo made after `since`."""
+  angles = simulate_deposits.SORT_ANGLES
+  return [angles[round(event.value)]
+          for event in log.events('servo', run_best_integ.CHOOSE_PIN, since)
+          if event.value is not None and round(event.value) in angles]
+
+
+def run(model, recording_dir, speed, motion_debounce, output, baseline):
+  recorded = recording.Recording(recording_dir)
+  print(f'Replaying {len(recorded.frames)} frame(s) and '
+        f'{len(recorded.events)} sensor event(s) over '
+        f'{recorded.duration():.1f} s')
+
+  backend = hardware.SimulatedHardware(simulate_camera=False)
+  player = recording.Replay(recorded, backend.GPIO, speed)
+  backend.VideoCapture = player.VideoCapture
+  run_best_integ.setup_hardware(backend)
+  controls = preview.ControlChannel()
+  bin_thread = threading.Thread(
+      target=run_best_integ.run,
+      args=(model, False, motion_debounce),
+      kwargs={'headless': True, 'controls': controls},
+      name='Bin', daemon=True)
+  bin_thread.start()
+  if not simulate_deposits.wait_until_ready(backend, _STARTUP_TIMEOUT):
+    sys.exit('ERROR: The bin did not start')
+
+  start_time = time.time()
+  player.start()
+  while not player.finished.wait(1):
+    if not bin_thread.is_alive():
+      sys.exit('ERROR: The bin stopped during the replay')
+  replay_time = time.time() - start_time
+  # Let the bin decide on the last item and put the chute back
+  time.sleep(run_best_integ.BURST_TIMEOUT)
+  run_best_integ.scheduler.wait_idle(_SETTLE_TIMEOUT)
+  controls.post(preview.CONTROL_KEYS['quit'])
+  bin_thread.join(_SETTLE_TIMEOUT)
+
+  decisions = _decisions(backend.log, start_time)
+  snapshot = metrics.registry.snapshot()
+  results = {
+      'settings': {
+          'model': model,
+          'recording': recording_dir,
+          'speed': speed,
+          'motion_debounce': motion_debounce,
+      },
+      'timestamp': time.time(),
+      'frames': len(recorded.frames),
+      'events': len(recorded.events),
+      'recorded_seconds': recorded.duration(),
+      'replay_seconds': replay_time,
+      'decisions': decisions,
+      'stages': snapshot['stages'],
+      'counters': snapshot['counters'],
+  }
+  print(f'{len(decisions)} decision(s) in {replay_time:.1f} s: '
+        f"{decisions.count('recycle')} recycle, "
+        f"{decisions.count('nonRecyclable')} nonRecyclable")
+
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {output}')
+
+  if baseline:
+    with open(baseline) as f:
+      expected = json.load(f)['decisions']
+    changed = sum(a != b for a, b in zip(decisions, expected))
+    changed += abs(len(decisions) - len(expected))
+    if changed:
+      print(f'REGRESSION: {changed} of {len(expected)} decision(s) differ '
+            'from the baseline')
+      sys.exit(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--recording',
+      help='Directory written by run_best_integ.py --record.',
+      required=True)
+  parser.add_argument(
+      '--model',
+      help='Name of image classification model.',
+      required=False,
+      default='default_model.tflite')
+  parser.add_argument(
+      '--speed',
+      help='Replay speed relative to the recording; 0 skips the quiet time '
+      'between sensor events.',
+      type=float,
+      required=False,
+      default=1.0)
+  parser.add_argument(
+      '--motionDebounce',
+      help='Seconds after a motion trigger during which new motion is ignored.',
+      type=float,
+      required=False,
+      default=run_best_integ.MOTION_DEBOUNCE)
+  parser.add_argument(
+      '--output',
+      help='JSON file the results are written to.',
+      required=False,
+      default='replay_results.json')
+  parser.add_argument(
+      '--baseline',
+      help='Previous results file; exit with an error if a decision differs.',
+      required=False,
+      default=None)
+  args = parser.parse_args()
+
+  run(args.model, args.recording, args.speed, args.motionDebounce, args.output,
+      args.baseline)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,35 +1,50 @@
 """Main script to run image classification."""
 
 import argparse
+import concurrent.futures
 import sys
 import time
 import threading
-import os
 import uuid
 
+# Taken before the heavy imports so the startup report includes them
+_IMPORT_START_TIME = time.time()
+
 import cv2
-from tflite_support.task import core
-from tflite_support.task import processor
-from tflite_support.task import vision
 
-from firebase_admin import credentials, initialize_app, storage
+import capture
+import cascade
+import dataset_writer
+import event_store
+import inference_service
+import metrics
+import model_manager
+import phash_cache
+import preview
+import startup
+import upload_spool
+
+# Challenged images are uploaded to this Firebase Storage bucket. The
+# connection is only made on the first upload.
+_CREDENTIALS_FILE = 'private.json'
+_STORAGE_BUCKET = 'smart-recycling-bin-bbcaa.appspot.com'
 
-cred = credentials.Certificate("private.json")
-initialize_app(cred, {'storageBucket': 'smart-recycling-bin-bbcaa.appspot.com'})
-bucket = storage.bucket()
 # Visualization parameters
 _ROW_SIZE = 20  # pixels
 _LEFT_MARGIN = 24  # pixels
 _TEXT_COLOR = (0, 0, 255)  # red
 _FONT_SIZE = 3
 _FONT_THICKNESS = 1
-_FPS_AVERAGE_FRAME_COUNT = 10
 _FRAME_WIDTH = 800
 _FRAME_HEIGHT = 800
 
 # Bin Parameters
 _UNLOCK_THRESHOLD = 0.6
 _TIME_FOR_CHALLENGING = 10
+# A challenge of an item that looks like one challenged within the window is
+# dropped before it is written or uploaded
+_CHALLENGE_DEDUP_WINDOW = 3600  # seconds
+_CHALLENGE_DEDUP_ENTRIES = 256
 time_of_last_classification = 0
 
 # Classification Model Parameters
@@ -37,76 +52,154 @@ _MAX_RESULTS = 3
 _SCORE_THRESHOLD = 0.20
 _NUM_THREADS = 4
 _CAMERA_ID = 0
-
-def run(model: str, save_images_on: bool) -> None:
-
-  model_path = f'./models/{model}'
-
-
-  # Initialize the image classification model
-  base_options = core.BaseOptions(
-      file_name=model_path, use_coral=False, num_threads=_NUM_THREADS)
-
-  # Enable Coral by this setting
-  classification_options = processor.ClassificationOptions(
-      max_results=_MAX_RESULTS, score_threshold=_SCORE_THRESHOLD)
-  options = vision.ImageClassifierOptions(
-      base_options=base_options, classification_options=classification_options)
-
-  classifier = vision.ImageClassifier.create_from_options(options)
-
-  # Variables to calculate FPS
-  counter, fps = 0, 0
-  start_time = time.time()
+_FRAME_TIMEOUT = 5  # seconds to wait for a new frame
+
+def run(model: str, save_images_on: bool, local_bucket: str = None,
+        headless: bool = False, preview_port: int = None,
+        timer: startup.StartupTimer = None,
+        metrics_file: str = None, cascade_model: str = None,
+        cascade_score: float = cascade.MIN_SCORE,
+        cascade_margin: float = cascade.MIN_MARGIN,
+        inference_socket: str = None, events_db: str = None) -> None:
+
+  if timer is None:
+    timer = startup.StartupTimer()
+  # The model loads and warms up on a worker thread while the camera starts
+  loader = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+  load_model = startup.load_model
+  inference_client = None
+  if inference_socket:
+    # The models are loaded once and run by the shared inference service
+    inference_client = inference_service.InferenceClient(inference_socket,
+                                                         'run')
+    load_model = inference_client.load_model
+  models = model_manager.ModelManager(model, _NUM_THREADS, _MAX_RESULTS,
+                                      _SCORE_THRESHOLD, load_model=load_model)
+  model_future = loader.submit(models.load, timer)
+  cascade_models = None
+  if cascade_model:
+    # The heavier model loads next to the main one and stays resident
+    cascade_models = model_manager.ModelManager(
+        cascade_model, _NUM_THREADS, _MAX_RESULTS, _SCORE_THRESHOLD,
+        load_model=load_model)
+    cascade_future = loader.submit(timer.timed, 'cascade model',
+                                   cascade_models.load)
+  loader.shutdown(wait=False)
+
+  # Frames per second are averaged by the metrics over the last minute
+  loop_time = time.time()
   time_of_last_classification = 0
 
-  # Start capturing video input from the camera
-  cap = cv2.VideoCapture(_CAMERA_ID)
-  cap.set(cv2.CAP_PROP_FRAME_WIDTH, _FRAME_WIDTH)
-  cap.set(cv2.CAP_PROP_FRAME_HEIGHT, _FRAME_HEIGHT)
-
-  last_challenged_image = None # quick fix for variable used before assignemt error
+  # Start capturing video input from the camera on a background thread
+  # The session keeps the device open for the whole run and only reconnects
+  # when reads actually fail.
+  session = capture.CameraSession(_CAMERA_ID, _FRAME_WIDTH, _FRAME_HEIGHT)
+  grabber = capture.FrameGrabber(session)
+  if not timer.timed('camera', grabber.start):
+    sys.exit(
+        'ERROR: Unable to read from webcam. Please verify your webcam settings.'
+    )
+  last_frame_time = 0
+
+  # Challenged images are uploaded by background workers
+  if local_bucket:
+    spool = upload_spool.UploadSpool(upload_spool.LocalBucket(local_bucket))
+  else:
+    spool = upload_spool.UploadSpool(
+        upload_spool.FirebaseBucket(_CREDENTIALS_FILE, _STORAGE_BUCKET))
+  spool.start()
+
+  dataset = dataset_writer.DatasetWriter() if save_images_on else None
+  # Every decided item is logged for throughput and accuracy reports
+  events = None
+  if events_db:
+    events = event_store.EventStore(events_db)
+    events.start()
+
+  # Without a monitor, keys come from the control channel and the camera can
+  # be watched through the local preview server
+  controls = preview.ControlChannel()
+  preview_server = None
+  if preview_port:
+    preview_server = preview.PreviewServer(preview_port, controls,
+                                            models=models)
+    preview_server.start()
+
+  model_future.result()
+  if cascade_models:
+    cascade_future.result()
+  classifier = cascade.Cascade(models, cascade_models, cascade_score,
+                               cascade_margin)
+  if metrics_file:
+    metrics.registry.start_dump(metrics_file)
+  # Retrained models are swapped in without a restart
+  models.watch()
+  timer.report()
+
+  # Near-duplicate frames of the same item reuse its recent result
+  results_cache = phash_cache.PerceptualCache()
+  challenged = phash_cache.PerceptualCache(_CHALLENGE_DEDUP_ENTRIES,
+                                           _CHALLENGE_DEDUP_WINDOW)
   # Continuously capture images from the camera and run inference
-  while cap.isOpened():
-    success, image = cap.read()
-    if not success:
+  while grabber.is_running():
+    frame = grabber.wait_for_frame(last_frame_time, timeout=_FRAME_TIMEOUT)
+    if frame is None:
+      if grabber.is_running():
+        continue  # The camera session is reconnecting
       sys.exit(
           'ERROR: Unable to read from webcam. Please verify your webcam settings.'
       )
-    key_press = cv2.waitKey(2)
+    last_frame_time = frame.timestamp
+    image = frame.image
+    # Text is drawn on a copy, the frame is saved and uploaded without it
+    display = None if headless else image.copy()
+    key_press = -1 if headless else cv2.waitKey(2)
+    if key_press == -1:
+      key_press = controls.read_key()
 
     # Only classify the image when spacebar is pressed
     if key_press == 32: # Spacebar code
-      counter += 1
-      image = cv2.flip(image, 1)
-      # Convert the image from BGR to RGB as required by the TFLite model.
-      rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-      # Create TensorImage from the RGB image
-      tensor_image = vision.TensorImage.create_from_array(rgb_image)
-      # List classification results
-      categories = classifier.classify(tensor_image)
+      metrics.increment('items')
+      c_time = time.time()
+      # Frames wait in the grabber, so this is how old the classified one is
+      metrics.observe('capture', c_time - frame.timestamp)
+      stages = classifier.stages()
+      with metrics.timed('hash'):
+        image_hash = phash_cache.dhash(image)
+      # Results are only reused from the models that are active now
+      model_tag = classifier.tag(stages)
+      cached = results_cache.get(image_hash, model_tag)
+      if cached is None:
+        # The main model classifies, the cascade model only when it is unsure
+        categories, decided_by = classifier.classify(image, stages)
+        results_cache.put(image_hash, (categories, decided_by), model_tag)
+      else:
+        categories, decided_by = cached
+        metrics.increment('cache_hits')
 
-      best_guess = max(categories.classifications[0].categories, key=lambda x:x.score)
+      best_guess = max(categories, key=lambda x:x.score)
       category_name = best_guess.category_name
       score = best_guess.score
 
       last_classified_image = image
+      last_classified_hash = image_hash
       last_classified_image_category = category_name
       time_of_last_classification = time.time()
 
       result_text = category_name + ' (' + str(score) + ')'
-      cv2.putText(image, result_text, text_location, cv2.FONT_HERSHEY_PLAIN,
-          _FONT_SIZE, _TEXT_COLOR, _FONT_THICKNESS)
+      if not headless:
+        cv2.putText(display, result_text, text_location, cv2.FONT_HERSHEY_PLAIN,
+            _FONT_SIZE, _TEXT_COLOR, _FONT_THICKNESS)
+
+      decision_time = time.time() - c_time
+      metrics.observe('decision', decision_time)
+      image_path = None
 
       # Decide to unlock or not
       if("nonRecyclable" not in category_name and score > _UNLOCK_THRESHOLD):
-        cap.release()
-        cap = cv2.VideoCapture(_CAMERA_ID)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, _FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, _FRAME_HEIGHT)
+        decision = 'recycle'
         if(save_images_on):
-          write_out_image_to_classified_directory(image, category_name)
+          image_path = write_out_image_to_classified_directory(image, category_name, score, dataset)
         print("UNLOCKED")
         print(f"You are recycling {category_name} ({score * 100}% confidence) \
               \nIf this is incorrect, please press 'c' to submit the incorrect labelling for review")
@@ -114,8 +207,16 @@ def run(model: str, save_images_on: bool) -> None:
         print("LOCKED")
       else:
         category_name = "nonRecyclable"
+        decision = category_name
         print("NOT RECYCLEABLE. If this is incorrect, press the challenge button (c)")
         time.sleep(1)
+      if events:
+        ranking = [(c.category_name, c.score) for c in
+                   sorted(categories, key=lambda c: c.score, reverse=True)]
+        last_item_id = events.record_item(
+            ranking, decision, decided_by.name, image_path,
+            {'capture': c_time - frame.timestamp, 'decision': decision_time},
+            time_of_last_classification)
       
     # Challenge the classification (save it to directory, and upload it to Firestore)
     elif key_press == ord('c'):
@@ -124,55 +225,73 @@ def run(model: str, save_images_on: bool) -> None:
 
       if ellapsed_time > _TIME_FOR_CHALLENGING:
         print("Time ran out of time to challenge the item. Try classifying again, then challenge.")
-      elif last_classified_image is last_challenged_image:
-        print("Can not challenge the same image twice")
+      elif challenged.get(last_classified_hash) is not None:
+        print("This item was already challenged")
+        metrics.increment('duplicate_challenges')
       else:
-          upload_to_fireStoreDB(last_classified_image, last_classified_image_category, storage)
-          last_challenged_image = last_classified_image
+          path = upload_to_fireStoreDB(last_classified_image, last_classified_image_category, spool)
+          challenged.put(last_classified_hash, True)
+          if events:
+            events.record_challenge(last_item_id, path)
       
     # Stop the program if the ESC key is pressed.
     elif key_press == 27:
       break
     # Calculate the FPS
-    if counter % _FPS_AVERAGE_FRAME_COUNT == 0:
-      end_time = time.time()
-      fps = _FPS_AVERAGE_FRAME_COUNT / (end_time - start_time)
-      start_time = time.time()
+    metrics.observe('loop', time.time() - loop_time)
+    loop_time = time.time()
+    fps = metrics.rate('loop')
 
     # Show the FPS
-    fps_text = 'FPS = ' + str(int(fps))
-    text_location = (_LEFT_MARGIN, _ROW_SIZE)
-    cv2.putText(image, fps_text, text_location, cv2.FONT_HERSHEY_PLAIN,
-                _FONT_SIZE, _TEXT_COLOR, _FONT_THICKNESS)
-
-    cv2.imshow('image_classification', image)
-
-  cap.release()
-  cv2.destroyAllWindows()
-
-def upload_to_fireStoreDB(image, category, storage):
-  print("Uploading Challenged Image to Database")
+    if not headless:
+      fps_text = 'FPS = ' + str(int(fps))
+      text_location = (_LEFT_MARGIN, _ROW_SIZE)
+      cv2.putText(display, fps_text, text_location, cv2.FONT_HERSHEY_PLAIN,
+                  _FONT_SIZE, _TEXT_COLOR, _FONT_THICKNESS)
+      cv2.imshow('image_classification', display)
+    if preview_server:
+      preview_server.publish(image if display is None else display)
+
+  grabber.stop()
+  if metrics_file:
+    metrics.registry.stop()
+    metrics.registry.dump(metrics_file)
+  models.stop()
+  if cascade_models:
+    cascade_models.stop()
+  if inference_client:
+    inference_client.close()
+  spool.stop()
+  if dataset:
+    dataset.close()
+  if events:
+    events.close()
+  if preview_server:
+    preview_server.stop()
+  if not headless:
+    cv2.destroyAllWindows()
+
+def upload_to_fireStoreDB(image, category, spool):
+  print("Queueing Challenged Image for upload to Database")
   image_name = str(uuid.uuid4()) + ".jpg"
 
   path = f'challenged_images/{category}/{image_name}'
 
-  if not os.path.isdir(f'challenged_images/{category}/'): # Automatically create a new directory for novel categories
-    os.mkdir(f'challenged_images/{category}/')
-
-  cv2.imwrite(path, image)
-  blob = bucket.blob(path)
-  blob.upload_from_filename(path)
-  print("Image sucessfully uploaded to DB")
-
-def write_out_image_to_classified_directory(image, category):
-  path = f'./classified_images/{category}/'
-  if not os.path.isdir(path):
-    os.mkdir(path)
-    name = '0.jpg'
-  else:
-    name = str(len(os.listdir(path))) + ".jpg"
-  print(f'saving image named {name}, to {path}')
-  cv2.imwrite(os.path.join(path , name), image)
+  # The image is encoded, kept locally and uploaded in the background, so
+  # neither the disk nor a slow or offline uplink freezes the bin, and the
+  # challenge is not lost. Directories of novel categories are created there.
+  # Mirrored like the frames the model classifies, as it always was
+  spool.enqueue_image(cv2.flip(image, 1), path, path)
+  return path
+
+def write_out_image_to_classified_directory(image, category, score, writer):
+  # Naming, encoding and the disk write happen on the writer's thread pool.
+  # Mirrored like the frames the model classifies, as it always was; the
+  # flip makes the copy the writer takes ownership of.
+  path = writer.save(cv2.flip(image, 1), category, score)
+  if path:
+    print(f'saving image to {path}')
+  return path
 
 def main():
 
@@ -189,9 +308,64 @@ def main():
     action='store_true',
     required=False,
     default=False)
+  parser.add_argument(
+    '--localBucket',
+    help='Upload challenged images to this local directory instead of Firebase Storage',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--headless',
+    help='Run without a display window; keys are sent through the preview server',
+    action='store_true',
+    required=False,
+    default=False)
+  parser.add_argument(
+    '--previewPort',
+    help='Serve a low-rate MJPEG preview and controls on this local port',
+    type=int,
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--metricsFile',
+    help='Periodically write the stage latencies to this JSON file',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--cascadeModel',
+    help='Heavier model that classifies the items the main model is unsure about',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--cascadeScore',
+    help='Top score of the main model below which the cascade model is asked',
+    type=float,
+    required=False,
+    default=cascade.MIN_SCORE)
+  parser.add_argument(
+    '--cascadeMargin',
+    help='Gap between the two top scores below which the cascade model is asked',
+    type=float,
+    required=False,
+    default=cascade.MIN_MARGIN)
+  parser.add_argument(
+    '--inferenceSocket',
+    help='Classify through the inference service listening on this socket',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--eventsDb',
+    help='Log every classified item to this SQLite database, e.g. events.db',
+    required=False,
+    default=None)
   args = parser.parse_args()
 
-  run(args.model, bool(args.saveImages))
+  timer = startup.StartupTimer(_IMPORT_START_TIME)
+  timer.record('imports', _IMPORT_START_TIME)
+
+  run(args.model, bool(args.saveImages), args.localBucket,
+      bool(args.headless), args.previewPort, timer,
+      args.metricsFile, args.cascadeModel, args.cascadeScore,
+      args.cascadeMargin, args.inferenceSocket, args.eventsDb)
 
 if __name__ == '__main__':
   main()
@@ -6,22 +6,33 @@
 # Date: 3/8/2024 
 
 import argparse
+import concurrent.futures
 import sys
 import time
 import threading
-import os
-import uuid
+
+# Taken before the heavy imports so the startup report includes them
+_IMPORT_START_TIME = time.time()
+
 import cv2
-from tflite_support.task import core
-from tflite_support.task import processor
-from tflite_support.task import vision
-from firebase_admin import credentials, initialize_app, storage
-import RPi.GPIO as GPIO
-from gpiozero import Servo
-from gpiozero import AngularServo
-from rpi_ws281x import PixelStrip, Color
 
-GPIO.setmode(GPIO.BCM)
+import actuators
+import burst
+import capacity
+import capture
+import cascade
+import dataset_writer
+import event_store
+import hardware
+import inference_service
+import leds
+import metrics
+import model_manager
+import motion
+import phash_cache
+import preview
+import recording
+import startup
 
 # Sensor/Actuator Pins
 PIR = 4
@@ -29,6 +40,7 @@ BEAM_PIN1 = 5
 BEAM_PIN2 = 6
 BEAM_PIN3 = 13
 BEAM_PIN4 = 16
+BEAM_PINS = (BEAM_PIN1, BEAM_PIN2, BEAM_PIN3, BEAM_PIN4)
 CHOOSE_PIN = 17
 LOCK_PIN = 24
 LED_PIN = 18
@@ -40,105 +52,156 @@ LED_DMA = 10          # DMA channel to use for generating signal (try 10)
 LED_BRIGHTNESS = 200  # Set to 0 for darkest and 255 for brightest
 LED_INVERT = False    # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
+STATUS_LED_COUNT = 8  # Pixels of the status/capacity stick at the strip's end
+
+# Servo Configuration
+maxPW1 = (2.3) / 1000
+minPW1 = (0.5) / 1000
+buff2 = 0.6
+maxPW2 = (1.0 + buff2) / 1000
+minPW2 = (1.0 - buff2) / 1000
 
-# Declare & Intialize LED Strip
-LED = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
-LED.begin()
+# Devices, created on a real or simulated backend by setup_hardware()
+backend = None
+GPIO = None
+Color = None
+LED = None
+compositor = None
+chooseServo = None
+lockServo = None
+scheduler = None
+capacity_monitor = None
+
+# Motion Sensor Events
+# Rising edges of the PIR are queued from the GPIO callback thread, so the
+# main loop sleeps until motion is detected instead of polling the pin.
+motion_events = motion.MotionEvents()
+
+
+def setup_hardware(hardware_backend):
+  """Creates the bin's devices on `hardware_backend` and homes the servos."""
+  global backend, GPIO, Color, LED, compositor, chooseServo, lockServo, scheduler
+  global capacity_monitor
+  backend = hardware_backend
+  GPIO = backend.GPIO
+  Color = backend.Color
+  GPIO.setmode(GPIO.BCM)
+
+  # Declare & Intialize LED Strip
+  LED = backend.PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA,
+                           LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
+  LED.begin()
+  # The first stick lights the camera, the second shows the bin's status
+  compositor = leds.LedCompositor(LED, {
+      'camera': range(0, LED_COUNT - STATUS_LED_COUNT),
+      'status': range(LED_COUNT - STATUS_LED_COUNT, LED_COUNT)})
+  compositor.start()
+
+  chooseServo = backend.AngularServo(
+      CHOOSE_PIN, min_angle=0, max_angle=250, min_pulse_width=minPW1,
+      max_pulse_width=maxPW1)
+  lockServo = backend.Servo(
+      LOCK_PIN, min_pulse_width=minPW2, max_pulse_width=maxPW2)
+
+  # Servo motions run on their own thread so the vision loop keeps running
+  # while the chute and the lock move.
+  scheduler = actuators.ActuatorScheduler()
+
+  # Home both servos, then stop driving them
+  scheduler.submit('home', [
+      (0, lambda: setattr(chooseServo, 'angle', 125)),
+      (0, lockServo.max),
+      (1.5, lambda: detach(chooseServo)),
+      (0, lambda: detach(lockServo))])
+
+  motion.watch_pir(motion_events, GPIO, PIR)
+
+  # Break Beam Intialization
+  for pin in BEAM_PINS:
+    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  # The beams are debounced on the monitor's thread; a full bin is locked
+  # through the scheduler and stays locked until it is reset with the 'r'
+  # control after emptying
+  capacity_monitor = capacity.CapacityMonitor(
+      GPIO, BEAM_PINS, on_full=lambda: lock(255),
+      on_level=lambda level: show_status())
+  capacity_monitor.start()
 
 
 #LED Functions
+# These only change the compositor's frame buffer; its render thread sends
+# the pixels to the strip when they changed.
 def fill_color1(color):
-    for i in range(8, LED.numPixels()):
-        LED.setPixelColor(i, color)
-    LED.show()
+    compositor.fill('status', color)
     
 def fill_color2(color):
-    for i in range(LED.numPixels()-8):
-        LED.setPixelColor(i, color)
-    LED.show()
+    compositor.fill('camera', color)
     
 def clearLEDs():
-  fill_color1(Color(0,0,0))
-  fill_color2(Color(0,0,0))
+  compositor.clear()
+  compositor.flush()
 
+def show_status():
+  # The status stick shows the fill level as a bar, or pulses red when full
+  if capacity_monitor.full:
+    compositor.animate('status', leds.pulse(Color(255,0,0)))
+  else:
+    compositor.set_pixels('status', leds.bar(
+        capacity_monitor.level(), Color(0,0,255), STATUS_LED_COUNT))
 
-# Servo Configuration & Intialization  
-maxPW1 = (2.3) / 1000
-minPW1 = (0.5) / 1000
-buff2 = 0.6
-maxPW2 = (1.0 + buff2) / 1000
-minPW2 = (1.0 - buff2) / 1000
-chooseServo = AngularServo(17, min_angle = 0, max_angle = 250, min_pulse_width=minPW1, max_pulse_width=maxPW1)
-chooseServo.angle = 125
-lockServo = Servo(LOCK_PIN, min_pulse_width=minPW2, max_pulse_width=maxPW2)
-lockServo.max()
-time.sleep(1.5)
-chooseServo.value = None
-lockServo.value = None
-
-# Motion Sensor Initialization
-GPIO.setup(PIR, GPIO.IN)
-last_motion_time = 0
-
-# Motion Sensor Functions
-
-def motion_callback(channel):
-    global last_motion_time
-    current_time = time.time()
-    # Check if enough time has passed since the last motion detection
-    if (current_time - last_motion_time) > 8 and GPIO.input(channel):
-      # Record the time of the latest motion detection
-      last_motion_time = current_time
-      return True
-    else:
-      return False
+
+# Counts the results shown, so a timer never clears a newer result
+results_shown = 0
+
+def clear_result_later(sorting):
+  # Shows the fill level again a second after the chute is back in place.
+  # A timer does this rather than the actuator queue, so the next item is
+  # accepted as soon as the chute is free.
+  global results_shown
+  results_shown += 1
+  shown = results_shown
+
+  def clear():
+    if results_shown == shown:
+      show_status()
+
+  def start_timer(_):
+    timer = threading.Timer(_RESULT_DISPLAY_TIME, clear)
+    timer.daemon = True
+    timer.start()
+
+  sorting.add_done_callback(start_timer)
+
+
+def detach(servo):
+    servo.value = None
+
+# Actuator Functions
+# Each returns a future that resolves once the motion finished.
 
 def lock(x):
-    lockServo.min()
-    time.sleep(2)
-    lockServo.value = None
-    fill_color1(Color(x,0,0))
+    return scheduler.submit('lock', [
+        (0, lockServo.min),
+        (2, lambda: detach(lockServo)),
+        (0, lambda: compositor.animate('status', leds.pulse(Color(x,0,0))))])
 
-    
 def unlock():
-    lockServo.max()
-    time.sleep(2)
-    lockServo.value = None
-    fill_color1(Color(0,0,0))
-    
+    return scheduler.submit('unlock', [
+        (0, lockServo.max),
+        (2, lambda: detach(lockServo)),
+        (0, show_status)])
+
 def toggle(cat):
     if cat == 'recycle':
-      chooseServo.angle = 70
-      time.sleep(2)
-      chooseServo.angle = 120
-      time.sleep(1)
-      chooseServo.value = None
+      angle = 70
     elif cat == 'nonRecyclable':
-        chooseServo.angle = 200
-        time.sleep(2)
-        chooseServo.angle = 120
-        time.sleep(1)
-        chooseServo.value = None
-        
-def breakbeam_callback(channel):
-  time.sleep(10)
-  if not GPIO.input(channel):
-    lock(255)
-
-# Break Beam Intialization        
-GPIO.setup(BEAM_PIN1, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(BEAM_PIN2, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(BEAM_PIN3, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(BEAM_PIN4, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-GPIO.add_event_detect(BEAM_PIN1, GPIO.FALLING, callback=breakbeam_callback)
-#GPIO.add_event_detect(BEAM_PIN2, GPIO.FALLING, callback=breakbeam_callback)
-GPIO.add_event_detect(BEAM_PIN3, GPIO.FALLING, callback=breakbeam_callback)
-#GPIO.add_event_detect(BEAM_PIN4, GPIO.FALLING, callback=breakbeam_callback)
-
-cred = credentials.Certificate("private.json")
-initialize_app(cred, {'storageBucket': 'smart-recycling-bin-bbcaa.appspot.com'})
-bucket = storage.bucket()
+      angle = 200
+    else:
+      return None
+    return scheduler.submit('toggle_' + cat, [
+        (0, lambda: setattr(chooseServo, 'angle', angle)),
+        (2, lambda: setattr(chooseServo, 'angle', 120)),
+        (1, lambda: detach(chooseServo))])
 
 # Visualization parameters
 _ROW_SIZE = 20  # pixels
@@ -146,13 +209,17 @@ _LEFT_MARGIN = 24  # pixels
 _TEXT_COLOR = (0, 0, 255)  # red
 _FONT_SIZE = 3
 _FONT_THICKNESS = 1
-_FPS_AVERAGE_FRAME_COUNT = 10
 _FRAME_WIDTH = 800
 _FRAME_HEIGHT = 800
 
 # Bin Parameters
 _UNLOCK_THRESHOLD = 0.5
 _TIME_FOR_CHALLENGING = 10
+_RESULT_DISPLAY_TIME = 1  # seconds the result LEDs stay on after sorting
+MOTION_DEBOUNCE = 8  # seconds after a motion trigger to ignore new motion
+# Area in front of the chute watched by the camera trigger, as (x, y, width,
+# height) fractions of the frame
+_TRIGGER_REGION = (0.25, 0.25, 0.5, 0.5)
 time_of_last_classification = 0
 
 # Classification Model Parameters
@@ -160,123 +227,270 @@ _MAX_RESULTS = 3
 _SCORE_THRESHOLD = 0.2
 _NUM_THREADS = 4
 _CAMERA_ID = 0
+_FRAME_TIMEOUT = 5  # seconds to wait for a new frame
+_PREVIEW_INTERVAL = 0.1  # seconds between preview refreshes while idle
+_HEADLESS_INTERVAL = 1  # seconds between control checks with no preview
+
+# Burst Classification Parameters
+_BURST_MIN_FRAMES = 2  # frames averaged before deciding early
+_BURST_MAX_FRAMES = 8  # frames classified at most per item
+BURST_TIMEOUT = 6  # seconds after motion to decide with what was seen
+
+def run(model: str, save_images_on: bool, motion_debounce: float = MOTION_DEBOUNCE,
+        vision_trigger: bool = False, headless: bool = False,
+        preview_port: int = None,
+        controls: preview.ControlChannel = None,
+        timer: startup.StartupTimer = None,
+        metrics_file: str = None, record_dir: str = None,
+        cascade_model: str = None,
+        cascade_score: float = cascade.MIN_SCORE,
+        cascade_margin: float = cascade.MIN_MARGIN,
+        inference_socket: str = None, events_db: str = None) -> None:
+
+  if timer is None:
+    timer = startup.StartupTimer()
+  # The model loads and warms up on a worker thread while the camera starts
+  loader = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+  load_model = startup.load_model
+  inference_client = None
+  if inference_socket:
+    # The models are loaded once and run by the shared inference service
+    inference_client = inference_service.InferenceClient(inference_socket,
+                                                         'run_best_integ')
+    load_model = inference_client.load_model
+  models = model_manager.ModelManager(model, _NUM_THREADS, _MAX_RESULTS,
+                                      _SCORE_THRESHOLD, load_model=load_model)
+  model_future = loader.submit(models.load, timer)
+  cascade_models = None
+  if cascade_model:
+    # The heavier model loads next to the main one and stays resident
+    cascade_models = model_manager.ModelManager(
+        cascade_model, _NUM_THREADS, _MAX_RESULTS, _SCORE_THRESHOLD,
+        load_model=load_model)
+    cascade_future = loader.submit(timer.timed, 'cascade model',
+                                   cascade_models.load)
+  # The servos home on the scheduler thread
+  homing_future = loader.submit(timer.timed, 'homing', scheduler.wait_idle)
+  loader.shutdown(wait=False)
 
-def run(model: str, save_images_on: bool) -> None:
-
-  model_path = f'./models/{model}'
-
-
-  # Initialize the image classification model
-  base_options = core.BaseOptions(
-      file_name=model_path, use_coral=False, num_threads=_NUM_THREADS)
-
-  # Enable Coral by this setting
-  classification_options = processor.ClassificationOptions(
-      max_results=_MAX_RESULTS, score_threshold=_SCORE_THRESHOLD)
-  options = vision.ImageClassifierOptions(
-      base_options=base_options, classification_options=classification_options)
-
-  classifier = vision.ImageClassifier.create_from_options(options)
-
-  # Variables to calculate FPS
-  counter, fps = 0, 0
-  start_time = time.time()
   time_of_last_classification = [0,1]
 
-  # Start capturing video input from the camera
-  cap = cv2.VideoCapture(_CAMERA_ID)
-  cap.set(cv2.CAP_PROP_FRAME_WIDTH, _FRAME_WIDTH)
-  cap.set(cv2.CAP_PROP_FRAME_HEIGHT, _FRAME_HEIGHT)
+  # Start capturing video input from the camera on a background thread
+  # The session keeps the device open for the whole run and only reconnects
+  # when reads actually fail.
+  session = capture.CameraSession(_CAMERA_ID, _FRAME_WIDTH, _FRAME_HEIGHT,
+                                  capture_factory=backend.VideoCapture)
+  grabber = capture.FrameGrabber(session)
+  if vision_trigger:
+    # Watch the chute on every captured frame, next to the PIR
+    grabber.add_listener(motion.VisionTrigger(motion_events, _TRIGGER_REGION))
+  recorder = None
+  if record_dir:
+    # Frames and sensor edges are written for replay.py
+    recorder = recording.Recorder(record_dir)
+    grabber.add_listener(recorder.add_frame)
+    recorder.watch(GPIO, PIR, GPIO.RISING)
+    for pin in BEAM_PINS:
+      recorder.watch(GPIO, pin, GPIO.BOTH)
+  if not timer.timed('camera', grabber.start):
+    sys.exit(
+        'ERROR: Unable to read from webcam. Please verify your webcam settings.'
+    )
+
+  dataset = dataset_writer.DatasetWriter() if save_images_on else None
+  # Every decided item is logged for throughput and accuracy reports
+  events = None
+  if events_db:
+    events = event_store.EventStore(events_db)
+    events.start()
+  motion_events.debounce = motion_debounce
+  pending_motion = None
+
+  # Without a monitor, keys come from the control channel and the camera can
+  # be watched through the local preview server
+  if controls is None:
+    controls = preview.ControlChannel()
+  preview_server = None
+  if preview_port:
+    preview_server = preview.PreviewServer(preview_port, controls,
+                                            models=models)
+    preview_server.start()
+  if headless and not preview_server:
+    idle_interval = _HEADLESS_INTERVAL
+  else:
+    idle_interval = _PREVIEW_INTERVAL
+
+  model_future.result()
+  if cascade_models:
+    cascade_future.result()
+  classifier = cascade.Cascade(models, cascade_models, cascade_score,
+                               cascade_margin)
+  if metrics_file:
+    metrics.registry.start_dump(metrics_file)
+  # Retrained models are swapped in without a restart
+  models.watch()
+  homing_future.result()
+  timer.report()
 
   last_challenged_image = None # fix for variable used before assignemt error
+  # An item whose first frame looks like a recent item's, e.g. the same item
+  # again or an empty chute, starts from that result instead of running the
+  # model on it
+  results_cache = phash_cache.PerceptualCache()
   
+  # Light the camera while the bin runs
+  fill_color2(Color(255,100,25))
   # Continuously capture images from the camera and run inference
-  while cap.isOpened():
-    fill_color2(Color(255,100,25))
-    success, image = cap.read()
-    if not success:
-      sys.exit(
-          'ERROR: Unable to read from webcam. Please verify your webcam settings.'
-      )
-    key_press = cv2.waitKey(1)
-    if motion_callback(PIR):
+  while grabber.is_running():
+    # Sleep until motion is detected, waking up only to refresh the preview
+    if pending_motion is None:
+      pending_motion = motion_events.wait(timeout=idle_interval)
+    else:
+      scheduler.wait_idle(timeout=idle_interval)
+    frame = grabber.latest()
+    if frame is None:
+      continue  # No frame captured yet, or the camera is reconnecting
+    image = frame.image
+    key_press = -1 if headless else cv2.waitKey(1)
+    if key_press == -1:
+      key_press = controls.read_key()
+    # Stop the program if the ESC key is pressed.
+    if key_press == 27:
+      break
+    # A full bin is only unlocked by hand, once it was emptied
+    if (key_press == preview.CONTROL_KEYS['reset'] and
+        capacity_monitor.reset()):
+      unlock()
+    # Only accept a new item once the chute is physically free
+    if pending_motion is not None and scheduler.is_idle():
+      motion_time = pending_motion.timestamp
+      pending_motion = None
+      # Drop frames queued before the motion, then classify every new frame
+      # until the averaged scores are confident enough or the frame budget
+      # runs out.
       c_time = time.time()
-      image = None
-      while time.time() < (c_time + 6):
-        success, image = cap.read()
-        pass
-      success, image = cap.read()  
-      counter += 1
-      image = cv2.flip(image, 1)
-      # Convert the image from BGR to RGB as required by the TFLite model.
-      rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-      # Create TensorImage from the RGB image
-      tensor_image = vision.TensorImage.create_from_array(rgb_image)
-      # List classification results
-      categories = classifier.classify(tensor_image)
-      best_guess = max(categories.classifications[0].categories, key=lambda x:x.score)
-      category_name = best_guess.category_name
-      score = best_guess.score
+      grabber.flush()
+      frame_time = c_time
+      deadline = c_time + BURST_TIMEOUT
+      # Every frame of the item is classified by the same models
+      stages = classifier.stages()
+      # Results are only reused from the models that are active now
+      model_tag = classifier.tag(stages)
+      classifications = burst.BurstClassifier(
+          _UNLOCK_THRESHOLD, _BURST_MAX_FRAMES, _BURST_MIN_FRAMES)
+      while not classifications.done and time.time() < deadline:
+        frame = grabber.wait_for_frame(frame_time, timeout=deadline - time.time())
+        if frame is None:
+          break
+        frame_time = frame.timestamp
+        metrics.observe('capture', time.time() - frame.timestamp)
+        # The frames of one burst all show the same item, so only its first
+        # frame is compared with earlier items. Later frames are always
+        # classified, or the burst would average one result with itself.
+        first_frame = not classifications.frames
+        cached = None
+        if first_frame:
+          with metrics.timed('hash'):
+            image_hash = phash_cache.dhash(frame.image)
+          cached = results_cache.get(image_hash, model_tag)
+        if cached is None:
+          # The main model classifies, the cascade model only when it is
+          # unsure
+          categories, decided_by = classifier.classify(frame.image, stages)
+          if first_frame:
+            results_cache.put(image_hash, (categories, decided_by), model_tag)
+        else:
+          categories, decided_by = cached
+          metrics.increment('cache_hits')
+        if stages[1] is not None:
+          # Scores of different models can't be averaged, so the model that
+          # decided the first frame classifies the rest of the item
+          stages = (decided_by, None)
+          model_tag = classifier.tag(stages)
+        classifications.add(categories, frame.image)
+      category_name, score, image = classifications.result()
+      if image is None:
+        if grabber.is_running():
+          continue  # The camera session is reconnecting
+        sys.exit(
+            'ERROR: Unable to read from webcam. Please verify your webcam settings.'
+        )
+      metrics.increment('items')
+      classify_time = time.time() - c_time
 
       last_classified_image = image
       last_classified_image_category = category_name
       time_of_last_classification = time.time()
       result_text = category_name + ' (' + str(score) + ')'
-      print(result_text)
-      cv2.imshow('image_classification', image)
+      print(f'{result_text} after {classifications.frames} frame(s) in '
+            f'{time.time() - c_time:.2f} s')
+      if not headless:
+        cv2.imshow('image_classification', image)
+
+      # Time from the motion trigger, including waiting for the chute
+      decision_time = time.time() - motion_time
+      metrics.observe('decision', decision_time)
+      image_path = None
 
       # Decide to unlock or not
       if("nonRecyclable" not in category_name and score > _UNLOCK_THRESHOLD):
-        cap.release()
-        cap = cv2.VideoCapture(_CAMERA_ID)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, _FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, _FRAME_HEIGHT)
+        decision = 'recycle'
         fill_color1(Color(0,255,0))
-        toggle('recycle')
+        sorting = toggle('recycle')
         if(save_images_on):
-          write_out_image_to_classified_directory(image, category_name)
+          image_path = write_out_image_to_classified_directory(image, category_name, score, dataset)
       else:
         category_name = "nonRecyclable"
+        decision = category_name
         fill_color1(Color(255,40,0))
-        toggle(category_name)
-      time.sleep(1)
-      fill_color1(Color(0,0,0))
-      
-    # Calculate the FPS
-    if counter % _FPS_AVERAGE_FRAME_COUNT == 0:
-      end_time = time.time()
-      fps = _FPS_AVERAGE_FRAME_COUNT / (end_time - start_time)
-      start_time = time.time()
+        sorting = toggle(category_name)
+      if events:
+        events.record_item(
+            classifications.ranking(_MAX_RESULTS), decision, decided_by.name,
+            image_path,
+            {'classify': classify_time, 'decision': decision_time},
+            time_of_last_classification)
+      clear_result_later(sorting)
       
-    cv2.imshow('image_classification', image)
+    if not headless:
+      cv2.imshow('image_classification', image)
+    if preview_server:
+      preview_server.publish(image)
     
     
-  cap.release()
-  cv2.destroyAllWindows()
-
-def upload_to_fireStoreDB(image, category, storage):
-  print("Uploading Challenged Image to Database")
-  image_name = str(uuid.uuid4()) + ".jpg"
-
-  path = f'challenged_images/{category}/{image_name}'
-
-  if not os.path.isdir(f'challenged_images/{category}/'): # Automatically create a new directory for novel categories
-    os.mkdir(f'challenged_images/{category}/')
-
-  cv2.imwrite(path, image)
-  blob = bucket.blob(path)
-  blob.upload_from_filename(path)
-  print("Image sucessfully uploaded to DB")
-
-def write_out_image_to_classified_directory(image, category):
-  path = f'./classified_images/{category}/'
-  if not os.path.isdir(path):
-    os.mkdir(path)
-    name = '0.jpg'
-  else:
-    name = str(len(os.listdir(path))) + ".jpg"
-  print(f'saving image named {name}, to {path}')
-  cv2.imwrite(os.path.join(path , name), image)
+  grabber.stop()
+  if recorder:
+    recorder.close()
+    print(f'Recorded {recorder.frames} frame(s) to {record_dir}')
+  if metrics_file:
+    metrics.registry.stop()
+    metrics.registry.dump(metrics_file)
+  models.stop()
+  if cascade_models:
+    cascade_models.stop()
+  if inference_client:
+    inference_client.close()
+  if dataset:
+    dataset.close()
+  if events:
+    events.close()
+  if preview_server:
+    preview_server.stop()
+  if not headless:
+    cv2.destroyAllWindows()
+  if grabber.failed:
+    sys.exit(
+        'ERROR: Unable to read from webcam. Please verify your webcam settings.'
+    )
+
+def write_out_image_to_classified_directory(image, category, score, writer):
+  # Naming, encoding and the disk write happen on the writer's thread pool.
+  # Mirrored like the frames the model classifies, as it always was; the
+  # flip makes the copy the writer takes ownership of.
+  path = writer.save(cv2.flip(image, 1), category, score)
+  if path:
+    print(f'saving image to {path}')
+  return path
 
 def main():
 
@@ -293,15 +507,93 @@ def main():
     action='store_true',
     required=False,
     default=False)
+  parser.add_argument(
+    '--motionDebounce',
+    help='Seconds after a motion trigger during which new motion is ignored',
+    type=float,
+    required=False,
+    default=MOTION_DEBOUNCE)
+  parser.add_argument(
+    '--visionTrigger',
+    help='Also trigger classification when the camera sees a still object in front of the chute',
+    action='store_true',
+    required=False,
+    default=False)
+  parser.add_argument(
+    '--headless',
+    help='Run without a display window; keys are sent through the preview server',
+    action='store_true',
+    required=False,
+    default=False)
+  parser.add_argument(
+    '--previewPort',
+    help='Serve a low-rate MJPEG preview and controls on this local port',
+    type=int,
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--simulate',
+    help='Use simulated GPIO, servos and LEDs instead of the Raspberry Pi hardware',
+    action='store_true',
+    required=False,
+    default=False)
+  parser.add_argument(
+    '--metricsFile',
+    help='Periodically write the stage latencies to this JSON file',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--record',
+    help='Record camera frames and sensor events to this directory for replay.py',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--cascadeModel',
+    help='Heavier model that classifies the items the main model is unsure about',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--cascadeScore',
+    help='Top score of the main model below which the cascade model is asked',
+    type=float,
+    required=False,
+    default=cascade.MIN_SCORE)
+  parser.add_argument(
+    '--cascadeMargin',
+    help='Gap between the two top scores below which the cascade model is asked',
+    type=float,
+    required=False,
+    default=cascade.MIN_MARGIN)
+  parser.add_argument(
+    '--inferenceSocket',
+    help='Classify through the inference service listening on this socket',
+    required=False,
+    default=None)
+  parser.add_argument(
+    '--eventsDb',
+    help='Log every classified item to this SQLite database, e.g. events.db',
+    required=False,
+    default=None)
   args = parser.parse_args()
 
-  run(args.model, bool(args.saveImages))
+  timer = startup.StartupTimer(_IMPORT_START_TIME)
+  timer.record('imports', _IMPORT_START_TIME)
+
+  timer.timed('hardware setup', lambda: setup_hardware(
+      hardware.load(bool(args.simulate))))
+  run(args.model, bool(args.saveImages), args.motionDebounce,
+      bool(args.visionTrigger), bool(args.headless), args.previewPort,
+      timer=timer, metrics_file=args.metricsFile, record_dir=args.record,
+      cascade_model=args.cascadeModel, cascade_score=args.cascadeScore,
+      cascade_margin=args.cascadeMargin,
+      inference_socket=args.inferenceSocket, events_db=args.eventsDb)
 
 if __name__ == '__main__':
   try:
     main()
   except KeyboardInterrupt:
-    clearLEDs()
+    if LED is not None:
+      clearLEDs()
   except:
     pass
     
@@ -0,0 +1,247 @@
+"""End-to-end deposit timing of the bin on simulated hardware.
+
+Runs the `run_best_integ.py` loop with the real classifier but simulated
+GPIO, servos, LEDs and camera. For every deposit an item image is put in
+front of the simulated camera and the PIR is pulsed; the deposit is done when
+the chute servo is back in place and detached. Results are written as JSON
+and can be compared against a previous run:
+
+  python3 simulate_deposits.py --items 20 --output deposits.json
+  python3 simulate_deposits.py --baseline deposits.json --output new.json
+
+Runs on any Linux machine, no Raspberry Pi needed.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import hardware
+import image_files
+import metrics
+import preview
+import run_best_integ
+
+_ITEMS = 10
+_PIR_PULSE = 0.5  # seconds the simulated PIR output stays high
+_STARTUP_TIMEOUT = 60  # seconds to wait for the model and camera
+_DEPOSIT_TIMEOUT = 30  # seconds to wait for one deposit
+# The sort angles `run_best_integ.toggle()` moves the chute to
+SORT_ANGLES = {70: 'recycle', 200: 'nonRecyclable'}
+# Allowed change against the baseline before a result is a regression
+_LATENCY_TOLERANCE = 0.10  # relative increase of the p50 deposit latency
+_THROUGHPUT_TOLERANCE = 0.10  # relative drop of the items per minute
+
+
+def _percentiles(latencies):
+  p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+  return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+def _deposit(backend, image, motion_debounce):
+  """Drops one item and waits until the chute is back in place.
+
+  Returns:
+    A dict with the timing of the deposit, or None if it timed out.
+  """
+  backend.scene.show(image)
+  start_time = time.time()
+  backend.GPIO.pulse(run_best_integ.PIR, _PIR_PULSE)
+  log = backend.log
+  sort = log.wait_for('servo', run_best_integ.CHOOSE_PIN, since=start_time,
+                      timeout=_DEPOSIT_TIMEOUT)
+  if sort is None:
+    backend.scene.clear()
+    return None
+  done = log.wait_for('servo', run_best_integ.CHOOSE_PIN, value=None,
+                      since=sort.timestamp, timeout=_DEPOSIT_TIMEOUT)
+  backend.scene.clear()
+  if done is None:
+    return None
+  led_writes = len(log.events('led', since=start_time))
+  # A new item is only accepted once the motion debounce ran out
+  remaining = start_time + motion_debounce - time.time()
+  if remaining > 0:
+    time.sleep(remaining)
+  return {
+      'decision': SORT_ANGLES.get(round(sort.value), str(sort.value)),
+      'decision_latency': sort.timestamp - start_time,
+      'sort_time': done.timestamp - sort.timestamp,
+      'deposit_latency': done.timestamp - start_time,
+      'led_writes': led_writes,
+  }
+
+
+def wait_until_ready(backend, timeout=_STARTUP_TIMEOUT):
+  """Blocks until the bin homed its servos and lit the camera.
+
+  Returns:
+    True if the bin is watching for motion, False if the timeout expired.
+  """
+  # The loop turns the camera light on once it watches for motion
+  camera_light = backend.Color(255, 100, 25)
+  lit = (camera_light,) * (run_best_integ.LED_COUNT - 8) + (0,) * 8
+  return (run_best_integ.scheduler.wait_idle(timeout) and
+          backend.log.wait_for('led', value=lit, timeout=timeout) is not None)
+
+
+def _compare(results, baseline):
+  """Returns a list of regressions of `results` against `baseline`."""
+  regressions = []
+  old_p50 = baseline['deposit_latency']['p50_ms']
+  new_p50 = results['deposit_latency']['p50_ms']
+  if new_p50 > old_p50 * (1 + _LATENCY_TOLERANCE):
+    regressions.append(f'deposit p50 latency {old_p50:.0f} -> {new_p50:.0f} ms')
+  old_rate = baseline['items_per_minute']
+  new_rate = results['items_per_minute']
+  if new_rate < old_rate * (1 - _THROUGHPUT_TOLERANCE):
+    regressions.append(f'throughput {old_rate:.2f} -> {new_rate:.2f} items/min')
+  return regressions
+
+
+def run(model, images_dir, items, motion_debounce, output, baseline,
+        cascade_model=None, inference_socket=None):
+  images = [cv2.imread(path) for path in image_files.find_images(images_dir)]
+  images = [image for image in images if image is not None]
+  if not images:
+    sys.exit(f'ERROR: No images found in {images_dir}')
+
+  backend = hardware.SimulatedHardware()
+  run_best_integ.setup_hardware(backend)
+  controls = preview.ControlChannel()
+  bin_thread = threading.Thread(
+      target=run_best_integ.run,
+      args=(model, False, motion_debounce),
+      kwargs={'headless': True, 'controls': controls,
+              'cascade_model': cascade_model,
+              'inference_socket': inference_socket},
+      name='Bin', daemon=True)
+  bin_thread.start()
+  if not wait_until_ready(backend):
+    sys.exit('ERROR: The bin did not start')
+
+  deposits = []
+  start_time = time.time()
+  for i in range(items):
+    deposit = _deposit(backend, images[i % len(images)], motion_debounce)
+    if deposit is None:
+      print(f'Item {i}: timed out')
+      continue
+    deposits.append(deposit)
+    print(f"Item {i}: {deposit['decision']} after "
+          f"{deposit['decision_latency']:.2f} s, done after "
+          f"{deposit['deposit_latency']:.2f} s")
+  elapsed = time.time() - start_time
+
+  controls.post(preview.CONTROL_KEYS['quit'])
+  bin_thread.join(_DEPOSIT_TIMEOUT)
+  if not deposits:
+    sys.exit('ERROR: No deposit completed')
+
+  snapshot = metrics.registry.snapshot()
+  results = {
+      'settings': {
+          'model': model,
+          'cascade_model': cascade_model,
+          'inference_socket': inference_socket,
+          'images_dir': images_dir,
+          'items': items,
+          'motion_debounce': motion_debounce,
+      },
+      'timestamp': time.time(),
+      'completed': len(deposits),
+      'items_per_minute': len(deposits) / elapsed * 60,
+      'deposit_latency': _percentiles(
+          [d['deposit_latency'] for d in deposits]),
+      'decision_latency': _percentiles(
+          [d['decision_latency'] for d in deposits]),
+      'sort_time': _percentiles([d['sort_time'] for d in deposits]),
+      'led_writes_per_deposit': float(
+          np.mean([d['led_writes'] for d in deposits])),
+      'interrupted_servo_moves': sum(
+          servo.interrupted_moves for servo in backend.servos),
+      'stages': snapshot['stages'],
+      'counters': snapshot['counters'],
+      'deposits': deposits,
+  }
+  latency = results['deposit_latency']
+  print(f"{results['completed']}/{items} deposits, "
+        f"{results['items_per_minute']:.2f} items/min, deposit p50/p95/p99 "
+        f"{latency['p50_ms']:.0f}/{latency['p95_ms']:.0f}/"
+        f"{latency['p99_ms']:.0f} ms, decision p50 "
+        f"{results['decision_latency']['p50_ms']:.0f} ms")
+  if results['interrupted_servo_moves']:
+    print(f"WARNING: {results['interrupted_servo_moves']} servo moves were "
+          'cut short by a detach')
+
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {output}')
+
+  if baseline:
+    with open(baseline) as f:
+      regressions = _compare(results, json.load(f))
+    for regression in regressions:
+      print(f'REGRESSION: {regression}')
+    if regressions:
+      sys.exit(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--model',
+      help='Name of image classification model.',
+      required=False,
+      default='default_model.tflite')
+  parser.add_argument(
+      '--cascadeModel',
+      help='Heavier model for the items the main model is unsure about.',
+      required=False,
+      default=None)
+  parser.add_argument(
+      '--inferenceSocket',
+      help='Classify through the inference service listening on this socket.',
+      required=False,
+      default=None)
+  parser.add_argument(
+      '--images',
+      help='Directory of item images shown to the simulated camera.',
+      required=False,
+      default='challenged_images')
+  parser.add_argument(
+      '--items',
+      help='Number of items to deposit.',
+      type=int,
+      required=False,
+      default=_ITEMS)
+  parser.add_argument(
+      '--motionDebounce',
+      help='Seconds after a motion trigger during which new motion is ignored.',
+      type=float,
+      required=False,
+      default=run_best_integ.MOTION_DEBOUNCE)
+  parser.add_argument(
+      '--output',
+      help='JSON file the results are written to.',
+      required=False,
+      default='deposit_results.json')
+  parser.add_argument(
+      '--baseline',
+      help='Previous results file; exit with an error on regressions.',
+      required=False,
+      default=None)
+  args = parser.parse_args()
+
+  run(args.model, args.images, args.items, args.motionDebounce, args.output,
+      args.baseline, args.cascadeModel, args.inferenceSocket)
+
+
+if __name__ == '__main__':
+  main()
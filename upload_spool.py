@@ -0,0 +1,437 @@
+"""Disk-backed background upload queue for challenged images.
+
+Challenged images are written locally first and a small JSON entry is put in
+the spool directory. Worker threads upload spooled entries to a storage
+bucket and delete the entry once the upload succeeded, so a challenge
+survives both a flaky uplink and a restart of the bin. Entries that keep
+failing while other uploads succeed are moved to `<spool>/failed/` after
+`_MAX_ATTEMPTS` attempts; their image stays on disk. `enqueue_image()`
+also moves the JPEG encoding and the disk write off the caller's thread.
+
+The bucket only needs the subset of the `firebase_admin.storage.bucket()`
+API used here: `bucket.blob(name).upload_from_filename(path)`. `LocalBucket`
+implements it on top of a local directory so the whole path can be
+load-tested offline:
+
+  python3 upload_spool.py --images 200 --workers 4 --latency 0.2 --outage 5
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import cv2
+
+import metrics
+
+_SPOOL_DIR = 'upload_spool'
+_NUM_WORKERS = 2
+# Backoff between retries while the link is down, doubled after every
+# failure and randomized by up to 25% so bins don't retry in lockstep.
+_INITIAL_BACKOFF = 2  # seconds
+_MAX_BACKOFF = 300  # seconds
+# Failed uploads of one entry, while the link is up, before it is given up
+_MAX_ATTEMPTS = 10
+_FAILED_DIR = 'failed'  # spool subdirectory of entries given up on
+
+
+class LocalBlob:
+  """A blob in a `LocalBucket`."""
+
+  def __init__(self, bucket, name):
+    self._bucket = bucket
+    self.name = name
+
+  def upload_from_filename(self, filename):
+    if self._bucket.latency:
+      time.sleep(self._bucket.latency)
+    if (not self._bucket.online or
+        random.random() < self._bucket.failure_rate):
+      raise ConnectionError(f'Simulated upload failure for {self.name}')
+
+    destination = os.path.join(self._bucket.root, self.name)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(filename, destination + '.part')
+    os.replace(destination + '.part', destination)
+
+
+class LocalBucket:
+  """Local-directory stand-in for `firebase_admin.storage.bucket()`.
+
+  Attributes:
+    root: Directory uploaded blobs are copied to.
+    latency: Seconds every upload takes, to simulate a slow link.
+    failure_rate: Probability in [0, 1] that an upload fails.
+    online: Set to False to make every upload fail until set back to True.
+  """
+
+  def __init__(self, root, latency=0.0, failure_rate=0.0):
+    self.root = root
+    self.latency = latency
+    self.failure_rate = failure_rate
+    self.online = True
+
+  def blob(self, name):
+    return LocalBlob(self, name)
+
+
+class FirebaseBucket:
+  """Firebase Storage bucket that connects on the first upload.
+
+  Importing `firebase_admin` and reading the credentials is slow on the Pi,
+  so it is done by an upload worker rather than at startup. A failed
+  connection raises from `blob()` like a failed upload and is retried with
+  the same backoff.
+  """
+
+  def __init__(self, credentials_file, bucket_name):
+    self._credentials_file = credentials_file
+    self._bucket_name = bucket_name
+    self._lock = threading.Lock()
+    self._app = None
+    self._bucket = None
+
+  def blob(self, name):
+    return self._connect().blob(name)
+
+  def _connect(self):
+    with self._lock:
+      if self._bucket is None:
+        # pylint: disable=import-outside-toplevel
+        from firebase_admin import credentials, initialize_app, storage
+        if self._app is None:
+          self._app = initialize_app(
+              credentials.Certificate(self._credentials_file),
+              {'storageBucket': self._bucket_name})
+        self._bucket = storage.bucket(app=self._app)
+      return self._bucket
+
+
+class UploadSpool:
+  """Uploads spooled files to a bucket from a pool of worker threads.
+
+  All workers share the same bucket object, so its HTTP session and
+  connections are reused across uploads. When an upload fails the link is
+  considered down: a single worker retries one entry with exponential backoff
+  while the others wait, and as soon as that probe succeeds every worker
+  resumes and the backlog is flushed in one go.
+
+  A failed entry also backs off on its own and goes to the back of the
+  queue, so an entry that can never be uploaded does not hold up the others.
+  Only failures while the link is up count towards `_MAX_ATTEMPTS`, so an
+  outage never gives up on the backlog.
+  """
+
+  def __init__(self, bucket, spool_dir=_SPOOL_DIR, num_workers=_NUM_WORKERS):
+    self._bucket = bucket
+    self._spool_dir = spool_dir
+    self._num_workers = num_workers
+    self._pending = collections.deque()
+    self._condition = threading.Condition()
+    self._workers = []
+    self._running = False
+    self._in_flight = 0
+    # Images being encoded, spooled once they are on disk
+    self._writing = 0
+    self._writer = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='UploadSpoolWriter')
+    self._link_up = True
+    self._probing = False
+    self._backoff = _INITIAL_BACKOFF
+    self._retry_time = 0
+    self.uploaded = 0
+    self.failures = 0
+    self.given_up = 0
+
+  def start(self):
+    """Loads entries left over from a previous run and starts the workers."""
+    os.makedirs(self._spool_dir, exist_ok=True)
+    entries = []
+    for name in os.listdir(self._spool_dir):
+      if not name.endswith('.json'):
+        continue
+      entry_path = os.path.join(self._spool_dir, name)
+      try:
+        with open(entry_path) as f:
+          entry = json.load(f)
+      except (OSError, ValueError):
+        print(f'Skipping unreadable upload spool entry {entry_path}')
+        continue
+      entry['entry_path'] = entry_path
+      entries.append(entry)
+    entries.sort(key=lambda entry: entry['created'])
+    if entries:
+      print(f'Resuming {len(entries)} queued upload(s)')
+
+    with self._condition:
+      self._pending.extend(entries)
+      self._running = True
+    for i in range(self._num_workers):
+      worker = threading.Thread(
+          target=self._work, name=f'UploadSpool-{i}', daemon=True)
+      worker.start()
+      self._workers.append(worker)
+
+  def stop(self, timeout=None):
+    """Stops the workers. Entries not uploaded yet stay in the spool."""
+    # Queued images are written and spooled first, so they are not lost
+    self._writer.shutdown(wait=True)
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    for worker in self._workers:
+      worker.join(timeout)
+    self._workers = []
+
+  def enqueue(self, local_path, remote_path):
+    """Spools an existing local file for upload.
+
+    Args:
+      local_path: File to upload. It must stay in place until uploaded.
+      remote_path: Blob name in the bucket.
+    """
+    entry = {
+        'local_path': local_path,
+        'remote_path': remote_path,
+        'created': time.time(),
+        'attempts': 0,
+    }
+    entry['entry_path'] = os.path.join(self._spool_dir,
+                                       str(uuid.uuid4()) + '.json')
+    self._write_entry(entry)
+    with self._condition:
+      self._pending.append(entry)
+      self._condition.notify()
+
+  def enqueue_image(self, image, local_path, remote_path):
+    """Writes a BGR image to `local_path` in the background and spools it.
+
+    The image must not be modified afterwards. It is only spooled once it
+    was written, so a restart before that loses it.
+    """
+    with self._condition:
+      self._writing += 1
+    self._writer.submit(self._write_image, image, local_path, remote_path)
+
+  def pending_count(self):
+    """Returns the number of entries waiting for or being uploaded."""
+    with self._condition:
+      return len(self._pending) + self._in_flight + self._writing
+
+  def flush(self, timeout=None):
+    """Blocks until every spooled entry was uploaded.
+
+    Returns:
+      True if the spool is empty, False if the timeout expired.
+    """
+    with self._condition:
+      return self._condition.wait_for(
+          lambda: (not self._pending and not self._in_flight and
+                   not self._writing), timeout)
+
+  def _write_image(self, image, local_path, remote_path):
+    try:
+      os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+      with metrics.timed('upload_encode'):
+        written = cv2.imwrite(local_path, image)
+      if written:
+        self.enqueue(local_path, remote_path)
+      else:
+        print(f'ERROR: Unable to write {local_path}, not uploading it')
+        metrics.increment('upload_write_failures')
+    except (OSError, cv2.error) as e:
+      print(f'ERROR: Unable to spool {local_path}: {e}')
+      metrics.increment('upload_write_failures')
+    finally:
+      with self._condition:
+        self._writing -= 1
+        self._condition.notify_all()
+
+  def _write_entry(self, entry):
+    data = {k: v for k, v in entry.items() if k != 'entry_path'}
+    tmp_path = entry['entry_path'] + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(data, f)
+    os.replace(tmp_path, entry['entry_path'])
+
+  def _next_entry(self):
+    """Waits for an entry that may be uploaded now.
+
+    Returns:
+      An `(entry, probe)` tuple, where `probe` is True if the upload is the
+      one probing a link that is down, or `(None, False)` when stopping.
+    """
+    with self._condition:
+      while True:
+        if not self._running:
+          return None, False
+        now = time.time()
+        # The oldest entry that is not backing off after its own failure
+        entry = next((entry for entry in self._pending
+                      if entry.get('retry_time', 0) <= now), None)
+        if entry is not None and self._link_up:
+          probe = False
+          break
+        # While the link is down only one worker probes it at a time
+        if (entry is not None and not self._probing and
+            now >= self._retry_time):
+          self._probing = probe = True
+          break
+        timeout = None
+        if self._pending and not (self._probing and not self._link_up):
+          retry_time = min(entry.get('retry_time', 0)
+                           for entry in self._pending)
+          if not self._link_up:
+            retry_time = max(retry_time, self._retry_time)
+          timeout = max(0.0, retry_time - now)
+        self._condition.wait(timeout)
+      self._pending.remove(entry)
+      self._in_flight += 1
+      return entry, probe
+
+  def _work(self):
+    while True:
+      entry, probe = self._next_entry()
+      if entry is None:
+        return
+
+      if not os.path.exists(entry['local_path']):
+        print(f"Dropping upload of missing file {entry['local_path']}")
+        self._finish(entry, probe, success=True)
+        continue
+
+      start_time = time.time()
+      try:
+        blob = self._bucket.blob(entry['remote_path'])
+        blob.upload_from_filename(entry['local_path'])
+      except Exception as e:  # pylint: disable=broad-except
+        print(f"Upload of {entry['remote_path']} failed: {e}")
+        metrics.increment('upload_failures')
+        self._finish(entry, probe, success=False)
+      else:
+        metrics.observe('upload', time.time() - start_time)
+        self._finish(entry, probe, success=True)
+
+  def _finish(self, entry, probe, success):
+    give_up = False
+    if success:
+      try:
+        os.remove(entry['entry_path'])
+      except FileNotFoundError:
+        pass
+    else:
+      # A failed probe only says the link is still down
+      if not probe:
+        entry['attempts'] += 1
+      give_up = entry['attempts'] >= _MAX_ATTEMPTS
+      if give_up:
+        self._give_up(entry)
+      else:
+        backoff = min(_INITIAL_BACKOFF * 2 ** entry['attempts'], _MAX_BACKOFF)
+        entry['retry_time'] = time.time() + backoff * random.uniform(1.0, 1.25)
+        self._write_entry(entry)
+
+    with self._condition:
+      self._in_flight -= 1
+      if probe:
+        self._probing = False
+      if success:
+        self.uploaded += 1
+        if not self._link_up:
+          print(f'Upload link restored, flushing {len(self._pending)} '
+                f'queued image(s)')
+        self._link_up = True
+        self._backoff = _INITIAL_BACKOFF
+      else:
+        self.failures += 1
+        if give_up:
+          self.given_up += 1
+        else:
+          # At the back, so an entry that keeps failing holds up no others
+          self._pending.append(entry)
+        if self._link_up or probe:
+          self._retry_time = time.time() + self._backoff * random.uniform(
+              1.0, 1.25)
+          self._backoff = min(self._backoff * 2, _MAX_BACKOFF)
+        self._link_up = False
+      self._condition.notify_all()
+
+  def _give_up(self, entry):
+    """Moves the entry out of the spool, keeping it for inspection."""
+    failed_dir = os.path.join(self._spool_dir, _FAILED_DIR)
+    print(f"ERROR: Giving up on uploading {entry['remote_path']} after "
+          f"{entry['attempts']} attempts, entry moved to {failed_dir}")
+    metrics.increment('upload_given_up')
+    try:
+      os.makedirs(failed_dir, exist_ok=True)
+      self._write_entry(entry)
+      os.replace(entry['entry_path'], os.path.join(
+          failed_dir, os.path.basename(entry['entry_path'])))
+    except OSError as e:
+      print(f"ERROR: Unable to move {entry['entry_path']}: {e}")
+
+
+def _load_test(num_images, num_workers, latency, failure_rate, outage):
+  """Uploads synthetic images to a LocalBucket and reports throughput."""
+  work_dir = tempfile.mkdtemp(prefix='upload_spool_')
+  bucket = LocalBucket(os.path.join(work_dir, 'bucket'), latency, failure_rate)
+  images_dir = os.path.join(work_dir, 'images')
+  os.makedirs(images_dir)
+
+  spool = UploadSpool(bucket, os.path.join(work_dir, 'spool'), num_workers)
+  spool.start()
+  bucket.online = outage <= 0
+  if outage > 0:
+    threading.Timer(outage, lambda: setattr(bucket, 'online', True)).start()
+
+  start_time = time.time()
+  for i in range(num_images):
+    path = os.path.join(images_dir, f'{i}.jpg')
+    with open(path, 'wb') as f:
+      f.write(os.urandom(64 * 1024))
+    spool.enqueue(path, f'challenged_images/loadtest/{i}.jpg')
+  enqueue_time = time.time() - start_time
+
+  spool.flush()
+  elapsed = time.time() - start_time
+  spool.stop()
+  print(f'Enqueued {num_images} image(s) in {enqueue_time:.3f} s')
+  print(f'Uploaded {spool.uploaded} image(s) in {elapsed:.2f} s '
+        f'({spool.uploaded / elapsed:.1f} images/s), '
+        f'{spool.failures} failed attempt(s), gave up on {spool.given_up}')
+  shutil.rmtree(work_dir)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Load-test the upload spool against a local bucket.',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--images', help='Number of images to upload.', type=int, default=100)
+  parser.add_argument(
+      '--workers', help='Number of upload workers.', type=int,
+      default=_NUM_WORKERS)
+  parser.add_argument(
+      '--latency', help='Seconds each upload takes.', type=float, default=0.1)
+  parser.add_argument(
+      '--failureRate', help='Probability that an upload fails.', type=float,
+      default=0.0)
+  parser.add_argument(
+      '--outage', help='Seconds the link is down at the start.', type=float,
+      default=0.0)
+  args = parser.parse_args()
+
+  _load_test(args.images, args.workers, args.latency, args.failureRate,
+             args.outage)
+
+
+if __name__ == '__main__':
+  main()